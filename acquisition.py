@@ -0,0 +1,380 @@
+"""Out-of-process acquisition.
+
+The scope is owned by a worker process so that a crash or a hung serial port
+in acquisition cannot take the server down with it. The worker writes every
+frame into a FrameRing, a ring of fixed size slots in shared memory, and the
+server reads frames straight out of the ring. Settings changes travel the
+other way over a pipe.
+
+The ring is created by the server before the worker is forked, so it survives
+worker restarts and the server keeps the last good frames while it waits for
+a new worker to come up.
+"""
+import collections
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import metrics
+from scope import AcquisitionControl, Frame, FramePool, Scope
+from scope import ScopeReadThread, ScopeSettings, SAMPLE_COUNT, empty_codes
+
+TRIGGER_CHANNELS = (Scope.CHANNEL_A, Scope.CHANNEL_B, Scope.EXTERNAL)
+
+
+class FrameRing(object):
+    """A single writer, lock-free ring of decoded frames in shared memory.
+
+    Each slot starts with the sequence number of the frame it holds. The
+    writer zeroes it before touching the slot and stores the new sequence
+    number once the slot is complete, so a reader knows a slot is consistent
+    if it holds the sequence number it expects both before and after reading.
+
+    read copies a frame's codes out of its slot, since the slot is rewritten
+    after slot_count newer frames while the frame may still be waiting to be
+    encoded for a client. Readers check is_valid once the copy is made to
+    detect a slot rewritten during it.
+    """
+    HEADER = struct.Struct('=QQ')
+    SEQUENCE = struct.Struct('=Q')
+    SLOT_HEADER = struct.Struct('=QdHBdBBdd')
+    CODES_OFFSET = 64
+    SLOT_SIZE = CODES_OFFSET + 2 * SAMPLE_COUNT * 2
+
+    def __init__(self, slot_count=16):
+        self.slot_count = slot_count
+        self.memory = mmap.mmap(
+                -1, FrameRing.HEADER.size + slot_count * FrameRing.SLOT_SIZE)
+        FrameRing.HEADER.pack_into(self.memory, 0, slot_count, 0)
+
+    @property
+    def head(self):
+        """Sequence number of the newest complete frame, 0 if none."""
+        return FrameRing.SEQUENCE.unpack_from(self.memory, 8)[0]
+
+    def slot_offset(self, sequence):
+        slot = sequence % self.slot_count
+        return FrameRing.HEADER.size + slot * FrameRing.SLOT_SIZE
+
+    def codes_views(self, offset):
+        codes_offset = offset + FrameRing.CODES_OFFSET
+        a_codes = numpy.frombuffer(
+                self.memory, dtype=numpy.int16, count=SAMPLE_COUNT,
+                offset=codes_offset)
+        b_codes = numpy.frombuffer(
+                self.memory, dtype=numpy.int16, count=SAMPLE_COUNT,
+                offset=codes_offset + 2 * SAMPLE_COUNT)
+        return (a_codes, b_codes)
+
+    def write(self, frame):
+        """Stores a frame in the next slot. Returns its ring sequence number.
+
+        Sequence numbers come from the ring rather than the frame, so they
+        keep increasing across worker restarts.
+        """
+        sequence = self.head + 1
+        offset = self.slot_offset(sequence)
+        settings = frame.settings
+        FrameRing.SEQUENCE.pack_into(self.memory, offset, 0)
+        FrameRing.SLOT_HEADER.pack_into(
+                self.memory, offset,
+                0,
+                frame.timestamp,
+                frame.end_addr,
+                settings.sample_rate_divisor,
+                settings.trigger_level,
+                settings.trigger_edge,
+                TRIGGER_CHANNELS.index(settings.trigger_channel),
+                settings.step_size_a,
+                settings.step_size_b)
+        a_codes, b_codes = frame.codes
+        if numpy is not None:
+            a_slot, b_slot = self.codes_views(offset)
+            a_slot[:] = a_codes
+            b_slot[:] = b_codes
+        else:
+            struct.pack_into(
+                    '=%dh' % (2 * SAMPLE_COUNT), self.memory,
+                    offset + FrameRing.CODES_OFFSET, *(a_codes + b_codes))
+        FrameRing.SEQUENCE.pack_into(self.memory, offset, sequence)
+        FrameRing.SEQUENCE.pack_into(self.memory, 8, sequence)
+        return sequence
+
+    def is_valid(self, sequence):
+        offset = self.slot_offset(sequence)
+        slot_sequence = FrameRing.SEQUENCE.unpack_from(self.memory, offset)[0]
+        return slot_sequence == sequence
+
+    def read(self, sequence, out=None):
+        """Returns the frame with the given sequence number, or None.
+
+        With numpy, the codes are copied into out, a pair of arrays from
+        empty_codes, if given.
+        """
+        offset = self.slot_offset(sequence)
+        (slot_sequence, timestamp, end_addr, divisor, trigger_level,
+         trigger_edge, trigger_channel, step_size_a, step_size_b) = (
+                FrameRing.SLOT_HEADER.unpack_from(self.memory, offset))
+        if slot_sequence != sequence:
+            return None
+
+        if numpy is not None:
+            codes = out if out is not None else empty_codes()
+            for codes_out, slot_codes in zip(codes, self.codes_views(offset)):
+                codes_out[:] = slot_codes
+        else:
+            values = struct.unpack_from(
+                    '=%dh' % (2 * SAMPLE_COUNT), self.memory,
+                    offset + FrameRing.CODES_OFFSET)
+            codes = (list(values[:SAMPLE_COUNT]),
+                     list(values[SAMPLE_COUNT:]))
+        settings = ScopeSettings(
+                sample_rate_divisor=divisor,
+                trigger_level=trigger_level,
+                trigger_edge=trigger_edge,
+                trigger_channel=TRIGGER_CHANNELS[trigger_channel],
+                step_size_a=step_size_a,
+                step_size_b=step_size_b)
+        return Frame(sequence, timestamp, settings, end_addr, None,
+                     codes=codes)
+
+
+class RingFrameSink(object):
+    """Stands in for the data sender inside the worker process."""
+
+    def __init__(self, ring):
+        self.ring = ring
+
+    def append(self, frame):
+        self.ring.write(frame)
+
+
+def close_inherited_fds(keep):
+    """Closes every file descriptor but stdio and those in keep.
+
+    A worker forked by a running server would otherwise hold on to the
+    server's listening socket and client connections, so clients the server
+    closes would not see EOF, and the port would stay bound if the server
+    died.
+    """
+    try:
+        max_fd = os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError):
+        max_fd = 256
+    low = 3
+    for fd in sorted(keep):
+        os.closerange(low, fd)
+        low = max(low, fd + 1)
+    os.closerange(low, max_fd)
+
+
+def run_acquisition_worker(scope_port, ring, commands, pipelined):
+    """Entry point of the worker process.
+
+    Acquires frames into the ring and applies (method name, args) settings
+    commands received from the server until told to stop. The server's
+    AcquisitionControl state arrives as ('control', (mode, demand)).
+    """
+    # SIGINT goes to the whole process group; the server decides when the
+    # worker should stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The ring is an anonymous mapping, so only the pipe has a descriptor.
+    close_inherited_fds([commands.fileno()])
+    scope = Scope(scope_port)
+    control = AcquisitionControl()
+    read_thread = ScopeReadThread(
+            scope, RingFrameSink(ring), pipelined=pipelined, control=control)
+    read_thread.daemon = True
+    read_thread.start()
+
+    while True:
+        name, args = commands.recv()
+        if name == 'stop':
+            break
+        elif name == 'control':
+            control.update(*args)
+        else:
+            getattr(scope, name)(*args)
+    read_thread.stop()
+
+
+class RemoteScope(Scope):
+    """The server's view of a Scope owned by an AcquisitionWorker.
+
+    Settings are tracked locally, so the server can answer questions like
+    sample_rate without a round trip, and forwarded to the worker. The latest
+    value of each setting is kept so it can be replayed to a new worker.
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.calls = collections.OrderedDict()
+        super(RemoteScope, self).__init__(None, com=worker)
+
+    def queue_command(self, key, cmd):
+        pass  # The worker's Scope talks to the hardware.
+
+    def forward(self, key, name, *args):
+        self.calls[key] = (name, args)
+        self.worker.send(name, args)
+
+    def replay(self):
+        for name, args in self.calls.values():
+            self.worker.send(name, args)
+
+    def get_frame(self):
+        raise NotImplementedError('frames are read from the FrameRing')
+
+    def forward_control(self, control):
+        self.forward('control', 'control', control.mode,
+                     control.demand or not control.on_demand)
+
+    def set_preamp(self, channel, high):
+        super(RemoteScope, self).set_preamp(channel, high)
+        self.forward(('preamp', channel.upper()), 'set_preamp', channel, high)
+
+    def set_sample_rate_divisor(self, divisor):
+        super(RemoteScope, self).set_sample_rate_divisor(divisor)
+        self.forward('sample-rate', 'set_sample_rate_divisor', divisor)
+
+    def set_trigger_type(self, edge, channel):
+        super(RemoteScope, self).set_trigger_type(edge, channel)
+        self.forward('trigger-type', 'set_trigger_type', edge, channel)
+
+    def set_trigger_level(self, voltage):
+        super(RemoteScope, self).set_trigger_level(voltage)
+        self.forward('trigger-level', 'set_trigger_level', voltage)
+
+
+class AcquisitionWorker(object):
+    """Runs and supervises the acquisition worker process.
+
+    The worker follows the server's AcquisitionControl, if there is one.
+    """
+    RESTART_DELAY = 1.0
+
+    def __init__(self, scope_port, ring, pipelined=False, control=None):
+        self.scope_port = scope_port
+        self.ring = ring
+        self.pipelined = pipelined
+        self.process = None
+        self.commands = None
+        self.restarts = 0
+        self.died_at = None
+        self.scope = RemoteScope(self)
+        if control is not None:
+            control.add_listener(lambda: self.scope.forward_control(control))
+            self.scope.forward_control(control)
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def start(self):
+        self.commands, worker_commands = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+                target=run_acquisition_worker,
+                args=(self.scope_port, self.ring, worker_commands,
+                      self.pipelined))
+        self.process.daemon = True
+        self.process.start()
+        self.scope.replay()
+
+    def send(self, name, args):
+        if not self.alive:
+            return
+        try:
+            self.commands.send((name, args))
+        except (IOError, OSError) as e:
+            print 'could not reach acquisition worker: %s' % e
+
+    def check(self):
+        """Restarts the worker if it died. Call periodically."""
+        if self.process is None or self.alive:
+            return
+        now = time.time()
+        if self.died_at is None:
+            self.died_at = now
+            print 'acquisition worker exited with code %s' % (
+                    self.process.exitcode)
+        if now - self.died_at >= AcquisitionWorker.RESTART_DELAY:
+            self.died_at = None
+            self.restarts += 1
+            print 'restarting acquisition worker (restart %d)' % self.restarts
+            self.start()
+
+    def stop(self):
+        self.send('stop', ())
+        if self.process is not None:
+            self.process.join(1.0)
+            if self.process.is_alive():
+                self.process.terminate()
+        self.process = None
+
+
+class RingReaderThread(threading.Thread):
+    """Publishes frames from a FrameRing to the data sender.
+
+    Frames are copied out of the ring into the memory of a FramePool and only
+    published if the slot was not rewritten while they were copied. If the
+    reader falls more than a ring behind, it skips ahead to the newest frame.
+
+    With an AcquisitionControl, the reader sleeps while the control is not
+    active and skips the frames written before it woke up. Each frame read
+    counts towards a single shot, so the control stops after one.
+    """
+    POLL_INTERVAL = 0.005
+
+    def __init__(self, ring, scope_data, control=None):
+        super(RingReaderThread, self).__init__(name='ring-reader')
+
+        self.ring = ring
+        self.scope_data = scope_data
+        self.control = control
+        self.pool = FramePool(ScopeReadThread.POOL_SIZE)
+        self.last_sequence = ring.head
+        self.torn_frames = 0
+        self.stopped = True
+
+    def run(self):
+        self.stopped = False
+        while not self.stopped:
+            if self.control is not None and not self.control.active:
+                self.control.wait()
+                self.last_sequence = self.ring.head
+                continue
+            head = self.ring.head
+            if head == self.last_sequence:
+                time.sleep(RingReaderThread.POLL_INTERVAL)
+                continue
+
+            sequence = max(self.last_sequence + 1,
+                           head - self.ring.slot_count + 1)
+            self.last_sequence = sequence
+            slot = self.pool.acquire()
+            frame = self.ring.read(sequence, slot[1])
+            if frame is None or not self.ring.is_valid(sequence):
+                self.pool.release(slot)
+                self.torn_frames += 1
+                metrics.count('ring.torn-frames')
+                continue
+            self.pool.lend(frame, slot)
+            if self.control is not None:
+                self.control.begin_capture()
+            payloads = self.scope_data.encode(frame)
+            if payloads is not None:
+                self.scope_data.publish(payloads)
+
+    def stop(self):
+        self.stopped = True
+        if self.control is not None:
+            self.control.wake()
@@ -0,0 +1,397 @@
+"""Benchmarks for each stage of the acquisition to client pipeline.
+
+Runs against mockserial, so no hardware is needed:
+
+    decode      Scope.decode_sample, vectorized and pure Python, and the
+                codes alone, into new arrays and into pooled ones
+    encode      ScopeDataSender.encode for each payload key
+    acquire     frames per second sustained by ScopeReadThread, both on the
+                modelled 230400 baud link and with the link taken out
+    instruments total frames per second of 1, 2 and 4 scopes acquired in
+                parallel, and how close to linear that scales
+    latency     capture to socket latency with 1, 10, 100 and 1000 clients
+
+Results are written as JSON: a "meta" object describing the run and a
+"metrics" object mapping metric names to {"value", "unit", "better"}. Pass a
+previous results file with --compare to flag regressions.
+
+usage: python benchmark.py [--output FILE] [--compare FILE] [--quick]
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from twisted.internet import protocol, reactor
+
+import encoding
+import mockserial
+import scope
+from scope import Scope, ScopeReadThread
+from tekscope import Instrument, ScopeDataSender, ScopeFactory
+
+CLIENT_COUNTS = (1, 10, 100, 1000)
+INSTRUMENT_COUNTS = (1, 2, 4)
+
+
+class Metrics(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, name, value, unit, better='lower'):
+        self.metrics[name] = {'value': value, 'unit': unit, 'better': better}
+        print '%-45s %12.4f %s' % (name, value, unit)
+
+    def add_timings(self, name, seconds):
+        seconds = sorted(seconds)
+        count = len(seconds)
+        self.add('%s.mean' % name, 1000.0 * sum(seconds) / count, 'ms')
+        self.add('%s.p50' % name, 1000.0 * seconds[count // 2], 'ms')
+        self.add('%s.p99' % name,
+                 1000.0 * seconds[min(count - 1, int(count * 0.99))], 'ms')
+
+
+def time_calls(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        timings.append(time.time() - start)
+    return timings
+
+
+def mock_scope(realtime, seed=0):
+    return Scope(None, com=mockserial.Serial(realtime=realtime, seed=seed))
+
+
+def capture_frames(count):
+    """Returns undecoded frames captured from a mock scope."""
+    mock = mock_scope(realtime=False)
+    return [mock.get_frame() for _ in range(count)]
+
+
+def bench_decode(metrics, repeat):
+    frames = capture_frames(8)
+    mock = mock_scope(realtime=False)
+
+    def decode(decoder):
+        def run():
+            for frame in frames:
+                decoder(frame.buf, frame.end_addr)
+        return run
+
+    if numpy is not None:
+        timings = time_calls(decode(mock.decode_sample), repeat)
+        metrics.add_timings(
+                'decode.vectorized', [t / len(frames) for t in timings])
+        timings = time_calls(decode(scope.decode_codes), repeat)
+        metrics.add_timings(
+                'decode.codes', [t / len(frames) for t in timings])
+
+        codes = scope.empty_codes()
+
+        def pooled_decoder(buf, end_addr):
+            return scope.decode_codes(buf, end_addr, codes)
+        timings = time_calls(decode(pooled_decoder), repeat)
+        metrics.add_timings(
+                'decode.codes-pooled', [t / len(frames) for t in timings])
+
+    def python_decoder(buf, end_addr):
+        return scope.decode_buffer_python(buf, end_addr, mock.ad_step_sizes)
+    timings = time_calls(decode(python_decoder), max(1, repeat // 10))
+    metrics.add_timings('decode.python', [t / len(frames) for t in timings])
+
+
+def bench_encode(metrics, repeat):
+    frames = capture_frames(16)
+    for frame in frames:
+        frame.codes  # Time encoding only.
+
+    keys = [
+        (encoding.FORMAT_JSON, None, encoding.CHANNELS),
+        (encoding.FORMAT_BINARY, None, encoding.CHANNELS),
+        (encoding.FORMAT_DELTA, None, encoding.CHANNELS),
+        (encoding.FORMAT_JSON, ('minmax', 256), encoding.CHANNELS),
+        (encoding.FORMAT_JSON, ('lttb', 256), encoding.CHANNELS),
+        (encoding.FORMAT_BINARY, None, (scope.Scope.CHANNEL_A,)),
+    ]
+    for key in keys:
+        sender = ScopeDataSender(set())
+        sender.payload_keys = frozenset([key])
+        sizes = []
+
+        def run():
+            for frame in frames:
+                sizes.append(len(sender.encode(frame).get(key)))
+
+        timings = time_calls(run, repeat)
+        name = 'encode.%s' % key[0]
+        if key[1] is not None:
+            name += '.%s-%d' % key[1]
+        if key[2] != encoding.CHANNELS:
+            name += '.%s' % ''.join(key[2])
+        metrics.add_timings(name, [t / len(frames) for t in timings])
+        metrics.add('%s.bytes' % name, float(sum(sizes)) / len(sizes),
+                    'bytes')
+
+
+class CountingSink(object):
+    """Encodes frames as JSON, like a single legacy client would need."""
+
+    def __init__(self):
+        self.frames = 0
+
+    def append(self, frame):
+        encoding.encode_json(frame)
+        self.frames += 1
+
+
+def bench_acquire(metrics, duration):
+    for realtime in (True, False):
+        for pipelined in (False, True):
+            sink = CountingSink()
+            read_thread = ScopeReadThread(
+                    mock_scope(realtime=realtime), sink, pipelined=pipelined)
+            read_thread.start()
+            time.sleep(duration)
+            read_thread.stop()
+            read_thread.join()
+            name = 'acquire.%s.%s' % (
+                    'link' if realtime else 'unthrottled',
+                    'pipelined' if pipelined else 'sequential')
+            metrics.add('%s.fps' % name, sink.frames / duration, 'frames/s',
+                        better='higher')
+
+
+def bench_instruments(metrics, duration):
+    """Acquires from several mock scopes at once, each on its own link and
+    thread, the way tekscope.run_threaded does.
+    """
+    single = None
+    for count in INSTRUMENT_COUNTS:
+        sinks = [CountingSink() for _ in range(count)]
+        read_threads = [
+                ScopeReadThread(mock_scope(realtime=True, seed=i), sink)
+                for i, sink in enumerate(sinks)]
+        for read_thread in read_threads:
+            read_thread.start()
+        time.sleep(duration)
+        for read_thread in read_threads:
+            read_thread.stop()
+        for read_thread in read_threads:
+            read_thread.join()
+        fps = sum(sink.frames for sink in sinks) / duration
+        if single is None:
+            single = fps
+        name = 'instruments.%d' % count
+        metrics.add('%s.fps' % name, fps, 'frames/s', better='higher')
+        metrics.add('%s.scaling' % name, fps / (single * count) if single
+                    else 0.0, 'ratio', better='higher')
+
+
+class LatencyClient(protocol.Protocol):
+    """Switches to binary frames and records how old each frame is."""
+    HEADER = encoding.BINARY_HEADER
+
+    def __init__(self, latencies, measuring):
+        self.latencies = latencies
+        self.measuring = measuring
+        self.buffer = ''
+
+    def connectionMade(self):
+        self.transport.write('%s\n' % json.dumps({'format': 'binary'}))
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while self.buffer:
+            if self.buffer.startswith(encoding.BINARY_MAGIC):
+                size = LatencyClient.HEADER.size
+                if len(self.buffer) < size:
+                    return
+                header = LatencyClient.HEADER.unpack(self.buffer[:size])
+                end = size + header[-1]
+                if len(self.buffer) < end:
+                    return
+                if self.measuring[0]:
+                    self.latencies.append(time.time() - header[5])
+                self.buffer = self.buffer[end:]
+            else:
+                line_end = self.buffer.find('\n')
+                if line_end < 0:
+                    return
+                self.buffer = self.buffer[line_end + 1:]
+
+
+def run_latency_clients(port, count, warmup, duration, output):
+    """Runs count clients and writes the latencies they saw to output.
+
+    Runs in its own process so the clients do not compete with the server
+    for the reactor.
+    """
+    latencies = []
+    measuring = [False]
+    factory = protocol.ClientFactory()
+    factory.protocol = lambda: LatencyClient(latencies, measuring)
+    for _ in range(count):
+        reactor.connectTCP('127.0.0.1', port, factory)
+
+    def start_measuring():
+        measuring[0] = True
+
+    def finish():
+        with open(output, 'w') as f:
+            json.dump(latencies, f)
+        reactor.stop()
+
+    reactor.callLater(warmup, start_measuring)
+    reactor.callLater(warmup + duration, finish)
+    reactor.run()
+
+
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else min(
+                needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def bench_latency(metrics, client_counts, duration):
+    """Measures capture to socket latency with the server on this reactor
+    and the clients in a child process.
+    """
+    raise_file_limit(2 * max(client_counts) + 256)
+    data_sender = ScopeDataSender(set())
+    mock = mock_scope(realtime=True)
+    factory = ScopeFactory([Instrument(0, mock, data_sender)], None)
+    listener = reactor.listenTCP(0, factory, backlog=1024)
+    port = listener.getHost().port
+    read_thread = ScopeReadThread(mock, data_sender)
+    read_thread.daemon = True
+
+    def run_next(counts):
+        if not counts:
+            read_thread.stop()
+            reactor.stop()
+            return
+        count = counts[0]
+        warmup = 1.0 + count / 500.0
+        fd, output = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        clients = subprocess.Popen([
+                sys.executable, os.path.abspath(__file__),
+                '--latency-clients', str(port), str(count), str(warmup),
+                str(duration), output])
+
+        def collect():
+            if clients.poll() is None:
+                reactor.callLater(0.1, collect)
+                return
+            with open(output) as f:
+                latencies = json.load(f)
+            os.remove(output)
+            name = 'latency.clients-%d' % count
+            if latencies:
+                metrics.add_timings(name, latencies)
+            metrics.add('%s.frames-per-client' % name,
+                        float(len(latencies)) / count / duration, 'frames/s',
+                        better='higher')
+            # Let the server notice the disconnects before the next round.
+            reactor.callLater(1.0, run_next, counts[1:])
+
+        reactor.callLater(warmup + duration, collect)
+
+    reactor.callWhenRunning(read_thread.start)
+    reactor.callWhenRunning(run_next, list(client_counts))
+    reactor.run()
+
+
+def compare(metrics, baseline_path, tolerance):
+    """Prints metrics that got worse than the baseline by more than the
+    tolerance. Returns the number of regressions.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)['metrics']
+    regressions = 0
+    for name, metric in sorted(metrics.items()):
+        if name not in baseline or not baseline[name]['value']:
+            continue
+        old = baseline[name]['value']
+        change = (metric['value'] - old) / abs(old)
+        if metric['better'] == 'higher':
+            change = -change
+        if change > tolerance:
+            regressions += 1
+            print 'REGRESSION %s: %.4f -> %.4f %s (%+.1f%%)' % (
+                    name, old, metric['value'], metric['unit'], 100 * change)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Benchmarks the acquisition to client pipeline.')
+    parser.add_argument('--output', help='write JSON results to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='compare against a previous results file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change counted as a regression')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer repetitions and clients, for smoke tests')
+    parser.add_argument('--latency-clients', nargs=5,
+                        metavar=('PORT', 'COUNT', 'WARMUP', 'DURATION', 'OUT'),
+                        help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.latency_clients:
+        port, count, warmup, duration, output = args.latency_clients
+        raise_file_limit(int(count) + 256)
+        run_latency_clients(int(port), int(count), float(warmup),
+                            float(duration), output)
+        return
+
+    metrics = Metrics()
+    repeat = 20 if args.quick else 200
+    duration = 2.0 if args.quick else 10.0
+    client_counts = CLIENT_COUNTS[:2] if args.quick else CLIENT_COUNTS
+
+    bench_decode(metrics, repeat)
+    bench_encode(metrics, repeat)
+    bench_acquire(metrics, duration)
+    bench_instruments(metrics, duration)
+    bench_latency(metrics, client_counts, duration)
+
+    results = {
+        'meta': {
+            'time': time.time(),
+            'host': socket.gethostname(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__ if numpy is not None else None,
+            'quick': args.quick,
+        },
+        'metrics': metrics.metrics,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare and compare(metrics.metrics, args.compare,
+                                args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
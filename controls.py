@@ -1,5 +1,8 @@
+import collections
 import serial
 import threading
+from twisted.internet import protocol
+from twisted.internet.serialport import SerialPort
 
 
 class Control(object):
@@ -43,14 +46,17 @@ class Led(object):
 class ControlPanel(object):
     BAUD_RATE = 9600
 
-    def __init__(self, port):
-        self.com = serial.Serial(
-                port=port,
-                baudrate=ControlPanel.BAUD_RATE,
-                #parity=serial.PARITY_NONE,
-                #bytesize=serial.EIGHTBITS,
-                #stopbits=serial.STOPBITS_ONE,
-                timeout=0.2)
+    def __init__(self, port, com=None):
+        if com is None:
+            com = serial.Serial(
+                    port=port,
+                    baudrate=ControlPanel.BAUD_RATE,
+                    #parity=serial.PARITY_NONE,
+                    #bytesize=serial.EIGHTBITS,
+                    #stopbits=serial.STOPBITS_ONE,
+                    timeout=0.2)
+        self.com = com
+        self.pending_data = ''
         self.encoders = {}
         self.switches = {}
         self.leds = {}
@@ -89,61 +95,78 @@ class ControlPanel(object):
         self.leds[led_id].update(value)
 
     def update(self):
-        self.handle_message(self.com.read(2))
+        """Reads everything the control panel has sent and handles it.
+
+        Blocks for up to the port timeout waiting for the first byte.
+        """
+        data = self.com.read(1)
+        if data:
+            waiting = self.com.inWaiting()
+            if waiting:
+                data += self.com.read(waiting)
+        self.feed(data)
+
+    def feed(self, data):
+        """Handles a batch of data received from the control panel.
+
+        Messages are two bytes long. A byte that does not start a valid
+        message is logged and skipped, so the parser resynchronizes after line
+        noise instead of failing. Consecutive encoder ticks are summed, and
+        each encoder is updated once with its net movement before the next
+        switch message is handled, so switches and encoders still take effect
+        in the order they were received.
+        """
+        data = self.pending_data + data
+        encoder_deltas = collections.OrderedDict()
+        i = 0
+        while len(data) - i >= 2:
+            message = data[i:i + 2]
+            if self.is_encoder_message(message):
+                encoder_id = int(message[0])
+                step = 1 if message[1] == 'R' else -1
+                encoder_deltas[encoder_id] = (
+                        encoder_deltas.get(encoder_id, 0) + step)
+                i += 2
+            elif self.is_switch_message(message):
+                self.flush_encoders(encoder_deltas)
+                self.handle_switch(message)
+                i += 2
+            else:
+                print 'skipping unexpected control panel byte %d' % ord(
+                        message[0])
+                i += 1
+        self.pending_data = data[i:]
+        self.flush_encoders(encoder_deltas)
+
+    def flush_encoders(self, encoder_deltas):
+        """Applies and clears the summed encoder ticks."""
+        for encoder_id, delta in encoder_deltas.items():
+            self.handle_encoder(encoder_id, delta)
+        encoder_deltas.clear()
 
     def is_encoder_message(self, message):
-        return message[0].isdigit() and len(message) == 2
+        return message[0].isdigit() and message[1] in ('L', 'R')
 
     def is_switch_message(self, message):
-        return message[0].isupper() and len(message) == 2
-
-    def handle_message(self, message):
-        if len(message) == 0:
-            pass  # timed out
-        elif self.is_encoder_message(message):
-            self.handle_encoder(message)
-        elif self.is_switch_message(message):
-            self.handle_switch(message)
-        else:
-            vals = [str(ord(c)) for c in message]
-            hex_message = ' '.join(vals)
-            raise NotImplementedError('unhandled message %s' % hex_message)
+        return message[0].isupper() and message[1] in ('0', '1')
 
-    def handle_encoder(self, message):
-        encoder_id = int(message[0])
+    def handle_encoder(self, encoder_id, delta):
         if encoder_id not in self.encoders:
-            raise RuntimeError(
-                    'message received for unhandled encoder %s' %
-                    str(encoder_id))
-
-        encoder = self.encoders[encoder_id]
-        step = 1
-        if message[1] == 'L':
-            encoder.update(-step)
-        elif message[1] == 'R':
-            encoder.update(step)
-        else:
-            raise RuntimeError('malformed encoder message %s' % message)
+            print 'message received for unhandled encoder %d' % encoder_id
+        elif delta != 0:
+            self.encoders[encoder_id].update(delta)
 
     def handle_switch(self, message):
         switch_id = message[0]
         if switch_id not in self.switches:
-            raise RuntimeError(
-                    'message received for unhandled switch %s' %
-                    str(switch_id))
-
-        switch = self.switches[switch_id]
-        if message[1] == '1':
-            switch.update(True)
-        elif message[1] == '0':
-            switch.update(False)
+            print 'message received for unhandled switch %s' % switch_id
         else:
-            raise RuntimeError('malformed switch message %s' % message)
+            self.switches[switch_id].update(message[1] == '1')
 
 
 class ControlPanelThread(threading.Thread):
     def __init__(self, control_panel):
-        super(ControlPanelThread, self).__init__()
+        super(ControlPanelThread, self).__init__(name='control-panel')
         self.control_panel = control_panel
         self.stopped = True
 
@@ -155,3 +178,26 @@ class ControlPanelThread(threading.Thread):
     def stop(self):
         self.stopped = True
         self.control_panel.stop()
+
+
+class ControlPanelSerialProtocol(protocol.Protocol):
+    """Feeds control panel messages to a ControlPanel from the reactor."""
+
+    def __init__(self):
+        self.control_panel = None
+
+    def dataReceived(self, data):
+        if self.control_panel is not None:
+            self.control_panel.feed(data)
+
+
+def open_control_panel_serial(port, reactor):
+    """Opens the control panel port on the reactor.
+
+    Returns the ControlPanelSerialProtocol. Its control_panel must be set
+    once a ControlPanel has been created on its transport.
+    """
+    control_protocol = ControlPanelSerialProtocol()
+    SerialPort(control_protocol, port, reactor,
+               baudrate=ControlPanel.BAUD_RATE)
+    return control_protocol
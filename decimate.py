@@ -0,0 +1,180 @@
+"""Server-side decimation of frames for clients that need fewer points.
+
+Decimation picks sample indices from the 10-bit codes of each channel. Codes
+map to voltages through a decreasing linear function, so choosing points by
+code picks the same points as choosing them by voltage.
+
+Modes:
+    stride  every k-th sample
+    minmax  the minimum and maximum of each bucket, in time order, so that
+            spikes survive decimation
+    lttb    largest triangle three buckets, which keeps the visual shape of
+            the trace
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scope import Frame, SAMPLE_COUNT
+
+STRIDE = 'stride'
+MINMAX = 'minmax'
+LTTB = 'lttb'
+MODES = (STRIDE, MINMAX, LTTB)
+
+MIN_POINTS = {STRIDE: 1, MINMAX: 2, LTTB: 3}
+
+
+def ceil_div(a, b):
+    return -(-a // b)
+
+
+def stride_indices(codes, points):
+    step = ceil_div(len(codes), points)
+    if numpy is not None:
+        return numpy.arange(0, len(codes), step)
+    return range(0, len(codes), step)
+
+
+def minmax_indices(codes, points):
+    n = len(codes)
+    width = ceil_div(n, max(1, points // 2))
+    buckets = ceil_div(n, width)
+    if numpy is None:
+        indices = []
+        for start in range(0, n, width):
+            bucket = codes[start:start + width]
+            low = start + bucket.index(min(bucket))
+            high = start + bucket.index(max(bucket))
+            indices.extend(sorted((low, high)))
+        return indices
+
+    # Pad the last bucket with the final sample so the codes can be viewed
+    # as a (buckets, width) grid.
+    padded = numpy.empty(buckets * width, dtype=codes.dtype)
+    padded[:n] = codes
+    padded[n:] = codes[-1]
+    grid = padded.reshape(buckets, width)
+    offsets = numpy.arange(buckets) * width
+    low = grid.argmin(axis=1) + offsets
+    high = grid.argmax(axis=1) + offsets
+    pairs = numpy.sort(numpy.column_stack((low, high)), axis=1)
+    return numpy.minimum(pairs.ravel(), n - 1)
+
+
+def lttb_bounds(n, points):
+    """Returns the [start, end) sample bounds of each LTTB bucket.
+
+    The first and last samples are buckets of their own; the rest are split
+    into points - 2 buckets.
+    """
+    every = float(n - 2) / (points - 2)
+    bounds = [(0, 1)]
+    for i in range(points - 2):
+        bounds.append((int(i * every) + 1, int((i + 1) * every) + 1))
+    bounds.append((n - 1, n))
+    return bounds
+
+
+def lttb_indices(codes, points):
+    """Largest triangle three buckets.
+
+    Bucket averages are computed up front; the selection itself depends on
+    the previously selected point and has to walk the buckets in order. With
+    at most a few samples per bucket that walk is cheaper over plain floats
+    than over numpy slices.
+    """
+    n = len(codes)
+    bounds = lttb_bounds(n, points)
+    if numpy is None:
+        ys = codes
+        means = [(0.5 * (start + end - 1),
+                  float(sum(codes[start:end])) / (end - start))
+                 for start, end in bounds]
+    else:
+        ys = codes.tolist()
+        starts = numpy.array([start for start, _ in bounds])
+        ends = numpy.array([end for _, end in bounds])
+        sums = numpy.concatenate(
+                ([0], numpy.cumsum(codes, dtype=numpy.int64)))
+        mean_x = 0.5 * (starts + ends - 1)
+        mean_y = (sums[ends] - sums[starts]) / (ends - starts).astype(float)
+        means = zip(mean_x.tolist(), mean_y.tolist())
+
+    indices = [0]
+    a = 0
+    for bucket in range(1, points - 1):
+        start, end = bounds[bucket]
+        c_x, c_y = means[bucket + 1]
+        a_y = ys[a]
+        best_area = -1.0
+        best = start
+        for b in range(start, end):
+            area = abs((a - c_x) * (ys[b] - a_y) - (a - b) * (c_y - a_y))
+            if area > best_area:
+                best_area = area
+                best = b
+        a = best
+        indices.append(a)
+    indices.append(n - 1)
+    if numpy is not None:
+        return numpy.array(indices)
+    return indices
+
+
+INDEX_FUNCTIONS = {
+    STRIDE: stride_indices,
+    MINMAX: minmax_indices,
+    LTTB: lttb_indices,
+}
+
+
+def parse_decimation(value, samples=SAMPLE_COUNT):
+    """Returns the (mode, points) of a {"mode": MODE, "points": N} request,
+    or None if it is null or asks for at least as many points as there are
+    samples. Raises ValueError for anything else.
+    """
+    if value is None:
+        return None
+    mode = value.get('mode', MINMAX)
+    points = value.get('points')
+    # JSON true and false decode to bools, which are ints too.
+    if (mode not in MODES or not isinstance(points, int) or
+            isinstance(points, bool) or points < MIN_POINTS[mode]):
+        raise ValueError('unsupported decimation: %s' % value)
+    if points >= samples:
+        return None
+    return (mode, points)
+
+
+def take(values, indices):
+    if numpy is not None:
+        return values.take(indices)
+    return [values[i] for i in indices]
+
+
+def decimate_frame(frame, mode, points):
+    """Returns a Frame holding only the selected samples of each channel.
+
+    The selected sample indices are available as the frame's indices. For a
+    frame that already has indices, such as an envelope, they are the indices
+    of the original samples.
+    """
+    select = INDEX_FUNCTIONS[mode]
+    a_codes, b_codes = frame.codes
+    a_indices = select(a_codes, points)
+    if mode == STRIDE:
+        b_indices = a_indices
+    else:
+        b_indices = select(b_codes, points)
+
+    decimated = Frame(
+            frame.sequence, frame.timestamp, frame.settings, frame.end_addr,
+            None, codes=(take(a_codes, a_indices), take(b_codes, b_indices)))
+    if frame.indices is not None:
+        a_indices = take(frame.indices[0], a_indices)
+        b_indices = take(frame.indices[1], b_indices)
+    decimated.indices = (a_indices, b_indices)
+    decimated.instrument = frame.instrument
+    return decimated
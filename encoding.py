@@ -0,0 +1,425 @@
+"""Wire formats for frames sent to scope clients.
+
+Every client starts out receiving frames as JSON, one object per line:
+
+    {"instrument": ID, "A": [volts, ...], "B": [volts, ...]}
+
+ID is the instrument the frame was captured by, counting from 0 in the order
+the server was given its scopes.
+
+A client can switch to the binary format by sending {"format": "binary"}. The
+server replies with {"format": "binary"} on a JSON line, and every frame after
+that is sent as a fixed size header followed by the samples. Control and UI
+messages stay on JSON lines, so a client tells the two apart by the first four
+bytes: binary frames start with BINARY_MAGIC, JSON lines start with '{'.
+
+Binary header (big-endian, BINARY_HEADER.size bytes):
+    magic           4s  'TKSF'
+    version         B   BINARY_VERSION
+    flags           B   FLAG_INDICES if sample indices follow the codes,
+                        FLAG_NO_A or FLAG_NO_B if a channel was left out
+    instrument      B   instrument the frame was captured by
+    sequence        I   frame sequence number
+    timestamp       d   capture time, seconds since the epoch
+    sample_rate     d   samples per second
+    step_size_a     f   volts per code on channel A
+    step_size_b     f   volts per code on channel B
+    end_addr        H   end address reported by the scope
+    sample_count    H   samples per channel
+    payload_length  I   bytes following the header
+
+The payload is sample_count channel A codes followed by sample_count channel B
+codes, each a big-endian int16 holding the 10-bit value reported by the scope
+with the oldest sample first. Voltage is (511 - code) * step_size.
+
+Clients that only display one channel can subscribe to it with
+{"subscribe": {"channels": ["A"]}}. Its frames then leave the other channel
+out: JSON frames have no key for it, and binary frames set FLAG_NO_A or
+FLAG_NO_B and hold only the codes (and indices) of the channel sent.
+Measurements, persistence histograms and spectra leave it out as well.
+
+Clients can also ask for fewer points with {"decimate": {"mode": MODE,
+"points": N}}, where MODE is one of decimate.MODES, or {"decimate": null} to go
+back to full frames. Decimated JSON frames carry the sample index of every
+point as {"index": {"A": [...], "B": [...]}}. Decimated binary frames set
+FLAG_INDICES and follow the codes with the indices of channel A and then
+channel B, encoded the same way.
+
+The delta format ({"format": "delta"}) is meant for slow links. It uses the
+binary header with FLAG_COMPRESSED set, and its payload is a big-endian uint32
+reference sequence number followed by a zlib stream. The stream holds zigzag
+varints of every channel A code, then channel B code, then the indices if
+FLAG_INDICES is set. When FLAG_DELTA is set the codes are differences from the
+frame with the reference sequence number, which is always the previous frame
+sent on the connection; otherwise the frame is a keyframe, the codes are
+absolute and the reference sequence number is 0. A keyframe is sent after
+every KEYFRAME_INTERVAL - 1 deltas sent to the client, whatever frames it
+skips, after (re)connecting, whenever the client missed the reference frame
+and when the client asks for one with {"keyframe": true}.
+
+Measurements (see measure.py) are sent as their own JSON line:
+
+    {"measurements": {"instrument": ID, "sequence": N, "timestamp": T,
+                      "A": {"vpp": volts, ...}, "B": {...}}}
+
+Persistence histograms (see modes.py) are sent to subscribed clients while
+the persistence acquisition mode is on, also as a JSON line:
+
+    {"persistence": {"instrument": ID, "sequence": N, "rows": ROWS,
+                     "columns": COLUMNS, "A": IMAGE, "B": IMAGE}}
+
+IMAGE is a base64 encoded zlib stream of ROWS * COLUMNS bytes, row by row.
+Row r holds codes r * 1024 / ROWS and up, column c samples c * 1024 / COLUMNS
+and up, and each byte is how often the trace passed through that cell, scaled
+so the busiest cell is 255.
+
+Spectra (see spectrum.py) are sent to subscribed clients as:
+
+    {"spectrum": {"instrument": ID, "sequence": N, "window": WINDOW,
+                  "average": N, "bin-width": Hz,
+                  "A": [dBV, ...], "B": [dBV, ...],
+                  "peak": {"A": {"frequency": Hz, "db": dBV}, "B": {...}}}}
+
+with one value per bin from DC up to half the sample rate. The window and
+averaging are set for everyone with {"spectrum-settings": {"window": WINDOW,
+"average": N}}.
+
+{"encoder-stats": true} returns the compression ratio and mean encode time of
+each wire format.
+"""
+import array
+import base64
+import json
+import struct
+import sys
+import time
+import zlib
+
+import decimate
+import measure
+import metrics
+import modes
+from scope import Scope
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+FORMAT_JSON = 'json'
+FORMAT_BINARY = 'binary'
+FORMAT_DELTA = 'delta'
+FORMATS = (FORMAT_JSON, FORMAT_BINARY, FORMAT_DELTA)
+# Not a client choice: what a delta client gets when it needs a keyframe.
+FORMAT_DELTA_KEYFRAME = 'delta-keyframe'
+# Not wire formats for frames, but encoded and shared the same way.
+FORMAT_MEASUREMENTS = 'measurements'
+FORMAT_PERSISTENCE = 'persistence'
+FORMAT_SPECTRUM = 'spectrum'
+
+CHANNELS = (Scope.CHANNEL_A, Scope.CHANNEL_B)
+
+KEYFRAME_INTERVAL = 50
+
+BINARY_MAGIC = 'TKSF'
+BINARY_VERSION = 2
+BINARY_HEADER = struct.Struct('>4sBBBIddffHHI')
+FLAG_INDICES = 0x1
+FLAG_COMPRESSED = 0x2
+FLAG_DELTA = 0x4
+FLAG_NO_A = 0x8
+FLAG_NO_B = 0x10
+REFERENCE = struct.Struct('>I')
+
+
+def pack_codes(codes):
+    """Packs sequences of codes into big-endian int16 bytes."""
+    if numpy is not None:
+        return numpy.concatenate(codes).astype('>i2').tostring()
+    packed = array.array('h')
+    for channel_codes in codes:
+        packed.extend(channel_codes)
+    if sys.byteorder == 'little':
+        packed.byteswap()
+    return packed.tostring()
+
+
+def to_list(values):
+    if numpy is not None:
+        return values.tolist()
+    return list(values)
+
+
+def select_channels(values, channels):
+    """Returns the values of the channels sent, from a pair of values."""
+    return [value for channel, value in zip(CHANNELS, values)
+            if channel in channels]
+
+
+def channel_flags(channels):
+    flags = 0
+    if Scope.CHANNEL_A not in channels:
+        flags |= FLAG_NO_A
+    if Scope.CHANNEL_B not in channels:
+        flags |= FLAG_NO_B
+    return flags
+
+
+def encode_json(frame, channels=CHANNELS):
+    samples = frame.samples
+    data = dict((channel, samples[channel]) for channel in channels)
+    data['instrument'] = frame.instrument
+    if frame.indices is not None:
+        data['index'] = dict(
+                (channel, to_list(indices))
+                for channel, indices in zip(CHANNELS, frame.indices)
+                if channel in channels)
+    return '%s\n' % json.dumps(data)
+
+
+def encode_measurements(frame, channels=CHANNELS):
+    data = measure.measure_frame(frame, channels)
+    data['instrument'] = frame.instrument
+    data['sequence'] = frame.sequence
+    data['timestamp'] = frame.timestamp
+    return '%s\n' % json.dumps({'measurements': data})
+
+
+def encode_image(image):
+    if numpy is not None:
+        image = image.tostring()
+    return base64.b64encode(zlib.compress(str(image)))
+
+
+def encode_persistence(frame, channels=CHANNELS):
+    if frame.persistence is None:
+        return ''
+    images = frame.persistence.get()
+    if images is None:
+        return ''
+    data = {
+        'instrument': frame.instrument,
+        'sequence': frame.sequence,
+        'rows': modes.HISTOGRAM_ROWS,
+        'columns': modes.HISTOGRAM_COLUMNS,
+    }
+    for channel, image in zip(CHANNELS, images):
+        if channel in channels:
+            data[channel] = encode_image(image)
+    return '%s\n' % json.dumps({'persistence': data})
+
+
+def encode_spectrum(frame, channels=CHANNELS):
+    if frame.spectrum is None:
+        return ''
+    data = dict(frame.spectrum)
+    data['peak'] = dict(data['peak'])
+    for channel in CHANNELS:
+        if channel not in channels:
+            data.pop(channel, None)
+            data['peak'].pop(channel, None)
+    data['instrument'] = frame.instrument
+    return '%s\n' % json.dumps({'spectrum': data})
+
+
+def zigzag_varints(values):
+    """Encodes signed ints as zigzag varints.
+
+    Values must be within +/-8191 so that every varint fits in two bytes,
+    which holds for differences of 10-bit codes and for sample indices.
+    """
+    if numpy is None:
+        out = bytearray()
+        for value in values:
+            z = (value << 1) ^ (value >> 31)
+            if z < 0x80:
+                out.append(z)
+            else:
+                out.append((z & 0x7f) | 0x80)
+                out.append(z >> 7)
+        return str(out)
+
+    values = numpy.asarray(values, dtype=numpy.int32)
+    z = ((values << 1) ^ (values >> 31)).astype(numpy.uint32)
+    two = z >= 0x80
+    lengths = 1 + two
+    positions = numpy.cumsum(lengths) - lengths
+    out = numpy.empty(int(lengths.sum()), dtype=numpy.uint8)
+    out[positions] = (z & 0x7f) | (two << 7)
+    out[positions[two] + 1] = z[two] >> 7
+    return out.tostring()
+
+
+def code_differences(codes, reference_codes):
+    if numpy is None:
+        return [code - reference for code, reference in
+                zip(codes, reference_codes)]
+    return codes.astype(numpy.int32) - reference_codes
+
+
+def encode_varint_stream(frame, reference, channels=CHANNELS):
+    """Returns the zigzag varints of a frame, delta coded if reference is set.
+    """
+    streams = []
+    for channel, codes in enumerate(frame.codes):
+        if CHANNELS[channel] not in channels:
+            continue
+        if reference is not None:
+            codes = code_differences(codes, reference.codes[channel])
+        streams.append(zigzag_varints(codes))
+    if frame.indices is not None:
+        for indices in select_channels(frame.indices, channels):
+            streams.append(zigzag_varints(indices))
+    return ''.join(streams)
+
+
+def can_delta_encode(frame, reference):
+    # Differences are taken between codes, so settings changes do not matter,
+    # but both frames must hold the same number of samples.
+    return (reference is not None and
+            len(reference.codes[0]) == len(frame.codes[0]))
+
+
+def encode_delta(frame, reference=None, channels=CHANNELS):
+    flags = FLAG_COMPRESSED
+    reference_sequence = 0
+    if can_delta_encode(frame, reference):
+        flags |= FLAG_DELTA
+        reference_sequence = reference.sequence
+    else:
+        reference = None
+    payload = REFERENCE.pack(reference_sequence & 0xffffffff) + zlib.compress(
+            encode_varint_stream(frame, reference, channels))
+    return encode_binary(frame, channels, payload=payload, flags=flags)
+
+
+def encode_binary(frame, channels=CHANNELS, payload=None, flags=0):
+    a_codes, b_codes = frame.codes
+    flags |= channel_flags(channels)
+    if frame.indices is not None:
+        flags |= FLAG_INDICES
+    if payload is None:
+        payload = pack_codes(select_channels(frame.codes, channels))
+        if frame.indices is not None:
+            payload += pack_codes(select_channels(frame.indices, channels))
+    settings = frame.settings
+    header = BINARY_HEADER.pack(
+            BINARY_MAGIC,
+            BINARY_VERSION,
+            flags,
+            frame.instrument,
+            frame.sequence & 0xffffffff,
+            frame.timestamp,
+            settings.sample_rate,
+            settings.step_size_a,
+            settings.step_size_b,
+            frame.end_addr,
+            len(a_codes),
+            len(payload))
+    return header + payload
+
+
+ENCODERS = {
+    FORMAT_JSON: encode_json,
+    FORMAT_BINARY: encode_binary,
+    FORMAT_DELTA: encode_delta,
+    FORMAT_DELTA_KEYFRAME: encode_delta,
+    FORMAT_MEASUREMENTS: encode_measurements,
+    FORMAT_PERSISTENCE: encode_persistence,
+    FORMAT_SPECTRUM: encode_spectrum,
+}
+
+
+def encode_frame(frame, wire_format, reference=None, channels=CHANNELS):
+    if wire_format == FORMAT_DELTA:
+        return encode_delta(frame, reference, channels)
+    if wire_format == FORMAT_DELTA_KEYFRAME:
+        return encode_delta(frame, None, channels)
+    return ENCODERS[wire_format](frame, channels)
+
+
+class EncoderStats(object):
+    """Running totals of how long each wire format takes to encode and how
+    well it compresses relative to packed 16-bit codes.
+    """
+
+    def __init__(self):
+        self.totals = {}
+
+    def record(self, wire_format, frame, payload, seconds):
+        raw_bytes = 2 * sum(len(codes) for codes in frame.codes)
+        count, raw, encoded, total_seconds = self.totals.get(
+                wire_format, (0, 0, 0, 0.0))
+        self.totals[wire_format] = (
+                count + 1, raw + raw_bytes, encoded + len(payload),
+                total_seconds + seconds)
+
+    def report(self):
+        report = {}
+        for wire_format, totals in self.totals.items():
+            count, raw, encoded, seconds = totals
+            report[wire_format] = {
+                'frames': count,
+                'compression-ratio': float(raw) / max(encoded, 1),
+                'mean-encode-time': seconds / count,
+            }
+        return report
+
+
+stats = EncoderStats()
+
+
+class FramePayloads(object):
+    """The encodings of one frame, shared by every client that sends it.
+
+    Payloads are keyed by (wire format, decimation, channels), where
+    decimation is None or a (mode, points) pair and channels is the tuple of
+    channels sent, in CHANNELS order. Each key is encoded at most once, and
+    each decimation is computed at most once for all the wire formats that
+    use it.
+    Keys that were not encoded ahead of time are encoded on first use.
+
+    reference is the FramePayloads of the previous frame, used for delta
+    encoding. Delta encodings are keyframes when there is no reference; when
+    a client is due a periodic keyframe, it is sent the FORMAT_DELTA_KEYFRAME
+    encoding instead.
+    """
+
+    def __init__(self, frame, reference=None):
+        self.frame = frame
+        self.reference = reference
+        self.reference_sequence = None
+        if reference is not None:
+            self.reference_sequence = reference.frame.sequence
+        self.payloads = {}
+        self.decimated_frames = {}
+
+    def drop_reference(self):
+        """Releases the previous frame so frames do not form a chain."""
+        self.reference = None
+
+    def decimated(self, decimation):
+        if decimation is None:
+            return self.frame
+        frame = self.decimated_frames.get(decimation)
+        if frame is None:
+            mode, points = decimation
+            frame = decimate.decimate_frame(self.frame, mode, points)
+            self.decimated_frames[decimation] = frame
+        return frame
+
+    def get(self, key):
+        payload = self.payloads.get(key)
+        if payload is None:
+            wire_format, decimation, channels = key
+            frame = self.decimated(decimation)
+            reference = None
+            if self.reference is not None:
+                reference = self.reference.decimated(decimation)
+            start = time.time()
+            payload = encode_frame(frame, wire_format, reference, channels)
+            seconds = time.time() - start
+            stats.record(wire_format, frame, payload, seconds)
+            metrics.record('encode.%s' % wire_format, seconds)
+            self.payloads[key] = payload
+        return payload
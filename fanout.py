@@ -0,0 +1,685 @@
+"""Serving clients from several worker processes.
+
+With many clients, writing frames to every one of them keeps the reactor
+thread busy and competes for the GIL with acquisition. In fan-out mode the
+server process, the owner, keeps the scopes, the control panel and the
+encoding of each payload key, and a number of worker processes serve the
+clients:
+
+    owner       acquires, encodes each payload key in use once and writes the
+                payloads to a PayloadRing shared with every worker. Handles
+                the messages that touch shared state (settings, acquisition
+                and run modes, history queries, stats) for all clients.
+    workers     each listen on the server port with SO_REUSEPORT, so the
+                kernel spreads new connections across them, read payloads
+                from the ring and queue and write them to their own clients.
+                Messages that only change what a client is sent (format,
+                decimate, subscribe, keyframe) are handled by the worker,
+                everything else is forwarded to the owner.
+
+Each worker talks to the owner over a socket pair, with pickled messages:
+
+    worker to owner:
+        ('keys', INSTRUMENT, KEYS, MAX_RATE, SUBSCRIBERS)
+                            the payload keys and maximum rate the worker's
+                            subscribers of an instrument need
+        ('message', CLIENT, SETTINGS, DATA)
+                            a client message for the owner to handle, with
+                            the client's current settings
+        ('closed', CLIENT)  a client disconnected
+    owner to worker:
+        ('reply', CLIENT, BYTES)
+                            bytes to write to a client
+
+Workers are restarted if they die. While a worker is down, new connections
+go to the others.
+"""
+import cPickle as pickle
+import json
+import mmap
+import os
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from twisted.internet import protocol, reactor, task
+from twisted.protocols import basic
+
+import encoding
+import metrics
+from controls import ControlPanelThread
+from tekscope import Instrument, ScopeDataSender, ScopeProtocol
+from tekscope import history_budget, make_control_panel, make_profiler
+from tekscope import open_scopes
+
+RING_BYTES = 32 * 1024 * 1024
+# Shared memory, where the system has it.
+RING_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+POLL_INTERVAL = 0.005
+LISTEN_BACKLOG = 50
+
+FRAME = 'frame'
+UI = 'ui'
+
+
+class PayloadRing(object):
+    """A single writer ring of variable size records in a shared file.
+
+    Records are written one after the other, each preceded by its length,
+    and a record that would not fit before the end of the ring starts over
+    at the beginning instead. Positions count bytes written since the ring
+    was created, so they only grow: the record at position p is at offset
+    p % capacity.
+
+    The header holds the position after the newest complete record (the
+    head) and the position up to which the writer may be writing (reserved).
+    reserved is moved forward before any byte is overwritten, so a reader
+    knows a record it copied is intact if reserved is still less than a ring
+    past the record's position afterwards.
+
+    write may be called from any thread.
+    """
+    HEADER = struct.Struct('=QQQ')
+    POSITION = struct.Struct('=Q')
+    LENGTH = struct.Struct('=I')
+    HEAD_OFFSET = 8
+    RESERVED_OFFSET = 16
+    DATA_OFFSET = 64
+    # Length of the record that marks the rest of the ring as unused.
+    PAD = 0xffffffff
+
+    def __init__(self, capacity=RING_BYTES):
+        self.capacity = capacity
+        self.position = 0
+        self.lock = threading.Lock()
+        fd, self.path = tempfile.mkstemp(
+                prefix='tekscope-', suffix='.ring', dir=RING_DIR)
+        try:
+            os.ftruncate(fd, PayloadRing.DATA_OFFSET + capacity)
+            self.memory = mmap.mmap(fd, PayloadRing.DATA_OFFSET + capacity)
+        finally:
+            os.close(fd)
+        PayloadRing.HEADER.pack_into(self.memory, 0, capacity, 0, 0)
+
+    def write(self, data):
+        length = PayloadRing.LENGTH.size
+        size = length + len(data)
+        if size > self.capacity:
+            raise ValueError('a %d byte record does not fit the ring' % size)
+        with self.lock:
+            position = self.position
+            offset = position % self.capacity
+            wrap = offset + size > self.capacity
+            if wrap:
+                position += self.capacity - offset
+            PayloadRing.POSITION.pack_into(
+                    self.memory, PayloadRing.RESERVED_OFFSET, position + size)
+            if wrap and self.capacity - offset >= length:
+                PayloadRing.LENGTH.pack_into(
+                        self.memory, PayloadRing.DATA_OFFSET + offset,
+                        PayloadRing.PAD)
+            start = PayloadRing.DATA_OFFSET + position % self.capacity
+            PayloadRing.LENGTH.pack_into(self.memory, start, len(data))
+            self.memory[start + length:start + size] = data
+            self.position = position + size
+            PayloadRing.POSITION.pack_into(
+                    self.memory, PayloadRing.HEAD_OFFSET, self.position)
+
+    def close(self):
+        """Unmaps the ring and removes its file."""
+        self.memory.close()
+        os.remove(self.path)
+
+
+class PayloadRingReader(object):
+    """Reads the records of a PayloadRing written by another process.
+
+    Readers start at the newest record. A reader that falls a whole ring
+    behind skips ahead to the newest record.
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as ring_file:
+            self.memory = mmap.mmap(
+                    ring_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.capacity = PayloadRing.HEADER.unpack_from(self.memory, 0)[0]
+        self.position = self.read_position(PayloadRing.HEAD_OFFSET)
+        self.records_lost = 0
+
+    def read_position(self, offset):
+        return PayloadRing.POSITION.unpack_from(self.memory, offset)[0]
+
+    def read(self):
+        """Returns the records written since the last call, oldest first."""
+        records = []
+        head = self.read_position(PayloadRing.HEAD_OFFSET)
+        length_size = PayloadRing.LENGTH.size
+        while self.position < head:
+            position = self.position
+            offset = position % self.capacity
+            start = PayloadRing.DATA_OFFSET + offset
+            record = None
+            if self.capacity - offset < length_size:
+                next_position = position + self.capacity - offset
+            else:
+                length = PayloadRing.LENGTH.unpack_from(self.memory, start)[0]
+                if length == PayloadRing.PAD:
+                    next_position = position + self.capacity - offset
+                else:
+                    record = self.memory[start + length_size:
+                                         start + length_size + length]
+                    next_position = position + length_size + length
+            reserved = self.read_position(PayloadRing.RESERVED_OFFSET)
+            if reserved > position + self.capacity:
+                # Overwritten while it was read.
+                self.records_lost += 1
+                metrics.count('fanout.records-lost')
+                self.position = self.read_position(PayloadRing.HEAD_OFFSET)
+                head = self.position
+                continue
+            self.position = next_position
+            if record is not None:
+                records.append(record)
+        return records
+
+    def close(self):
+        self.memory.close()
+
+
+class FanoutPublisher(ScopeDataSender):
+    """The data sender of an instrument in the owner.
+
+    Rather than queueing frames to clients, every encoded frame is written to
+    the PayloadRing for the workers, straight from the thread that encoded
+    it, and UI updates are written there too. The payload keys encoded are
+    those the workers report their subscribers need. Workers choose
+    keyframes for delta clients that missed a frame themselves, so delta
+    keys are always encoded along with their keyframes.
+    """
+
+    def __init__(self, ring, instrument_id=0, on_demand=True,
+                 history_budget=0):
+        super(FanoutPublisher, self).__init__(
+                set(), instrument_id, on_demand=on_demand,
+                history_budget=history_budget)
+        self.ring = ring
+        # (keys, max_rate, subscribers) reported by each worker.
+        self.worker_keys = {}
+
+    def set_worker_keys(self, worker, keys, max_rate, subscribers):
+        if subscribers:
+            self.worker_keys[worker] = (keys, max_rate, subscribers)
+        else:
+            self.worker_keys.pop(worker, None)
+        self.update_payload_keys()
+
+    def update_payload_keys(self):
+        reports = self.worker_keys.values()
+        rates = [max_rate for _, max_rate, _ in reports]
+        if not rates or None in rates:
+            self.max_rate = None
+        else:
+            self.max_rate = max(rates)
+        keys = set(key for worker_keys, _, _ in reports
+                   for key in worker_keys)
+        for wire_format, decimation, channels in list(keys):
+            if wire_format == encoding.FORMAT_DELTA:
+                keys.add((encoding.FORMAT_DELTA_KEYFRAME, decimation,
+                          channels))
+        self.payload_keys = frozenset(keys)
+        self.control.set_demand(bool(reports))
+
+    def publish(self, payloads):
+        frame = payloads.frame
+        self.ring.write(pickle.dumps(
+                (FRAME, self.instrument_id, frame.sequence, frame.timestamp,
+                 payloads.reference_sequence, payloads.payloads),
+                pickle.HIGHEST_PROTOCOL))
+        now = time.time()
+        metrics.record('frame.age', now - frame.timestamp)
+        metrics.count('frames.published')
+        self.dispatch_times.append(now)
+
+    def broadcast(self, data):
+        self.ring.write(pickle.dumps(
+                (UI, '%s\n' % json.dumps(data)), pickle.HIGHEST_PROTOCOL))
+
+    def client_stats(self):
+        return [{'worker': worker, 'subscribers': subscribers}
+                for worker, (_, _, subscribers)
+                in sorted(self.worker_keys.items())]
+
+
+class Link(basic.Int32StringReceiver):
+    """One end of the socket pair between the owner and a worker."""
+    MAX_LENGTH = 64 * 1024 * 1024
+
+    def __init__(self, receive, lost):
+        self.receive = receive
+        self.lost = lost
+
+    def send_message(self, *message):
+        self.sendString(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def stringReceived(self, string):
+        try:
+            self.receive(pickle.loads(string))
+        except Exception as e:
+            print 'error handling %r: %s' % (string[:64], e)
+
+    def connectionLost(self, reason):
+        self.lost()
+
+
+class LinkFactory(protocol.Factory):
+    def __init__(self, receive, lost):
+        self.receive = receive
+        self.lost = lost
+        self.link = None
+
+    def buildProtocol(self, addr):
+        self.link = Link(self.receive, self.lost)
+        return self.link
+
+
+def adopt_link(sock, receive, lost):
+    """Hands one end of a socket pair to the reactor. Returns its Link."""
+    factory = LinkFactory(receive, lost)
+    reactor.adoptStreamConnection(sock.fileno(), socket.AF_UNIX, factory)
+    sock.close()
+    return factory.link
+
+
+class ReplyTransport(object):
+    """Sends what the owner writes to a worker's client back to the worker."""
+
+    def __init__(self, link, client_id):
+        self.link = link
+        self.client_id = client_id
+        self.peer = None
+
+    def write(self, data):
+        self.link.send_message('reply', self.client_id, data)
+
+    def getPeer(self):
+        return self.peer
+
+
+class RemoteClient(ScopeProtocol):
+    """The owner's stand-in for a client of a worker.
+
+    Handles the messages the worker forwards as if the client were connected
+    to the owner, with the settings the client has at the worker.
+    """
+
+    def __init__(self, instruments, control_panel, link, client_id,
+                 profiler=None):
+        ScopeProtocol.__init__(self, instruments, control_panel, profiler)
+        self.transport = ReplyTransport(link, client_id)
+
+    def apply_settings(self, settings):
+        self.transport.peer = settings['peer']
+        self.wire_format = settings['format']
+        self.decimation = settings['decimate']
+        self.message_types = frozenset(settings['types'])
+        self.instrument_ids = frozenset(settings['instruments'])
+        self.channels = settings['channels']
+        self.max_rate = settings['max-rate']
+
+
+class FanoutWorker(object):
+    """Runs and supervises a fan-out worker process.
+
+    Workers are separate programs rather than forks, since a fork would share
+    the owner's reactor.
+    """
+    RESTART_DELAY = 1.0
+
+    def __init__(self, index, server_port, ring, instruments, control_panel,
+                 profiler=None):
+        self.index = index
+        self.server_port = server_port
+        self.ring = ring
+        self.instruments = instruments
+        self.control_panel = control_panel
+        self.profiler = profiler
+        self.process = None
+        self.link = None
+        self.clients = {}
+        self.restarts = 0
+        self.died_at = None
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        owner_end, worker_end = socket.socketpair()
+        self.process = subprocess.Popen([
+                sys.executable, os.path.abspath(__file__),
+                str(self.server_port), str(worker_end.fileno()),
+                self.ring.path, str(len(self.instruments))])
+        worker_end.close()
+        self.link = adopt_link(owner_end, self.receive, self.lost)
+
+    def receive(self, message):
+        kind = message[0]
+        if kind == 'keys':
+            _, instrument_id, keys, max_rate, subscribers = message
+            self.instruments[instrument_id].data_sender.set_worker_keys(
+                    self.index, keys, max_rate, subscribers)
+        elif kind == 'message':
+            _, client_id, settings, data = message
+            client = self.clients.get(client_id)
+            if client is None:
+                client = RemoteClient(self.instruments, self.control_panel,
+                                      self.link, client_id, self.profiler)
+                self.clients[client_id] = client
+            client.apply_settings(settings)
+            client.run_command(data)
+        elif kind == 'closed':
+            client = self.clients.pop(message[1], None)
+            if client is not None:
+                client.stop_stats_push()
+        else:
+            print 'unhandled worker message: %s' % kind
+
+    def lost(self):
+        for instrument in self.instruments:
+            instrument.data_sender.set_worker_keys(self.index, None, None, 0)
+        for client in self.clients.values():
+            client.stop_stats_push()
+        self.clients.clear()
+
+    def check(self):
+        """Restarts the worker if it died. Call periodically."""
+        if self.process is None or self.alive:
+            return
+        now = time.time()
+        if self.died_at is None:
+            self.died_at = now
+            print 'fan-out worker %d exited with code %s' % (
+                    self.index, self.process.returncode)
+        if now - self.died_at >= FanoutWorker.RESTART_DELAY:
+            self.died_at = None
+            self.restarts += 1
+            print 'restarting fan-out worker %d (restart %d)' % (
+                    self.index, self.restarts)
+            self.start()
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+
+class PublishedPayloads(object):
+    """The payloads of a frame as read from the ring, in place of
+    encoding.FramePayloads.
+
+    Keys the owner did not encode, because it had not heard of a new
+    subscription yet, are sent as nothing.
+    """
+
+    def __init__(self, frame, reference_sequence, payloads):
+        self.frame = frame
+        self.reference_sequence = reference_sequence
+        self.payloads = payloads
+
+    def get(self, key):
+        return self.payloads.get(key, '')
+
+
+class PublishedFrame(object):
+    def __init__(self, instrument, sequence, timestamp):
+        self.instrument = instrument
+        self.sequence = sequence
+        self.timestamp = timestamp
+
+
+class FanoutSubscriber(object):
+    """Stands in for the ScopeDataSender of an instrument in a worker.
+
+    Frames come from the ring already encoded. Whenever the payload keys or
+    the maximum rate the worker's subscribers need change, they are reported
+    to the owner, which encodes them.
+    """
+
+    def __init__(self, client_list, instrument_id, server):
+        self.client_list = client_list
+        self.instrument_id = instrument_id
+        self.server = server
+        self.last_payloads = None
+        self.reported = None
+
+    def is_subscribed(self, client):
+        return self.instrument_id in client.instrument_ids
+
+    def add_client(self, client):
+        self.client_list.add(client)
+        self.update_payload_keys()
+        if self.last_payloads is not None and self.is_subscribed(client):
+            client.queue_frame(self.last_payloads)
+
+    def remove_client(self, client):
+        self.client_list.discard(client)
+        self.update_payload_keys()
+
+    def update_payload_keys(self):
+        subscribers = [client for client in self.client_list
+                       if self.is_subscribed(client) and client.payload_keys]
+        rates = [client.max_rate for client in subscribers]
+        if not rates or None in rates:
+            max_rate = None
+        else:
+            max_rate = max(rates)
+        keys = frozenset(
+                key for client in subscribers for key in client.payload_keys)
+        report = (keys, max_rate, len(subscribers))
+        if report != self.reported:
+            self.reported = report
+            self.server.link.send_message(
+                    'keys', self.instrument_id, *report)
+
+    def dispatch(self, payloads):
+        self.last_payloads = payloads
+        for client in self.client_list:
+            if self.is_subscribed(client):
+                client.queue_frame(payloads)
+
+
+class FanoutProtocol(ScopeProtocol):
+    """A client of a worker.
+
+    Messages that only change what this client is sent are handled here,
+    the rest are forwarded to the owner.
+    """
+    LOCAL_KEYS = frozenset(['format', 'decimate', 'subscribe', 'keyframe'])
+
+    def __init__(self, server, client_id):
+        ScopeProtocol.__init__(self, server.instruments, None)
+        self.server = server
+        self.client_id = client_id
+
+    def connectionMade(self):
+        self.server.clients[self.client_id] = self
+        ScopeProtocol.connectionMade(self)
+
+    def connectionLost(self, reason):
+        ScopeProtocol.connectionLost(self, reason)
+        del self.server.clients[self.client_id]
+        self.server.link.send_message('closed', self.client_id)
+
+    @property
+    def settings(self):
+        return {
+            'peer': str(self.transport.getPeer()),
+            'format': self.wire_format,
+            'decimate': self.decimation,
+            'types': sorted(self.message_types),
+            'instruments': sorted(self.instrument_ids),
+            'channels': self.channels,
+            'max-rate': self.max_rate,
+        }
+
+    def handle_message(self, data):
+        local = dict((key, value) for key, value in data.items()
+                     if key in FanoutProtocol.LOCAL_KEYS)
+        remote = dict((key, value) for key, value in data.items()
+                      if key not in FanoutProtocol.LOCAL_KEYS)
+        if local:
+            ScopeProtocol.handle_message(self, local)
+        if set(remote) - set(['instrument']):
+            self.server.link.send_message(
+                    'message', self.client_id, self.settings, remote)
+
+
+class FanoutFactory(protocol.Factory):
+    def __init__(self, server):
+        self.server = server
+        self.client_count = 0
+
+    def buildProtocol(self, addr):
+        self.client_count += 1
+        return FanoutProtocol(self.server, self.client_count)
+
+
+class FanoutServer(object):
+    """The clients of a worker and the ring they are fed from."""
+
+    def __init__(self, ring_path, instrument_count):
+        self.ring = PayloadRingReader(ring_path)
+        self.link = None
+        self.client_list = set()
+        self.clients = {}
+        self.instruments = [
+                Instrument(instrument_id, None,
+                           FanoutSubscriber(self.client_list, instrument_id,
+                                            self))
+                for instrument_id in range(instrument_count)]
+
+    def read_ring(self):
+        for record in self.ring.read():
+            self.dispatch(pickle.loads(record))
+
+    def dispatch(self, record):
+        if record[0] == UI:
+            for client in self.client_list:
+                if ScopeProtocol.UI_PARAMS in client.message_types:
+                    client.transport.write(record[1])
+            return
+        (_, instrument_id, sequence, timestamp, reference_sequence,
+         payloads) = record
+        frame = PublishedFrame(instrument_id, sequence, timestamp)
+        self.instruments[instrument_id].data_sender.dispatch(
+                PublishedPayloads(frame, reference_sequence, payloads))
+
+    def receive(self, message):
+        kind = message[0]
+        if kind == 'reply':
+            _, client_id, data = message
+            client = self.clients.get(client_id)
+            if client is not None:
+                client.transport.write(data)
+        else:
+            print 'unhandled owner message: %s' % kind
+
+    def lost(self):
+        print 'lost the server, stopping'
+        if reactor.running:
+            reactor.stop()
+
+
+def listen_shared(server_port, factory):
+    """Listens on a port that other processes listen on too."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind(('', server_port))
+    sock.listen(LISTEN_BACKLOG)
+    sock.setblocking(False)
+    reactor.adoptStreamPort(sock.fileno(), socket.AF_INET, factory)
+    sock.close()
+
+
+def run_fanout_worker(server_port, link_fd, ring_path, instrument_count):
+    """Entry point of a worker process."""
+    # SIGINT goes to the whole process group; the owner decides when the
+    # worker should stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    server = FanoutServer(ring_path, instrument_count)
+    link_socket = socket.fromfd(link_fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    os.close(link_fd)
+    server.link = adopt_link(link_socket, server.receive, server.lost)
+    listen_shared(server_port, FanoutFactory(server))
+    task.LoopingCall(server.read_ring).start(POLL_INTERVAL)
+    reactor.run()
+
+
+def run_with_fanout_workers(args):
+    """Acquires from every scope on its own thread and serves clients from
+    args.fanout_workers worker processes.
+    """
+    ring = PayloadRing()
+
+    def make_data_sender(instrument_id, on_demand):
+        return FanoutPublisher(ring, instrument_id, on_demand=on_demand,
+                               history_budget=history_budget(args))
+
+    instruments, scope_read_threads, frame_sinks = open_scopes(
+            args, make_data_sender)
+    control_panel = make_control_panel(args.controls_port, instruments)
+    control_panel_thread = ControlPanelThread(control_panel)
+    profiler = make_profiler(args)
+    workers = [FanoutWorker(index, args.server_port, ring, instruments,
+                            control_panel, profiler)
+               for index in range(args.fanout_workers)]
+
+    def stop_server_and_exit(signum, frame):
+        print '\rStopping server'
+        for worker in workers:
+            worker.stop()
+        for scope_read_thread in scope_read_threads:
+            scope_read_thread.stop()
+        control_panel_thread.stop()
+        print 'Joining control panel thread...'
+        control_panel_thread.join()
+        print 'Joining scope read threads... ',
+        print 'If this takes too long, kill with ^\\'
+        for scope_read_thread in scope_read_threads:
+            scope_read_thread.join()
+        for frame_sink in frame_sinks:
+            frame_sink.close()
+        ring.close()
+        reactor.stop()
+
+    def check_workers():
+        for worker in workers:
+            worker.check()
+
+    def status_message(msg):
+        print msg
+
+    signal.signal(signal.SIGINT, stop_server_and_exit)
+    for scope_read_thread in scope_read_threads:
+        scope_read_thread.start()
+    control_panel_thread.start()
+    for worker in workers:
+        worker.start()
+    task.LoopingCall(check_workers).start(0.5)
+    reactor.callWhenRunning(
+            status_message,
+            'Server started on port %d with %d instrument(s) and %d '
+            'fan-out worker(s)' % (args.server_port, len(instruments),
+                                   len(workers)))
+    reactor.run()
+
+
+if __name__ == '__main__':
+    run_fanout_worker(int(sys.argv[1]), int(sys.argv[2]), sys.argv[3],
+                      int(sys.argv[4]))
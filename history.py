@@ -0,0 +1,252 @@
+"""The most recent captures of an instrument, kept in memory for looking back.
+
+Captures are stored as acquired, before acquisition modes, in a ring of
+preallocated slots sized from a memory budget. Each slot holds the 10-bit
+codes of both channels along with the capture's sequence number, timestamp,
+end address and settings.
+
+Clients query the history with
+
+    {"history": {"from": SEQ, "to": SEQ}}       sequence numbers, inclusive
+    {"history": {"since": T, "until": T}}       capture times, inclusive
+
+Either end of a range may be left out. A query may also ask for a window of
+samples with "start" and "end" (sample indices, end exclusive), and for the
+window to be decimated with "decimate": {"mode": MODE, "points": N} as in the
+live stream.
+
+A query returns up to MAX_QUERY_FRAMES captures: the oldest in the range if
+it has a start, the newest otherwise. The reply comes in pages of up to
+PAGE_FRAMES frames, each a JSON line
+
+    {"history": {"instrument": ID, "count": N, "first": SEQ, "last": SEQ,
+                 "done": BOOL}}
+
+followed by the N frames, oldest first, in the client's wire format (delta
+clients get binary frames, since history frames have no reference). Pages are
+only sent while the client keeps up, and live frames may come between them.
+The last page is marked done. If the range held more captures than were
+returned, the last page also has "more": {"from": SEQ} or {"to": SEQ}, to be
+merged into the query to get the rest. Frames cut to a window carry sample
+indices, like decimated frames.
+
+With numpy, frames handed out by the history reference its slots, so the
+only copies made are the encoded bytes that are sent. A slot may be reused
+while it is being encoded; such frames are left out, which the reader can
+tell with holds.
+"""
+import array
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scope import Frame, SAMPLE_COUNT
+
+# Bytes of codes per slot; the other fields are small in comparison.
+SLOT_BYTES = 2 * SAMPLE_COUNT * 2
+MAX_QUERY_FRAMES = 256
+PAGE_FRAMES = 16
+
+
+class FrameHistory(object):
+    """A fixed capacity ring of the latest captures.
+
+    append is called by the one thread that encodes frames, queries may come
+    from any other thread.
+    """
+
+    def __init__(self, memory_budget):
+        self.capacity = max(int(memory_budget // SLOT_BYTES), 1)
+        # Captures appended so far. The newest is at position count - 1, in
+        # slot (count - 1) % capacity.
+        self.count = 0
+        self.lock = threading.Lock()
+        self.settings = [None] * self.capacity
+        self.end_addrs = [0] * self.capacity
+        if numpy is not None:
+            self.codes = numpy.zeros(
+                    (self.capacity, 2, SAMPLE_COUNT), dtype=numpy.int16)
+            self.sequences = numpy.zeros(self.capacity, dtype=numpy.int64)
+            self.timestamps = numpy.zeros(self.capacity)
+        else:
+            self.codes = array.array('h', [0]) * (
+                    self.capacity * 2 * SAMPLE_COUNT)
+            self.sequences = [0] * self.capacity
+            self.timestamps = [0.0] * self.capacity
+
+    @property
+    def stats(self):
+        count = self.count
+        oldest = max(count - self.capacity, 0)
+        stats = {
+            'capacity': self.capacity,
+            'frames': count - oldest,
+            'bytes': self.capacity * SLOT_BYTES,
+        }
+        if count:
+            stats['first'] = int(self.sequences[oldest % self.capacity])
+            stats['last'] = int(self.sequences[(count - 1) % self.capacity])
+        return stats
+
+    def append(self, frame):
+        slot = self.count % self.capacity
+        # Invalidate the slot first, so a reader of the frame it held
+        # notices it changed.
+        self.sequences[slot] = 0
+        a_codes, b_codes = frame.codes
+        if numpy is not None:
+            self.codes[slot, 0] = a_codes
+            self.codes[slot, 1] = b_codes
+        else:
+            offset = slot * 2 * SAMPLE_COUNT
+            self.codes[offset:offset + SAMPLE_COUNT] = array.array(
+                    'h', a_codes)
+            self.codes[offset + SAMPLE_COUNT:offset + 2 * SAMPLE_COUNT] = (
+                    array.array('h', b_codes))
+        self.settings[slot] = frame.settings
+        self.end_addrs[slot] = frame.end_addr
+        self.timestamps[slot] = frame.timestamp
+        self.sequences[slot] = frame.sequence
+        with self.lock:
+            self.count += 1
+
+    def bisect(self, key, value, low, high, after=False):
+        """Returns the first position in [low, high) whose key is at least
+        value (greater than value if after is set), or high.
+        """
+        capacity = self.capacity
+        while low < high:
+            middle = (low + high) // 2
+            k = key[middle % capacity]
+            if k < value or (after and k == value):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def positions(self, first=None, last=None, since=None, until=None):
+        """Returns the range of positions of the captures in a sequence
+        number or time range.
+        """
+        with self.lock:
+            high = self.count
+        # Leave out the oldest slot, which may be being rewritten.
+        low = max(high - self.capacity + 1, 0)
+        if first is not None:
+            low = self.bisect(self.sequences, first, low, high)
+        if last is not None:
+            high = self.bisect(self.sequences, last, low, high, after=True)
+        if since is not None:
+            low = self.bisect(self.timestamps, since, low, high)
+        if until is not None:
+            high = self.bisect(self.timestamps, until, low, high, after=True)
+        return low, high
+
+    def frame(self, position, start=0, end=SAMPLE_COUNT):
+        """Returns the capture at a position, cut to samples [start, end).
+
+        The frame references the history's memory when numpy is available.
+        """
+        slot = position % self.capacity
+        if numpy is not None:
+            codes = (self.codes[slot, 0, start:end],
+                     self.codes[slot, 1, start:end])
+        else:
+            offset = slot * 2 * SAMPLE_COUNT
+            codes = (self.codes[offset + start:offset + end].tolist(),
+                     self.codes[offset + SAMPLE_COUNT + start:
+                                offset + SAMPLE_COUNT + end].tolist())
+        frame = Frame(int(self.sequences[slot]), float(self.timestamps[slot]),
+                      self.settings[slot], self.end_addrs[slot], None,
+                      codes=codes)
+        if (start, end) != (0, SAMPLE_COUNT):
+            if numpy is not None:
+                indices = numpy.arange(start, end)
+            else:
+                indices = range(start, end)
+            frame.indices = (indices, indices)
+        return frame
+
+    def holds(self, position):
+        """Returns whether the capture at a position is still in the
+        history, and not in the oldest slot, which may be being rewritten.
+        """
+        with self.lock:
+            return self.count - self.capacity < position < self.count
+
+    def select(self, first=None, last=None, since=None, until=None,
+               limit=MAX_QUERY_FRAMES):
+        """Returns the positions of up to limit captures in a range, and
+        the range of the others, if any.
+
+        The captures are the oldest in the range if it has a start, and the
+        newest otherwise. The range of the others is {"from": SEQ} or
+        {"to": SEQ}, to narrow the query to, or None.
+        """
+        low, high = self.positions(first, last, since, until)
+        more = None
+        if high - low > limit:
+            if first is None and since is None:
+                low = high - limit
+                more = {'to': int(self.sequences[low % self.capacity]) - 1}
+            else:
+                high = low + limit
+                more = {'from': int(self.sequences[high % self.capacity])}
+        return range(low, high), more
+
+
+class HistoryReply(object):
+    """A reply to a history query, made a page at a time.
+
+    Frames are only read and encoded, with encode, when their page is, so a
+    reply waiting for a slow client holds no encoded frames. Captures that
+    left the history in the meantime are left out of their page.
+    """
+
+    def __init__(self, history, instrument_id, positions, more, start, end,
+                 encode):
+        self.history = history
+        self.instrument_id = instrument_id
+        self.positions = positions
+        self.more = more
+        self.start = start
+        self.end = end
+        self.encode = encode
+        self.next = 0
+
+    @property
+    def done(self):
+        return self.next >= len(self.positions)
+
+    def next_page(self):
+        """Returns the header and frame payloads of the next page."""
+        positions = self.positions[self.next:self.next + PAGE_FRAMES]
+        self.next += len(positions)
+        sequences = []
+        payloads = []
+        for position in positions:
+            if not self.history.holds(position):
+                continue
+            frame = self.history.frame(position, self.start, self.end)
+            frame.instrument = self.instrument_id
+            payload = self.encode(frame)
+            # Still held once encoded, so the slot was not rewritten while
+            # the frame referenced it.
+            if self.history.holds(position):
+                sequences.append(frame.sequence)
+                payloads.append(payload)
+
+        header = {
+            'instrument': self.instrument_id,
+            'count': len(payloads),
+            'done': self.done,
+        }
+        if sequences:
+            header['first'] = sequences[0]
+            header['last'] = sequences[-1]
+        if self.done and self.more is not None:
+            header['more'] = self.more
+        return {'history': header}, payloads
@@ -0,0 +1,198 @@
+"""Waveform measurements computed on the server, once per frame.
+
+Each channel of a frame is measured with:
+
+    vpp         peak to peak voltage
+    min, max    extremes, in volts
+    mean        average voltage
+    rms         root mean square voltage
+    frequency   in Hz, from the spacing of rising edges
+    period      in seconds
+    duty        fraction of each period spent high
+    rise-time   mean 10% to 90% time of the rising edges, in seconds
+    fall-time   mean 90% to 10% time of the falling edges, in seconds
+
+Edges are found with hysteresis between the 10% and 90% levels of the
+capture, so noise riding on a level does not count as an edge. Timing
+measurements that need edges the capture does not contain (a DC signal, or
+less than a full period) are None.
+"""
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scope import Scope
+
+LOW_LEVEL = 0.1
+HIGH_LEVEL = 0.9
+# Signals smaller than this many volts peak to peak are treated as DC.
+MIN_SWING = 0.02
+TIMING_KEYS = ('frequency', 'period', 'duty', 'rise-time', 'fall-time')
+
+
+def crossing(volts, index, level):
+    """Returns the fractional sample index at which the signal crosses level
+    between samples index and index + 1.
+    """
+    v0 = volts[index]
+    v1 = volts[index + 1]
+    if v1 == v0:
+        return float(index)
+    return index + (level - v0) / (v1 - v0)
+
+
+def edge_times(volts, edges, lasts, start_level, end_level, sample_period):
+    """Returns the mean time the edges take to go from start_level to
+    end_level.
+
+    lasts[i] is the last sample at the start level before edges[i], the first
+    sample at the end level.
+    """
+    if not len(edges):
+        return None
+    total = 0.0
+    for edge, last in zip(edges, lasts):
+        start = crossing(volts, last, start_level)
+        end = crossing(volts, edge - 1, end_level)
+        total += max(end - start, 0.0)
+    return total / len(edges) * sample_period
+
+
+def timing(states, rising, sample_rate):
+    """Returns frequency, period and duty from the edges of a capture."""
+    if len(rising) < 2:
+        return None, None, None
+    first = rising[0]
+    last = rising[-1]
+    period = float(last - first) / (len(rising) - 1) / sample_rate
+    if numpy is not None:
+        high = numpy.count_nonzero(states[first:last])
+    else:
+        high = sum(states[first:last])
+    duty = float(high) / (last - first)
+    return 1.0 / period, period, duty
+
+
+def measure_channel_arrays(volts, sample_rate):
+    low = float(volts.min())
+    high = float(volts.max())
+    result = {
+        'vpp': high - low,
+        'min': low,
+        'max': high,
+        'mean': float(volts.mean()),
+        'rms': math.sqrt(float(numpy.dot(volts, volts)) / len(volts)),
+    }
+    result.update(dict.fromkeys(TIMING_KEYS))
+    if high - low < MIN_SWING:
+        return result
+
+    low_level = low + LOW_LEVEL * (high - low)
+    high_level = low + HIGH_LEVEL * (high - low)
+    # Samples at either level set the state, samples between the levels keep
+    # the state of the last sample that set it.
+    marks = numpy.where(volts >= high_level, 1,
+                        numpy.where(volts <= low_level, 0, -1))
+    positions = numpy.arange(len(volts))
+    setters = numpy.maximum.accumulate(
+            numpy.where(marks >= 0, positions, 0))
+    states = marks[setters]
+    first_setter = numpy.argmax(marks >= 0)
+    states[:first_setter] = marks[first_setter]
+    changes = numpy.flatnonzero(numpy.diff(states)) + 1
+    rising = changes[states[changes] == 1]
+    falling = changes[states[changes] == 0]
+    lasts = setters[changes - 1]
+
+    sample_period = 1.0 / sample_rate
+    volts_list = volts.tolist()
+    result['rise-time'] = edge_times(
+            volts_list, rising.tolist(),
+            lasts[states[changes] == 1].tolist(), low_level, high_level,
+            sample_period)
+    result['fall-time'] = edge_times(
+            volts_list, falling.tolist(),
+            lasts[states[changes] == 0].tolist(), high_level, low_level,
+            sample_period)
+    (result['frequency'], result['period'],
+     result['duty']) = timing(states, rising, sample_rate)
+    return result
+
+
+def measure_channel_python(volts, sample_rate):
+    low = min(volts)
+    high = max(volts)
+    count = len(volts)
+    result = {
+        'vpp': high - low,
+        'min': low,
+        'max': high,
+        'mean': sum(volts) / count,
+        'rms': math.sqrt(sum(v * v for v in volts) / count),
+    }
+    result.update(dict.fromkeys(TIMING_KEYS))
+    if high - low < MIN_SWING:
+        return result
+
+    low_level = low + LOW_LEVEL * (high - low)
+    high_level = low + HIGH_LEVEL * (high - low)
+    states = []
+    rising = []
+    falling = []
+    rising_lasts = []
+    falling_lasts = []
+    state = None
+    setter = None
+    for i, v in enumerate(volts):
+        if v >= high_level:
+            mark = 1
+        elif v <= low_level:
+            mark = 0
+        else:
+            mark = None
+        if mark is not None:
+            if state is not None and mark != state:
+                if mark:
+                    rising.append(i)
+                    rising_lasts.append(setter)
+                else:
+                    falling.append(i)
+                    falling_lasts.append(setter)
+            state = mark
+            setter = i
+        states.append(state)
+    first_state = next(s for s in states if s is not None)
+    states = [first_state if s is None else s for s in states]
+
+    sample_period = 1.0 / sample_rate
+    result['rise-time'] = edge_times(
+            volts, rising, rising_lasts, low_level, high_level,
+            sample_period)
+    result['fall-time'] = edge_times(
+            volts, falling, falling_lasts, high_level, low_level,
+            sample_period)
+    (result['frequency'], result['period'],
+     result['duty']) = timing(states, rising, sample_rate)
+    return result
+
+
+def measure_frame(frame, channels=(Scope.CHANNEL_A, Scope.CHANNEL_B)):
+    """Returns the measurements of the given channels of a frame.
+
+    Frames derived from a capture, like envelopes, are measured by their
+    capture.
+    """
+    if frame.source is not None:
+        frame = frame.source
+    sample_rate = frame.settings.sample_rate
+    if numpy is not None:
+        sample = frame.sample_arrays
+        measure = measure_channel_arrays
+    else:
+        sample = frame.samples
+        measure = measure_channel_python
+    return dict((channel, measure(sample[channel], sample_rate))
+                for channel in channels)
@@ -0,0 +1,173 @@
+"""Always-on timing and counters for the acquisition to client pipeline.
+
+Each stage of a frame's trip records how long it took into a rolling latency
+histogram, and notable events bump counters:
+
+    scope.trigger-wait      S G until the scope reports the capture is done
+    scope.transfer          S B until the 4 KB memory has been read
+    frame.decode            raw memory to 10-bit codes
+    encode.FORMAT           one encoding of a frame in a wire format
+    sender.encode           every encoding a frame needs, end to end
+    sender.dispatch-wait    waiting for the reactor to pick a frame up
+    frame.age               capture to hand-off to the clients
+    client.write            writing one frame to a client transport
+
+Histograms bucket values HDR-style: exact below 64 microseconds and within
+about 3% above, so recording is a couple of integer operations and a dict
+increment. They cover the last WINDOW_COUNT windows of WINDOW seconds.
+
+Clients ask for everything with {"stats": true}. {"stats": {"interval": N}}
+also pushes a report every N seconds, and {"stats": {"interval": 0}} stops the
+pushes.
+"""
+import collections
+import threading
+import time
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+WINDOW = 10.0
+WINDOW_COUNT = 6
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def bucket_index(value):
+    """Returns the bucket of a non-negative integer value."""
+    shift = max(value.bit_length() - SUB_BUCKET_BITS - 1, 0)
+    return shift * SUB_BUCKET_COUNT + (value >> shift)
+
+
+def bucket_value(index):
+    """Returns the midpoint of the values that fall into a bucket."""
+    if index < 2 * SUB_BUCKET_COUNT:
+        return index
+    shift = index // SUB_BUCKET_COUNT - 1
+    low = (index - shift * SUB_BUCKET_COUNT) << shift
+    return low + ((1 << shift) - 1) / 2.0
+
+
+class Histogram(object):
+    """Counts of integer values by bucket."""
+
+    def __init__(self):
+        self.buckets = collections.defaultdict(int)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        self.buckets[bucket_index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for index, count in other.buckets.items():
+            self.buckets[index] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or
+                                      other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or
+                                      other.max > self.max):
+            self.max = other.max
+
+    def percentiles(self, percentiles):
+        """Returns the value at each percentile, in ascending order."""
+        values = []
+        targets = iter(sorted(percentiles))
+        target = next(targets, None)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            while target is not None and 100.0 * seen >= target * self.count:
+                value = bucket_value(index)
+                values.append(min(max(value, self.min), self.max))
+                target = next(targets, None)
+            if target is None:
+                break
+        return values
+
+
+class RollingHistogram(object):
+    """A Histogram of the last window_count windows of window seconds.
+
+    Values are durations, kept in whole microseconds and reported in
+    milliseconds.
+    """
+
+    def __init__(self, window=WINDOW, window_count=WINDOW_COUNT):
+        self.window = window
+        self.window_count = window_count
+        # (end time, Histogram) pairs, oldest first.
+        self.windows = collections.deque(maxlen=window_count)
+        self.total_count = 0
+
+    def record(self, seconds, now):
+        if not self.windows or now >= self.windows[-1][0]:
+            self.windows.append((now + self.window, Histogram()))
+        self.windows[-1][1].record(max(int(seconds * 1e6), 0))
+        self.total_count += 1
+
+    def report(self, now):
+        histogram = Histogram()
+        oldest = now - self.window * self.window_count
+        for end, window in self.windows:
+            if end > oldest:
+                histogram.merge(window)
+        report = {'count': histogram.count, 'total-count': self.total_count}
+        if histogram.count:
+            report['mean'] = histogram.total / 1000.0 / histogram.count
+            report['min'] = histogram.min / 1000.0
+            report['max'] = histogram.max / 1000.0
+            for percentile, value in zip(
+                    PERCENTILES, histogram.percentiles(PERCENTILES)):
+                report['p%g' % percentile] = value / 1000.0
+        return report
+
+
+class Registry(object):
+    """Named latency histograms and counters, safe to use from any thread."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.counters = collections.defaultdict(int)
+        self.started = time.time()
+
+    def record(self, name, seconds):
+        now = time.time()
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = RollingHistogram()
+                self.histograms[name] = histogram
+            histogram.record(seconds, now)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def report(self):
+        now = time.time()
+        with self.lock:
+            return {
+                'uptime': now - self.started,
+                'counters': dict(self.counters),
+                'latency-ms': dict(
+                        (name, histogram.report(now))
+                        for name, histogram in self.histograms.items()),
+            }
+
+
+registry = Registry()
+record = registry.record
+count = registry.count
+report = registry.report
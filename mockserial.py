@@ -1,30 +1,164 @@
+"""A stand-in for the scope's serial port, for development and benchmarking.
+
+The mock answers the same commands as the scope firmware, generates
+configurable waveforms on both channels and models how long things take on
+the real hardware: every byte costs 10 bit times at the configured baud rate,
+and a capture takes 1024 sample periods plus the wait for the trigger. The
+trigger fires at the first sample where the signal on the trigger channel
+crosses the trigger level on the configured edge, so the wait depends on the
+waveform, the level and the sample rate divisor. A trigger that does not
+fire within TRIGGER_TIMEOUT_CYCLES cycles of the signal fires anyway, as if
+auto-triggered. All randomness comes from a seeded generator, so runs are
+reproducible.
+
+With realtime=False the mock keeps a virtual clock instead of sleeping, which
+lets tests run as fast as the host allows while still reporting (in
+elapsed()) how long the exchange would have taken on the wire.
+
+Use it in place of a real port with Scope(None, com=mockserial.Serial()).
+"""
+import collections
+import math
 import random
 import re
 import time
 
-PARITY_NONE = None
+PARITY_NONE = 'N'
 STOPBITS_ONE = 1
 EIGHTBITS = 8
 
+SAMPLE_COUNT = 1024
+BASE_SAMPLE_RATE = 20000000.0
+BITS_PER_BYTE = 10  # start bit, 8 data bits, stop bit
+
+STEP_SIZE_HIGH = 0.0521
+STEP_SIZE_LOW = 0.00592
+# Volts per step of the trigger level, as Scope.set_trigger_level sets it.
+TRIGGER_STEP_SIZE = 0.52421484375
+# The trigger search samples each cycle of the signal at this many points
+# before narrowing down to the sample the edge is at.
+TRIGGER_SEARCH_STEPS = 32
+TRIGGER_TIMEOUT_CYCLES = 16
+
+
 def low_byte(short):
     return short & 0xff
 
+
 def high_byte(short):
     return low_byte(short >> 8)
 
+
+class Waveform(object):
+    """A signal on one channel.
+
+    shape is one of 'sine', 'square', 'noise' or 'burst'. A burst is burst
+    cycles of sine followed by silence, repeating every burst_period cycles.
+    Gaussian noise with a standard deviation of noise volts is added to every
+    shape.
+    """
+    SHAPES = ('sine', 'square', 'noise', 'burst')
+
+    def __init__(self, shape='sine', frequency=1000.0, amplitude=1.0,
+                 offset=0.0, noise=0.0, duty=0.5, burst=3, burst_period=10):
+        if shape not in Waveform.SHAPES:
+            raise ValueError('Unknown waveform shape %s' % shape)
+        self.shape = shape
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.offset = offset
+        self.noise = noise
+        self.duty = duty
+        self.burst = burst
+        self.burst_period = burst_period
+
+    def voltage(self, t, rng):
+        cycles = t * self.frequency
+        phase = cycles - math.floor(cycles)
+        if self.shape == 'sine':
+            v = self.amplitude * math.sin(2 * math.pi * phase)
+        elif self.shape == 'square':
+            v = self.amplitude if phase < self.duty else -self.amplitude
+        elif self.shape == 'burst':
+            if math.floor(cycles) % self.burst_period < self.burst:
+                v = self.amplitude * math.sin(2 * math.pi * phase)
+            else:
+                v = 0.0
+        else:
+            v = rng.gauss(0.0, self.amplitude)
+        if self.noise:
+            v += rng.gauss(0.0, self.noise)
+        return self.offset + v
+
+
+class Faults(object):
+    """Fault injection knobs. Each rate is a probability per response.
+
+    drop        one byte of the response is lost
+    corrupt     one byte of the response is flipped
+    junk        a stray byte is sent before the response
+    stall       the response is delayed by stall_time seconds
+    hang        the scope never answers an S G
+    """
+
+    def __init__(self, drop=0.0, corrupt=0.0, junk=0.0, stall=0.0,
+                 stall_time=0.5, hang=0.0):
+        self.drop = drop
+        self.corrupt = corrupt
+        self.junk = junk
+        self.stall = stall
+        self.stall_time = stall_time
+        self.hang = hang
+
+
 class Serial(object):
+    COMMAND_PATTERNS = (
+        ('rate', re.compile(r'^S R (\d+)$')),
+        ('trigger', re.compile(r'^S T (\d+) (\d+)$')),
+        ('preamp', re.compile(r'^S P ([AaBb])$')),
+        ('sample', re.compile(r'^S G$')),
+        ('read_mem', re.compile(r'^S B$')),
+    )
+
     def __init__(self,
-            port,
-            baudrate,
-            parity,
-            stopbits,
-            bytesize,
-            timeout,
-            rtscts):
+            port=None,
+            baudrate=230400,
+            parity=PARITY_NONE,
+            stopbits=STOPBITS_ONE,
+            bytesize=EIGHTBITS,
+            timeout=None,
+            rtscts=False,
+            seed=0,
+            realtime=True,
+            channels=None,
+            faults=None):
         self.timeout = timeout
-        self.sample_period = 1.0 / 20000000.0
-        self.out_buf = []
-        self.mem_buf = []
+        self.byte_time = float(BITS_PER_BYTE) / baudrate
+        self.rng = random.Random(seed)
+        self.realtime = realtime
+        self.start_time = time.time()
+        self.virtual_time = 0.0
+        self.channels = channels or {
+            'A': Waveform('sine', frequency=1000.0, amplitude=5.0),
+            'B': Waveform('square', frequency=250.0, amplitude=2.0),
+        }
+        self.faults = faults or Faults()
+
+        self.sample_period = 1.0 / BASE_SAMPLE_RATE
+        self.step_sizes = {'A': STEP_SIZE_HIGH, 'B': STEP_SIZE_HIGH}
+        self.trigger_code = 511
+        self.trigger_channel = 'A'
+        self.trigger_rising = True
+        self.line_free_at = 0.0
+
+        self.in_buf = bytearray()
+        self.out_buf = bytearray()
+        self.out_pos = 0
+        # (first stream offset, end offset, time the first byte is sent)
+        self.segments = collections.deque()
+        self.out_end = 0
+        self.mem_buf = bytearray(4 * SAMPLE_COUNT)
+        self.end_addr = 0
 
     def open(self):
         pass
@@ -32,59 +166,254 @@ class Serial(object):
     def close(self):
         pass
 
-    def read(self, size=1):
-        if len(self.out_buf) < size:
-            raise RuntimeError('Buffer underflow')
-        
-        data = self.out_buf[:size]
-        self.out_buf = self.out_buf[size:]
+    def now(self):
+        if self.realtime:
+            return time.time() - self.start_time
+        return self.virtual_time
+
+    def elapsed(self):
+        """Seconds the exchange so far would have taken on the hardware."""
+        return self.now()
+
+    def wait_until(self, t):
+        if self.realtime:
+            delay = t - self.now()
+            if delay > 0:
+                time.sleep(delay)
+        else:
+            self.virtual_time = max(self.virtual_time, t)
+
+    @property
+    def read_offset(self):
+        """Stream offset of the next byte to be read."""
+        return self.out_end - (len(self.out_buf) - self.out_pos)
+
+    def send(self, data, ready_time):
+        """Queues a response that the device has ready at ready_time.
+
+        The response goes out once the line is free, one byte time per byte.
+        """
+        start = max(ready_time, self.line_free_at)
+        first = self.out_end
+        self.out_buf.extend(data)
+        self.out_end += len(data)
+        self.segments.append((first, self.out_end, start))
+        self.line_free_at = start + len(data) * self.byte_time
+
+    def arrival_time(self, offset):
+        """Returns when the byte at a stream offset has fully arrived."""
+        for first, end, start in self.segments:
+            if first <= offset < end:
+                return start + (offset - first + 1) * self.byte_time
+        raise RuntimeError('Buffer underflow')
+
+    def arrived_by(self, t):
+        """Returns how many unread bytes have fully arrived by time t."""
+        offset = self.read_offset
+        arrived = offset
+        for first, end, start in self.segments:
+            if end <= offset:
+                continue
+            sent = int((t - start) / self.byte_time)
+            arrived = min(end, first + max(sent, 0))
+            if arrived < end:
+                break
+        return max(arrived - offset, 0)
+
+    def inWaiting(self):
+        return self.arrived_by(self.now())
+
+    @property
+    def in_waiting(self):
+        return self.inWaiting()
+
+    def take(self, size):
+        """Removes up to size bytes from the output buffer.
+
+        Waits for them to arrive according to the timing model. With a
+        timeout, returns whatever arrived before it expired. Without one,
+        asking for bytes the device will never send is an error rather than
+        a hang.
+        """
+        if self.timeout is None:
+            if len(self.out_buf) - self.out_pos < size:
+                raise RuntimeError('Buffer underflow')
+            self.wait_until(self.arrival_time(self.read_offset + size - 1))
+        else:
+            deadline = self.now() + self.timeout
+            arrived = self.arrived_by(deadline)
+            if arrived >= size:
+                self.wait_until(
+                        self.arrival_time(self.read_offset + size - 1))
+            else:
+                self.wait_until(deadline)
+                size = arrived
+        if size <= 0:
+            return bytearray()
+
+        data = self.out_buf[self.out_pos:self.out_pos + size]
+        self.out_pos += size
+        offset = self.read_offset
+        while self.segments and self.segments[0][1] <= offset:
+            self.segments.popleft()
+        # Compact occasionally so reads stay linear in the bytes read.
+        if self.out_pos > 65536 and self.out_pos * 2 > len(self.out_buf):
+            del self.out_buf[:self.out_pos]
+            self.out_pos = 0
         return data
 
+    def read(self, size=1):
+        return str(self.take(size))
+
+    def readinto(self, buf):
+        data = self.take(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
     def write(self, data):
-        rate_cmd = re.search('^S R (.)\r\n$', data)
-        preamp_cmd = re.search('^S P ([AB])\r\n$', data)
-        sample_cmd = re.search('^S G\r\n$', data)
-        read_mem_cmd = re.search('^S B\r\n$', data)
-        if rate_cmd:
-            n = ord(rate_cmd.group(1))
-            if n & ~(0xf):
-                raise RuntimeError('Invalid divisor %d' % n)
-            rate = 20000000.0 / (2 ** n)
-            self.sample_period = 1 / rate
-        elif preamp_cmd:
-            pass
-        elif sample_cmd:
-            self.begin_sample()
-        elif read_mem_cmd:
-            self.put_mem_buf()
+        self.in_buf.extend(data)
+        ready_time = self.now() + len(data) * self.byte_time
+        while True:
+            end = self.in_buf.find('\r\n')
+            if end < 0:
+                break
+            command = str(self.in_buf[:end])
+            del self.in_buf[:end + 2]
+            self.handle_command(command, ready_time)
+        return len(data)
+
+    def handle_command(self, command, ready_time):
+        for name, pattern in Serial.COMMAND_PATTERNS:
+            match = pattern.match(command)
+            if match:
+                getattr(self, 'handle_%s' % name)(ready_time, *match.groups())
+                return
+        raise NotImplementedError('Unknown command %r' % command)
+
+    def handle_rate(self, ready_time, register):
+        register = int(register)
+        n = register & 0xf
+        self.sample_period = (2 ** n) / BASE_SAMPLE_RATE
+        if register & (1 << 6):
+            self.trigger_channel = 'EXT'
+        elif register & (1 << 4):
+            self.trigger_channel = 'B'
         else:
-            raise NotImplementedError()
-
-    def begin_sample(self):
-        min_samples = 1
-        max_samples = 1024
-        num_samples = random.randrange(min_samples, max_samples + 1)
-        self.mem_buf = []
-
-        for _ in range(num_samples):
-            sample_a = self.random_sample()
-            sample_b = self.random_sample()
-
-            self.mem_buf.append(high_byte(sample_a))
-            self.mem_buf.append(low_byte(sample_a))
-            self.mem_buf.append(high_byte(sample_b))
-            self.mem_buf.append(low_byte(sample_b))
-
-        end_addr = num_samples * 4
-        self.out_buf.append('A')
-        self.out_buf.append(high_byte(end_addr))
-        self.out_buf.append(low_byte(end_addr))
-
-    def put_mem_buf(self):
-        self.out_buf.append('D')
-        self.out_buf.extend(self.mem_buf)
-        self.out_buf.extend([0] * (4096 - len(self.mem_buf)))
-
-    def random_sample(self):
-        time.sleep(self.sample_period)
-        return random.randrange(0, 0x03ff + 1)
+            self.trigger_channel = 'A'
+        self.trigger_rising = bool(register & (1 << 5))
+
+    def handle_trigger(self, ready_time, high, low):
+        self.trigger_code = (int(high) << 8) | int(low)
+
+    def handle_preamp(self, ready_time, channel):
+        step_size = STEP_SIZE_HIGH if channel.isupper() else STEP_SIZE_LOW
+        self.step_sizes[channel.upper()] = step_size
+
+    def handle_sample(self, ready_time):
+        faults = self.faults
+        if self.rng.random() < faults.hang:
+            return
+
+        # The signals run on the device clock. Once armed, the scope waits
+        # for the trigger, then fills its memory.
+        trigger_time = self.find_trigger(ready_time)
+        self.capture(trigger_time)
+
+        ready_time = trigger_time + SAMPLE_COUNT * self.sample_period
+        if self.rng.random() < faults.stall:
+            ready_time += faults.stall_time
+        self.respond(bytearray([ord('A'), high_byte(self.end_addr),
+                                low_byte(self.end_addr)]), ready_time)
+
+    def is_trigger_edge(self, before, after, level):
+        if self.trigger_rising:
+            return before < level <= after
+        return before > level >= after
+
+    def find_trigger(self, start_time):
+        """Returns the time of the first sample after start_time at which
+        the trigger channel crosses the trigger level on the trigger edge.
+
+        The signal is scanned coarsely and the crossing is then narrowed down
+        to a sample by bisection. There is no signal on the external trigger
+        input unless channels has an 'EXT' waveform; without one, the trigger
+        fires at a random point within a cycle of channel A.
+        """
+        waveform = self.channels.get(self.trigger_channel)
+        if waveform is None:
+            period = 1.0 / max(self.channels['A'].frequency, 1e-3)
+            samples = int(self.rng.uniform(0.0, period) / self.sample_period)
+            return start_time + samples * self.sample_period
+
+        level = (511 - self.trigger_code) * TRIGGER_STEP_SIZE
+        period = 1.0 / max(waveform.frequency, 1e-3)
+        cycles = TRIGGER_TIMEOUT_CYCLES
+        if waveform.shape == 'burst':
+            cycles = max(cycles, 2 * waveform.burst_period)
+        step = max(int(period / TRIGGER_SEARCH_STEPS / self.sample_period), 1)
+        limit = int(cycles * period / self.sample_period)
+
+        def voltage(sample):
+            return waveform.voltage(
+                    start_time + sample * self.sample_period, self.rng)
+
+        low = 0
+        low_voltage = voltage(low)
+        while low < limit:
+            high = low + step
+            high_voltage = voltage(high)
+            if self.is_trigger_edge(low_voltage, high_voltage, level):
+                # Narrow down to the first sample on the far side of the
+                # level.
+                while high - low > 1:
+                    middle = (low + high) // 2
+                    middle_voltage = voltage(middle)
+                    if self.is_trigger_edge(low_voltage, middle_voltage,
+                                            level):
+                        high = middle
+                    else:
+                        low = middle
+                        low_voltage = middle_voltage
+                return start_time + high * self.sample_period
+            low = high
+            low_voltage = high_voltage
+        return start_time + limit * self.sample_period
+
+    def handle_read_mem(self, ready_time):
+        self.respond(bytearray('D') + self.mem_buf, ready_time)
+
+    def respond(self, data, ready_time):
+        faults = self.faults
+        if self.rng.random() < faults.junk:
+            self.send(bytearray([self.rng.randrange(256)]), ready_time)
+        if self.rng.random() < faults.corrupt:
+            index = self.rng.randrange(len(data))
+            data[index] ^= 1 << self.rng.randrange(8)
+        if self.rng.random() < faults.drop:
+            del data[self.rng.randrange(len(data))]
+        self.send(data, ready_time)
+
+    def code(self, channel, voltage):
+        code = int(round(511 - voltage / self.step_sizes[channel]))
+        return max(0, min(code, 0x3ff))
+
+    def capture(self, start_time):
+        """Fills the scope memory with a capture starting at start_time.
+
+        The memory is circular. Sample i, oldest first, lives in slot
+        (end_addr + 1 + i) % 1024, which is where Scope.decode_sample expects
+        to find it.
+        """
+        self.end_addr = self.rng.randrange(SAMPLE_COUNT)
+        a = self.channels['A']
+        b = self.channels['B']
+        mem = self.mem_buf
+        for i in range(SAMPLE_COUNT):
+            t = start_time + i * self.sample_period
+            a_code = self.code('A', a.voltage(t, self.rng))
+            b_code = self.code('B', b.voltage(t, self.rng))
+            index = ((self.end_addr + 1 + i) % SAMPLE_COUNT) * 4
+            mem[index] = high_byte(a_code)
+            mem[index + 1] = low_byte(a_code)
+            mem[index + 2] = high_byte(b_code)
+            mem[index + 3] = low_byte(b_code)
@@ -0,0 +1,326 @@
+"""Server-side acquisition modes.
+
+Every capture passes through the current mode before it is encoded, so a
+noisy signal is reduced once on the server rather than by every client:
+
+    normal      captures are sent as they are
+    average     boxcar average of the last count captures
+    exponential exponential running average with a weight of 1/count
+    envelope    per-sample minimum and maximum over count captures, after
+                which the envelope starts over
+    persistence captures are sent as they are, along with a decaying 2-D
+                histogram of where the trace has been, with a time constant
+                of count captures
+
+Averages are rounded back to 10-bit codes so they can be sent in every wire
+format. An envelope frame holds the minimum and then the maximum of each
+sample, with sample indices like a decimated frame. Persistence histograms
+have HISTOGRAM_ROWS rows of codes by HISTOGRAM_COLUMNS columns of samples,
+and are sent to clients subscribed to them (see encoding.encode_persistence).
+They are only scaled to 8-bit images for captures that are encoded for such
+a client.
+
+Counts run from 1 to the largest of COUNTS. All state is allocated when a
+mode is selected and updating it costs O(samples) per capture. Accumulated
+state starts over whenever the mode, the count or the scope settings change.
+"""
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scope import CODE_MASK, SAMPLE_COUNT, Frame
+
+NORMAL = 'normal'
+AVERAGE = 'average'
+EXPONENTIAL = 'exponential'
+ENVELOPE = 'envelope'
+PERSISTENCE = 'persistence'
+MODES = (NORMAL, AVERAGE, EXPONENTIAL, ENVELOPE, PERSISTENCE)
+
+COUNTS = (2, 4, 8, 16, 32, 64, 128, 256)
+DEFAULT_COUNT = 16
+
+HISTOGRAM_SHIFT = 2
+HISTOGRAM_ROWS = (CODE_MASK + 1) >> HISTOGRAM_SHIFT
+HISTOGRAM_COLUMNS = SAMPLE_COUNT >> HISTOGRAM_SHIFT
+# Hits are weighted by a growing factor instead of decaying the whole
+# histogram every capture. It is folded back in once it reaches this size.
+MAX_WEIGHT = 1e6
+
+
+def derived_frame(frame, codes):
+    derived = Frame(frame.sequence, frame.timestamp, frame.settings,
+                    frame.end_addr, None, codes=codes)
+    derived.instrument = frame.instrument
+    return derived
+
+
+class Normal(object):
+    def process(self, frame):
+        return frame
+
+
+class Average(object):
+    def __init__(self, count):
+        self.count = count
+        self.filled = 0
+        self.next = 0
+        if numpy is not None:
+            self.history = numpy.zeros(
+                    (count, 2, SAMPLE_COUNT), dtype=numpy.int16)
+            self.total = numpy.zeros((2, SAMPLE_COUNT), dtype=numpy.int32)
+        else:
+            self.history = [[[0] * SAMPLE_COUNT, [0] * SAMPLE_COUNT]
+                            for _ in range(count)]
+            self.total = [[0] * SAMPLE_COUNT, [0] * SAMPLE_COUNT]
+
+    def process(self, frame):
+        slot = self.history[self.next]
+        self.next = (self.next + 1) % self.count
+        self.filled = min(self.filled + 1, self.count)
+        filled = self.filled
+        if numpy is not None:
+            self.total -= slot
+            slot[0] = frame.codes[0]
+            slot[1] = frame.codes[1]
+            self.total += slot
+            averaged = (self.total + filled // 2) // filled
+            return derived_frame(
+                    frame, (averaged[0].astype(numpy.int16),
+                            averaged[1].astype(numpy.int16)))
+
+        codes = []
+        for channel, total in enumerate(self.total):
+            old = slot[channel]
+            new = frame.codes[channel]
+            for i in range(SAMPLE_COUNT):
+                total[i] += new[i] - old[i]
+            slot[channel] = list(new)
+            codes.append([(t + filled // 2) // filled for t in total])
+        return derived_frame(frame, tuple(codes))
+
+
+class Exponential(object):
+    def __init__(self, count):
+        self.weight = 1.0 / count
+        self.started = False
+        if numpy is not None:
+            self.average = numpy.zeros((2, SAMPLE_COUNT))
+        else:
+            self.average = [[0.0] * SAMPLE_COUNT, [0.0] * SAMPLE_COUNT]
+
+    def process(self, frame):
+        weight = self.weight if self.started else 1.0
+        self.started = True
+        if numpy is not None:
+            for channel in range(2):
+                average = self.average[channel]
+                average += (frame.codes[channel] - average) * weight
+            codes = numpy.rint(self.average).astype(numpy.int16)
+            return derived_frame(frame, (codes[0], codes[1]))
+
+        codes = []
+        for channel, average in enumerate(self.average):
+            new = frame.codes[channel]
+            for i in range(SAMPLE_COUNT):
+                average[i] += (new[i] - average[i]) * weight
+            codes.append([int(round(a)) for a in average])
+        return derived_frame(frame, tuple(codes))
+
+
+if numpy is not None:
+    ENVELOPE_INDICES = numpy.repeat(numpy.arange(SAMPLE_COUNT), 2)
+else:
+    ENVELOPE_INDICES = [i // 2 for i in range(2 * SAMPLE_COUNT)]
+
+
+class Envelope(object):
+    def __init__(self, count):
+        self.count = count
+        self.seen = 0
+        if numpy is not None:
+            self.low = numpy.zeros((2, SAMPLE_COUNT), dtype=numpy.int16)
+            self.high = numpy.zeros((2, SAMPLE_COUNT), dtype=numpy.int16)
+        else:
+            self.low = [[0] * SAMPLE_COUNT, [0] * SAMPLE_COUNT]
+            self.high = [[0] * SAMPLE_COUNT, [0] * SAMPLE_COUNT]
+
+    def process(self, frame):
+        start = self.seen % self.count == 0
+        self.seen += 1
+        codes = []
+        for channel in range(2):
+            new = frame.codes[channel]
+            low = self.low[channel]
+            high = self.high[channel]
+            if numpy is not None:
+                if start:
+                    low[:] = new
+                    high[:] = new
+                else:
+                    numpy.minimum(low, new, out=low)
+                    numpy.maximum(high, new, out=high)
+                interleaved = numpy.empty(2 * SAMPLE_COUNT, dtype=numpy.int16)
+                interleaved[0::2] = low
+                interleaved[1::2] = high
+            else:
+                if start:
+                    low[:] = new
+                    high[:] = new
+                else:
+                    for i in range(SAMPLE_COUNT):
+                        low[i] = min(low[i], new[i])
+                        high[i] = max(high[i], new[i])
+                interleaved = [0] * (2 * SAMPLE_COUNT)
+                interleaved[0::2] = low
+                interleaved[1::2] = high
+            codes.append(interleaved)
+
+        envelope = derived_frame(frame, tuple(codes))
+        envelope.indices = (ENVELOPE_INDICES, ENVELOPE_INDICES)
+        envelope.source = frame
+        return envelope
+
+
+class PersistenceImages(object):
+    """The persistence images of one capture, scaled when first asked for.
+
+    Only the latest capture's images can still be made: once the next
+    capture is added to the histograms, get returns None if they were never
+    asked for.
+    """
+
+    def __init__(self, persistence):
+        self.persistence = persistence
+        self.lock = persistence.lock
+        self.images = None
+
+    def get(self):
+        with self.lock:
+            if self.images is None and self.persistence is not None:
+                self.images = self.persistence.make_images()
+            return self.images
+
+    def expire(self):
+        self.persistence = None
+
+
+class Persistence(object):
+    def __init__(self, count):
+        self.growth = 1.0 / (1.0 - 1.0 / max(count, 2))
+        self.weight = 1.0
+        # Guards the histograms against images being made on other threads.
+        self.lock = threading.Lock()
+        self.latest = None
+        cells = HISTOGRAM_ROWS * HISTOGRAM_COLUMNS
+        if numpy is not None:
+            self.histograms = numpy.zeros((2, cells))
+            self.columns = (numpy.arange(SAMPLE_COUNT) >> HISTOGRAM_SHIFT)
+        else:
+            self.histograms = [[0.0] * cells, [0.0] * cells]
+            self.columns = [i >> HISTOGRAM_SHIFT for i in range(SAMPLE_COUNT)]
+
+    def process(self, frame):
+        codes = frame.codes
+        with self.lock:
+            if self.latest is not None:
+                self.latest.expire()
+            self.weight *= self.growth
+            if self.weight > MAX_WEIGHT:
+                self.rescale()
+            for channel, histogram in enumerate(self.histograms):
+                if numpy is not None:
+                    rows = codes[channel].astype(numpy.intp) >> HISTOGRAM_SHIFT
+                    cells = rows * HISTOGRAM_COLUMNS + self.columns
+                    numpy.add.at(histogram, cells, self.weight)
+                else:
+                    for code, column in zip(codes[channel], self.columns):
+                        cell = (code >> HISTOGRAM_SHIFT) * HISTOGRAM_COLUMNS
+                        histogram[cell + column] += self.weight
+            self.latest = PersistenceImages(self)
+        frame.persistence = self.latest
+        return frame
+
+    def make_images(self):
+        """Scales each histogram to an 8-bit image. Called with the lock
+        held.
+        """
+        images = []
+        for histogram in self.histograms:
+            if numpy is not None:
+                peak = histogram.max()
+                images.append((histogram * (255.0 / peak)).astype(
+                        numpy.uint8))
+            else:
+                scale = 255.0 / max(histogram)
+                images.append(bytearray(int(h * scale) for h in histogram))
+        return tuple(images)
+
+    def rescale(self):
+        scale = 1.0 / self.weight
+        if numpy is not None:
+            self.histograms *= scale
+        else:
+            for histogram in self.histograms:
+                histogram[:] = [h * scale for h in histogram]
+        self.weight = 1.0
+
+
+PROCESSORS = {
+    NORMAL: lambda count: Normal(),
+    AVERAGE: Average,
+    EXPONENTIAL: Exponential,
+    ENVELOPE: Envelope,
+    PERSISTENCE: Persistence,
+}
+
+
+class AcquisitionModes(object):
+    """The current acquisition mode and its accumulated state.
+
+    process is called for every capture, in order, by the thread that
+    encodes frames. The mode may be changed from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = NORMAL
+        self.count = DEFAULT_COUNT
+        self.processor = Normal()
+        self.settings = None
+
+    @property
+    def state(self):
+        return {'mode': self.mode, 'count': self.count}
+
+    def set_mode(self, mode=None, count=None):
+        if mode is None:
+            mode = self.mode
+        if count is None:
+            count = self.count
+        if mode not in MODES:
+            raise ValueError('Unknown acquisition mode %s' % mode)
+        if (isinstance(count, bool) or not isinstance(count, int) or
+                not 1 <= count <= max(COUNTS)):
+            raise ValueError('Invalid acquisition count %s' % count)
+        with self.lock:
+            self.mode = mode
+            self.count = count
+            self.processor = PROCESSORS[mode](count)
+
+    def next_mode(self):
+        self.set_mode(mode=MODES[(MODES.index(self.mode) + 1) % len(MODES)])
+
+    def next_count(self):
+        larger = [count for count in COUNTS if count > self.count]
+        self.set_mode(count=larger[0] if larger else COUNTS[0])
+
+    def process(self, frame):
+        with self.lock:
+            if frame.settings != self.settings:
+                self.settings = frame.settings
+                self.processor = PROCESSORS[self.mode](self.count)
+            return self.processor.process(frame)
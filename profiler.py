@@ -0,0 +1,177 @@
+"""Sampling profiler for the live server.
+
+When the server is started with --allow-profiling, a client may profile it
+for a while with
+
+    {"profile": {"seconds": S, "interval": I, "format": FORMAT}}
+
+S is how long to profile for, at most MAX_SECONDS, I is the time between
+samples, in seconds, and FORMAT is one of
+
+    collapsed   one line per distinct stack, "THREAD;OUTER;...;INNER COUNT",
+                ready for flamegraph.pl or speedscope
+    pstats      a marshalled pstats dump (load it with pstats.Stats(PATH)),
+                base64 encoded, in which each thread is a caller of the
+                functions at the bottom of its stacks
+
+Every key may be left out. The client is answered straight away with
+{"profile": {"started": true, ...}} and once done with
+{"profile": {"format": FORMAT, "samples": N, "threads": {NAME: N, ...},
+"data": DATA, ...}}.
+
+While a session runs, a thread of its own samples the stack of every other
+thread with sys._current_frames, every interval, so the threads being
+profiled run unmodified. Stacks are tagged with the thread names: reactor,
+scope-read-ID, control-panel and so on. Nothing runs between sessions.
+"""
+import base64
+import collections
+import marshal
+import os
+import sys
+import threading
+import time
+
+COLLAPSED = 'collapsed'
+PSTATS = 'pstats'
+FORMATS = (COLLAPSED, PSTATS)
+
+MAX_SECONDS = 60.0
+MIN_INTERVAL = 0.001
+DEFAULT_SECONDS = 10.0
+DEFAULT_INTERVAL = 0.005
+
+
+def collapsed_stacks(samples):
+    """Returns the samples as collapsed stacks, one per line."""
+    lines = []
+    for (thread_name, stack), count in sorted(samples.items()):
+        frames = [thread_name] + [
+                '%s (%s:%d)' % (name, os.path.basename(filename), line)
+                for filename, line, name in stack]
+        lines.append('%s %d' % (';'.join(frames), count))
+    return '\n'.join(lines) + '\n'
+
+
+def pstats_dump(samples, interval):
+    """Returns the samples as a marshalled pstats dictionary.
+
+    Each sample counts as a call of every function on its stack that took
+    interval seconds, spent in the innermost one.
+    """
+    stats = {}
+    for (thread_name, stack), count in samples.items():
+        seconds = count * interval
+        # cProfile names built-in functions like this thread pseudo-function.
+        functions = [('~', 0, '<thread %s>' % thread_name)] + list(stack)
+        seen = set()
+        for depth, function in enumerate(functions):
+            calls, total_calls, own, cumulative, callers = stats.get(
+                    function, (0, 0, 0.0, 0.0, {}))
+            innermost = depth == len(functions) - 1
+            if innermost:
+                own += seconds
+            # Recursive calls count once towards the cumulative time.
+            if function not in seen:
+                seen.add(function)
+                calls += count
+                total_calls += count
+                cumulative += seconds
+            if depth:
+                caller = functions[depth - 1]
+                (caller_calls, caller_total_calls, caller_own,
+                 caller_cumulative) = callers.get(caller, (0, 0, 0.0, 0.0))
+                callers[caller] = (
+                        caller_calls + count, caller_total_calls + count,
+                        caller_own + (seconds if innermost else 0.0),
+                        caller_cumulative + seconds)
+            stats[function] = (calls, total_calls, own, cumulative, callers)
+    return marshal.dumps(stats)
+
+
+class ProfileSession(threading.Thread):
+    """Samples the stacks of every other thread until the session is over,
+    then calls done with the results.
+    """
+
+    def __init__(self, seconds, interval, output_format, done):
+        super(ProfileSession, self).__init__(name='profiler')
+        self.daemon = True
+        self.seconds = seconds
+        self.interval = interval
+        self.output_format = output_format
+        self.done = done
+
+    def run(self):
+        samples = collections.Counter()
+        threads = collections.Counter()
+        own_id = threading.current_thread().ident
+        end = time.time() + self.seconds
+        while time.time() < end:
+            names = dict((thread.ident, thread.name)
+                         for thread in threading.enumerate())
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno,
+                                  code.co_name))
+                    frame = frame.f_back
+                stack.reverse()
+                name = names.get(thread_id, str(thread_id))
+                samples[(name, tuple(stack))] += 1
+                threads[name] += 1
+            # Not a reference to the frames of other threads is kept between
+            # samples.
+            frame = None
+            time.sleep(self.interval)
+
+        if self.output_format == COLLAPSED:
+            data = collapsed_stacks(samples)
+        else:
+            data = base64.b64encode(pstats_dump(samples, self.interval))
+        self.done({
+            'format': self.output_format,
+            'seconds': self.seconds,
+            'interval': self.interval,
+            'samples': sum(threads.values()),
+            'threads': dict(threads),
+            'data': data,
+        })
+
+
+class SamplingProfiler(object):
+    """Runs one ProfileSession at a time."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.session = None
+
+    @property
+    def running(self):
+        return self.session is not None and self.session.is_alive()
+
+    def start(self, seconds=DEFAULT_SECONDS, interval=DEFAULT_INTERVAL,
+              output_format=COLLAPSED, done=None):
+        """Starts profiling. done is called with the results, on the
+        profiling thread, once the session is over.
+
+        Raises ValueError for unsupported settings and RuntimeError if a
+        session is already running.
+        """
+        if not isinstance(seconds, (int, float)) or not (
+                0 < seconds <= MAX_SECONDS):
+            raise ValueError('profiles last up to %d seconds' % MAX_SECONDS)
+        if not isinstance(interval, (int, float)) or interval < MIN_INTERVAL:
+            raise ValueError('the sampling interval must be at least %s '
+                             'seconds' % MIN_INTERVAL)
+        if output_format not in FORMATS:
+            raise ValueError('unsupported profile format: %s' % output_format)
+        with self.lock:
+            if self.running:
+                raise RuntimeError('a profile is already being taken')
+            self.session = ProfileSession(
+                    seconds, interval, output_format, done)
+            self.session.start()
@@ -0,0 +1,255 @@
+"""Recording captures to disk and playing them back without the hardware.
+
+A recording is a file of fixed size records behind a small header, written and
+read through mmap. Each record holds one capture exactly as the scope sent it:
+
+File header (big-endian, FILE_HEADER.size bytes):
+    magic           4s  'TKSR'
+    version         H   RECORDING_VERSION
+    header_size     H   bytes before the first record
+    record_size     I   bytes per record
+    record_count    Q   complete records in the file
+
+Record (big-endian, RECORD_HEADER then the raw memory at MEMORY_OFFSET):
+    timestamp       d   capture time, seconds since the epoch
+    end_addr        H   end address reported by the scope
+    divisor         B   sample rate divisor
+    trigger_level   d   volts
+    trigger_edge    B   Scope.RISING_EDGE or Scope.FALLING_EDGE
+    trigger_channel B   index into acquisition.TRIGGER_CHANNELS
+    step_size_a     d   volts per code on channel A (the preamp setting)
+    step_size_b     d   volts per code on channel B
+
+record_count is only updated once a record is complete, so a recording that
+is still being written, or whose writer crashed, can be replayed up to its
+last complete capture.
+"""
+import mmap
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from acquisition import TRIGGER_CHANNELS
+from scope import BUFFER_SIZE, SAMPLE_COUNT, Scope, ScopeSettings
+
+RECORDING_MAGIC = 'TKSR'
+RECORDING_VERSION = 1
+FILE_HEADER = struct.Struct('>4sHHIQ')
+HEADER_SIZE = 64
+RECORD_HEADER = struct.Struct('>dHBdBBdd')
+MEMORY_OFFSET = 64
+RECORD_SIZE = MEMORY_OFFSET + BUFFER_SIZE
+COUNT_OFFSET = 12
+
+
+def pack_buffer(codes, end_addr):
+    """Rebuilds the scope memory a pair of rotated codes was decoded from.
+
+    The bits decode_codes masks off are lost and come back as zeros, so the
+    rebuilt memory decodes to exactly the same codes.
+    """
+    a_codes, b_codes = codes
+    if numpy is not None:
+        words = numpy.column_stack((a_codes, b_codes)).astype('>u2')
+        return numpy.roll(words, end_addr + 1, axis=0).tostring()
+    buf = bytearray(BUFFER_SIZE)
+    for i in range(SAMPLE_COUNT):
+        index = ((end_addr + 1 + i) % SAMPLE_COUNT) * 4
+        struct.pack_into('>HH', buf, index, a_codes[i], b_codes[i])
+    return str(buf)
+
+
+class FrameRecorder(object):
+    """Appends every frame to a recording, then passes it on to scope_data.
+
+    Stands in for the data sender wherever frames are appended. Frames
+    without their raw memory, like those read from a FrameRing, are recorded
+    from their codes.
+    """
+    GROW_RECORDS = 256
+
+    def __init__(self, path, scope_data=None):
+        self.scope_data = scope_data
+        self.count = 0
+        self.capacity = 1
+        self.file = open(path, 'w+b')
+        self.file.truncate(HEADER_SIZE + RECORD_SIZE)
+        self.memory = mmap.mmap(self.file.fileno(), 0)
+        FILE_HEADER.pack_into(
+                self.memory, 0, RECORDING_MAGIC, RECORDING_VERSION,
+                HEADER_SIZE, RECORD_SIZE, 0)
+
+    def append(self, frame):
+        self.record(frame)
+        if self.scope_data is not None:
+            self.scope_data.append(frame)
+
+    def record(self, frame):
+        if self.memory is None:
+            return
+        if self.count == self.capacity:
+            self.capacity += FrameRecorder.GROW_RECORDS
+            self.memory.resize(HEADER_SIZE + self.capacity * RECORD_SIZE)
+
+        offset = HEADER_SIZE + self.count * RECORD_SIZE
+        settings = frame.settings
+        RECORD_HEADER.pack_into(
+                self.memory, offset,
+                frame.timestamp,
+                frame.end_addr,
+                settings.sample_rate_divisor,
+                settings.trigger_level,
+                settings.trigger_edge,
+                TRIGGER_CHANNELS.index(settings.trigger_channel),
+                settings.step_size_a,
+                settings.step_size_b)
+        buf = frame.buf
+        if buf is None:
+            buf = pack_buffer(frame.codes, frame.end_addr)
+        memory_offset = offset + MEMORY_OFFSET
+        self.memory[memory_offset:memory_offset + BUFFER_SIZE] = str(buf)
+        self.count += 1
+        struct.pack_into('>Q', self.memory, COUNT_OFFSET, self.count)
+
+    def close(self):
+        """Trims the file to the records written and closes it."""
+        if self.memory is None:
+            return
+        memory = self.memory
+        self.memory = None
+        memory.resize(HEADER_SIZE + self.count * RECORD_SIZE)
+        memory.flush()
+        memory.close()
+        self.file.close()
+
+
+class Recording(object):
+    """Read-only access to the records of a recording file."""
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.memory = mmap.mmap(
+                self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, header_size, record_size, count = (
+                FILE_HEADER.unpack_from(self.memory, 0))
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION:
+            raise RuntimeError('%s is not a version %d recording' % (
+                    path, RECORDING_VERSION))
+        self.header_size = header_size
+        self.record_size = record_size
+        complete = (len(self.memory) - header_size) // record_size
+        self.count = min(count, complete)
+
+    def __len__(self):
+        return self.count
+
+    def record_offset(self, index):
+        if not 0 <= index < self.count:
+            raise IndexError('record %d out of range' % index)
+        return self.header_size + index * self.record_size
+
+    def timestamp(self, index):
+        return struct.unpack_from(
+                '>d', self.memory, self.record_offset(index))[0]
+
+    def read_header(self, index):
+        """Returns the (timestamp, end_addr, settings) of a record."""
+        (timestamp, end_addr, divisor, trigger_level, trigger_edge,
+         trigger_channel, step_size_a, step_size_b) = (
+                RECORD_HEADER.unpack_from(
+                        self.memory, self.record_offset(index)))
+        settings = ScopeSettings(
+                sample_rate_divisor=divisor,
+                trigger_level=trigger_level,
+                trigger_edge=trigger_edge,
+                trigger_channel=TRIGGER_CHANNELS[trigger_channel],
+                step_size_a=step_size_a,
+                step_size_b=step_size_b)
+        return timestamp, end_addr, settings
+
+    def read_memory(self, index):
+        offset = self.record_offset(index) + MEMORY_OFFSET
+        return self.memory[offset:offset + BUFFER_SIZE]
+
+    def read_memory_into(self, index, buf):
+        """Reads the memory of a record straight into a bytearray."""
+        self.file.seek(self.record_offset(index) + MEMORY_OFFSET)
+        if self.file.readinto(buf) != BUFFER_SIZE:
+            raise EOFError('record %d is truncated' % index)
+
+    def close(self):
+        self.memory.close()
+        self.file.close()
+
+
+class ReplayScope(Scope):
+    """Plays a recording back in place of a Scope, e.g. in ScopeReadThread.
+
+    speed is how many times faster than real time to play: 1.0 keeps the
+    recorded spacing between captures, 10.0 plays ten times faster and None
+    or 0 plays as fast as frames can be consumed. Frames carry the recorded
+    settings and memory but are stamped with the time they are replayed, so
+    latency measured downstream is that of the replay. Settings changes are
+    accepted but have no effect on the recording.
+
+    At the end of the recording get_frame raises EOFError, unless loop is set,
+    in which case playback starts over.
+    """
+
+    def __init__(self, recording, speed=1.0, loop=False):
+        if not len(recording):
+            raise RuntimeError('the recording is empty')
+        self.recording = recording
+        self.speed = speed or None
+        self.loop = loop
+        self.position = 0
+        self.started_at = None
+        super(ReplayScope, self).__init__(None, com=recording)
+
+    def queue_command(self, key, cmd):
+        pass  # There is no hardware to send settings to.
+
+    def seek(self, index):
+        """Makes the record at index the next one played."""
+        if index < 0:
+            index += len(self.recording)
+        self.recording.record_offset(index)
+        self.position = index
+        self.started_at = None
+
+    def next_record(self):
+        """Returns the index of the next record to play and waits until it is
+        due.
+        """
+        if self.position >= len(self.recording):
+            if not self.loop:
+                raise EOFError('end of recording')
+            self.seek(0)
+        index = self.position
+        self.position += 1
+        if self.speed is not None:
+            recorded = self.recording.timestamp(index)
+            now = time.time()
+            if self.started_at is None:
+                self.started_at = (now, recorded)
+            start, first = self.started_at
+            delay = start + (recorded - first) / self.speed - now
+            if delay > 0:
+                time.sleep(delay)
+        return index
+
+    def get_frame(self):
+        index = self.next_record()
+        _, end_addr, settings = self.recording.read_header(index)
+        buf = self.recording.read_memory(index)
+        return self.make_frame(buf, end_addr, settings, time.time())
+
+    def get_frame_into(self, buf):
+        index = self.next_record()
+        _, end_addr, settings = self.recording.read_header(index)
+        self.recording.read_memory_into(index, buf)
+        return self.make_frame(buf, end_addr, settings, time.time())
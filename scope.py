@@ -1,5 +1,22 @@
+import collections
+import Queue
 import serial
 import threading
+import time
+import weakref
+from twisted.internet import protocol
+from twisted.internet.serialport import SerialPort
+
+import metrics
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SAMPLE_COUNT = 1024
+BUFFER_SIZE = 4 * SAMPLE_COUNT
+CODE_MASK = 0x3ff
 
 
 def low_byte(short):
@@ -14,6 +31,193 @@ def split_bytes(short):
     return (high_byte(short), low_byte(short))
 
 
+_voltage_tables = {}
+
+
+def voltage_table(step_size):
+    """Returns the 10-bit code to voltage lookup table for an A/D step size.
+
+    The table is a pair of (list, numpy array or None). Entries are rounded
+    exactly as the original per-sample decoder rounded them, so the pure Python
+    and vectorized decoders produce identical output.
+    """
+    tables = _voltage_tables.get(step_size)
+    if tables is None:
+        table = [round((511 - code) * step_size, 2)
+                 for code in range(CODE_MASK + 1)]
+        array = None
+        if numpy is not None:
+            array = numpy.array(table, dtype=numpy.float64)
+        tables = (table, array)
+        _voltage_tables[step_size] = tables
+    return tables
+
+
+def empty_codes():
+    """Returns a pair of code arrays to decode into."""
+    if numpy is not None:
+        return (numpy.zeros(SAMPLE_COUNT, dtype=numpy.uint16),
+                numpy.zeros(SAMPLE_COUNT, dtype=numpy.uint16))
+    return ([0] * SAMPLE_COUNT, [0] * SAMPLE_COUNT)
+
+
+def decode_codes(buf, end_addr, out=None):
+    """Returns the rotated 10-bit codes of each channel as numpy arrays.
+
+    The buffer is viewed (not copied) as 2048 big-endian words laid out
+    A0 B0 A1 B1 ..., and rotated so that the oldest sample comes first. The
+    codes are written to out, a pair of arrays from empty_codes, if given.
+    """
+    if len(buf) != BUFFER_SIZE:
+        raise RuntimeError('Invalid buffer size')
+    if out is None:
+        out = empty_codes()
+    words = numpy.frombuffer(buf, dtype='>u2').reshape(SAMPLE_COUNT, 2)
+    oldest = (end_addr + 1) % SAMPLE_COUNT
+    newest = SAMPLE_COUNT - oldest
+    for channel, codes in enumerate(out):
+        numpy.bitwise_and(words[oldest:, channel], CODE_MASK,
+                          out=codes[:newest])
+        numpy.bitwise_and(words[:oldest, channel], CODE_MASK,
+                          out=codes[newest:])
+    return out
+
+
+def decode_buffer(buf, end_addr, step_sizes):
+    """Vectorized decoder. Returns contiguous float64 arrays per channel."""
+    a_codes, b_codes = decode_codes(buf, end_addr)
+    a_table = voltage_table(step_sizes[Scope.CHANNEL_A])[1]
+    b_table = voltage_table(step_sizes[Scope.CHANNEL_B])[1]
+    return {
+        Scope.CHANNEL_A: a_table.take(a_codes),
+        Scope.CHANNEL_B: b_table.take(b_codes),
+    }
+
+
+def decode_codes_python(buf, end_addr, out=None):
+    """Pure Python counterpart of decode_codes. Returns lists of ints."""
+    if len(buf) != BUFFER_SIZE:
+        raise RuntimeError('Invalid buffer size')
+    if out is None:
+        out = ([0] * SAMPLE_COUNT, [0] * SAMPLE_COUNT)
+
+    data = buf if isinstance(buf, bytearray) else bytearray(buf)
+    a_codes, b_codes = out
+    for i in range(SAMPLE_COUNT):
+        index = ((i + end_addr) * 4) + 4
+        a_high = data[index % BUFFER_SIZE]
+        a_low = data[(index + 1) % BUFFER_SIZE]
+        b_high = data[(index + 2) % BUFFER_SIZE]
+        b_low = data[(index + 3) % BUFFER_SIZE]
+
+        a_codes[i] = (256 * a_high + a_low) & CODE_MASK
+        b_codes[i] = (256 * b_high + b_low) & CODE_MASK
+    return out
+
+
+def decode_buffer_python(buf, end_addr, step_sizes):
+    """Pure Python decoder. Returns lists of floats per channel."""
+    a_codes, b_codes = decode_codes_python(buf, end_addr)
+    a_table = voltage_table(step_sizes[Scope.CHANNEL_A])[0]
+    b_table = voltage_table(step_sizes[Scope.CHANNEL_B])[0]
+    return {
+        Scope.CHANNEL_A: [a_table[code] for code in a_codes],
+        Scope.CHANNEL_B: [b_table[code] for code in b_codes],
+    }
+
+
+class ScopeSettings(collections.namedtuple('ScopeSettings', [
+        'sample_rate_divisor', 'trigger_level', 'trigger_edge',
+        'trigger_channel', 'step_size_a', 'step_size_b'])):
+    """Snapshot of the scope settings a capture was taken with."""
+
+    @property
+    def sample_rate(self):
+        return 20000000.0 / (2 ** self.sample_rate_divisor)
+
+    @property
+    def step_sizes(self):
+        return {
+            Scope.CHANNEL_A: self.step_size_a,
+            Scope.CHANNEL_B: self.step_size_b,
+        }
+
+
+class Frame(object):
+    """A single capture and the settings it was taken with.
+
+    Decoding is deferred until the codes or voltages are first needed, and
+    the result is cached so every consumer of a frame shares the work.
+    Frames lent by a FramePool decode into the pool's arrays.
+    """
+
+    def __init__(self, sequence, timestamp, settings, end_addr, buf,
+                 codes=None):
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.settings = settings
+        self.end_addr = end_addr
+        self.buf = buf
+        self._codes = codes
+        self._samples = None
+        # Sample indices of each channel, for frames that were decimated.
+        self.indices = None
+        # The capture a derived frame, such as an envelope, was built from.
+        self.source = None
+        # Persistence histogram images of the channels, made on demand (see
+        # modes.PersistenceImages).
+        self.persistence = None
+        # Spectrum message contents (see spectrum.py).
+        self.spectrum = None
+        # Which of the server's scopes captured the frame.
+        self.instrument = 0
+        # Arrays to decode into, for frames lent by a FramePool.
+        self.codes_out = None
+
+    @property
+    def codes(self):
+        """The rotated 10-bit codes as an (A, B) pair."""
+        if self._codes is None:
+            start = time.time()
+            if numpy is None:
+                self._codes = decode_codes_python(
+                        self.buf, self.end_addr, self.codes_out)
+            else:
+                self._codes = decode_codes(
+                        self.buf, self.end_addr, self.codes_out)
+            metrics.record('frame.decode', time.time() - start)
+        return self._codes
+
+    @property
+    def sample_arrays(self):
+        """Voltages of each channel as numpy arrays."""
+        a_codes, b_codes = self.codes
+        return {
+            Scope.CHANNEL_A:
+                voltage_table(self.settings.step_size_a)[1].take(a_codes),
+            Scope.CHANNEL_B:
+                voltage_table(self.settings.step_size_b)[1].take(b_codes),
+        }
+
+    @property
+    def samples(self):
+        """Voltages of each channel as lists of floats."""
+        if self._samples is None:
+            if numpy is None:
+                a_codes, b_codes = self.codes
+                a_table = voltage_table(self.settings.step_size_a)[0]
+                b_table = voltage_table(self.settings.step_size_b)[0]
+                self._samples = {
+                    Scope.CHANNEL_A: [a_table[code] for code in a_codes],
+                    Scope.CHANNEL_B: [b_table[code] for code in b_codes],
+                }
+            else:
+                self._samples = dict(
+                        (ch, values.tolist())
+                        for ch, values in self.sample_arrays.items())
+        return self._samples
+
+
 class Scope(object):
     CHANNEL_A = 'A'
     CHANNEL_B = 'B'
@@ -22,30 +226,60 @@ class Scope(object):
     RISING_EDGE = 0
     FALLING_EDGE = 1
 
-    def __init__(self, port):
-        self.com = serial.Serial(
-                port=port,
-                baudrate=230400,
-                parity=serial.PARITY_NONE,
-                stopbits=serial.STOPBITS_ONE,
-                bytesize=serial.EIGHTBITS,
-                timeout=None,
-                rtscts=True)
+    BAUD_RATE = 230400
+
+    def __init__(self, port, com=None):
+        """Opens the scope on a serial port.
+
+        com may be given instead of a port: any object with a write method,
+        such as the transport of a ScopeSerialProtocol.
+        """
+        if com is None:
+            com = serial.Serial(
+                    port=port,
+                    baudrate=Scope.BAUD_RATE,
+                    parity=serial.PARITY_NONE,
+                    stopbits=serial.STOPBITS_ONE,
+                    bytesize=serial.EIGHTBITS,
+                    timeout=None,
+                    rtscts=True)
+        self.com = com
 
         self.gain = 1  # TODO: this can change, but it isn't clear how...
+        self.ad_step_sizes = {}
+        self.sequence = 0
         self.trigger_channel = Scope.CHANNEL_A
         self.trigger_edge = Scope.RISING_EDGE
 
+        # Settings commands, keyed by what they set, waiting to be sent
+        # between captures.
+        self.command_lock = threading.RLock()
+        self.pending_commands = collections.OrderedDict()
+        self.commands_queued = 0
+        self.commands_coalesced = 0
+        self.commands_sent = 0
+
         self.set_sample_rate_divisor(0)
         self.set_preamp(Scope.CHANNEL_A, high=True)
         self.set_preamp(Scope.CHANNEL_B, high=True)
         self.set_trigger_level(0.0)
         self.set_trigger_type(edge=Scope.RISING_EDGE, channel=Scope.CHANNEL_A)
+        self.flush_commands()
 
     @property
     def sample_rate(self):
         return 20000000.0 / (2 ** self.sample_rate_divisor)
 
+    @property
+    def settings(self):
+        return ScopeSettings(
+                sample_rate_divisor=self.sample_rate_divisor,
+                trigger_level=self.trigger_level,
+                trigger_edge=self.trigger_edge,
+                trigger_channel=self.trigger_channel,
+                step_size_a=self.ad_step_sizes[Scope.CHANNEL_A],
+                step_size_b=self.ad_step_sizes[Scope.CHANNEL_B])
+
     @property
     def control_register(self):
         reg = self.sample_rate_divisor
@@ -61,100 +295,553 @@ class Scope(object):
     def command(self, cmd):
         self.com.write('%s\r\n' % cmd)
 
+    def queue_command(self, key, cmd):
+        """Queues a settings command to be sent before the next capture.
+
+        A command still waiting with the same key is replaced, so only the
+        latest value of each setting reaches the scope.
+        """
+        with self.command_lock:
+            self.commands_queued += 1
+            if key in self.pending_commands:
+                self.commands_coalesced += 1
+            self.pending_commands[key] = cmd
+
+    def flush_commands(self):
+        """Sends the queued settings commands.
+
+        Called by whoever drives acquisition, between captures. Returns the
+        settings in effect for the next capture.
+        """
+        with self.command_lock:
+            for cmd in self.pending_commands.values():
+                self.command(cmd)
+                self.commands_sent += 1
+            self.pending_commands.clear()
+            return self.settings
+
+    @property
+    def command_stats(self):
+        return {
+            'queued': self.commands_queued,
+            'coalesced': self.commands_coalesced,
+            'sent': self.commands_sent,
+            'pending': len(self.pending_commands),
+        }
+
     def handle_message(self, msg):
-        hex_msg = ["%x" % ord(c) for c in msg]
-        raise NotImplementedError('Unhandled message ', hex_msg)
+        """Discards bytes the scope sent while a reply was expected.
+
+        They are counted as serial.unexpected-bytes.
+        """
+        metrics.count('serial.unexpected-bytes', len(msg))
 
     def begin_sample(self):
         self.command("S G")
 
     def wait_for_sample(self):
-        msg = self.com.read(3)
-        while msg[0] != 'A':
+        # Skip a byte at a time, so the reply is found even if unexpected
+        # bytes came before it.
+        msg = self.com.read()
+        while msg != 'A':
             self.handle_message(msg)
-            msg = self.com.read(3)
-        else:
-            upper = ord(msg[1])
-            lower = ord(msg[2])
-            return 256 * upper + lower
+            msg = self.com.read()
+        msg = self.com.read(2)
+        upper = ord(msg[0])
+        lower = ord(msg[1])
+        return 256 * upper + lower
 
-    def read_memory(self):
+    def request_memory(self):
+        """Asks for the scope memory and reads up to the 'D' before it."""
         self.command("S B")
         msg = self.com.read()
-        while msg[0] != 'D':
+        while msg != 'D':
             self.handle_message(msg)
             msg = self.com.read()
-        return self.com.read(4096)
+
+    def read_memory(self):
+        self.request_memory()
+        return self.com.read(BUFFER_SIZE)
+
+    def read_memory_into(self, buf):
+        """Like read_memory, but transfers the memory into a bytearray.
+
+        With a port that has readinto, the bytes go straight into buf.
+        """
+        self.request_memory()
+        readinto = getattr(self.com, 'readinto', None)
+        if readinto is None:
+            buf[:] = self.com.read(BUFFER_SIZE)
+            return
+        received = readinto(buf)
+        if received < BUFFER_SIZE:
+            view = memoryview(buf)
+            while received < BUFFER_SIZE:
+                count = readinto(view[received:])
+                if not count:
+                    raise EOFError('the scope stopped sending its memory')
+                received += count
 
     def decode_sample(self, buf, end_addr):
-        if len(buf) != 4096:
-            raise RuntimeError('Invalid buffer size')
-
-        sample = {Scope.CHANNEL_A: [], Scope.CHANNEL_B: []}
-        for i in range(1024):
-            index = ((i + end_addr) * 4) + 4
-            a_high = ord(buf[index % 4096])
-            a_low = ord(buf[(index + 1) % 4096])
-            b_high = ord(buf[(index + 2) % 4096])
-            b_low = ord(buf[(index + 3) % 4096])
-
-            a = 256 * a_high + a_low
-            b = 256 * b_high + b_low
-            a_voltage = (511 - a) * self.ad_step_size
-            b_voltage = (511 - b) * self.ad_step_size
-            sample[Scope.CHANNEL_A].append(round(a_voltage, 2))
-            sample[Scope.CHANNEL_B].append(round(b_voltage, 2))
-        return sample
+        """Decodes a memory buffer into lists of voltages for each channel.
 
-    def get_sample(self):
-        """Begins, collects and decodes a sample.
+        Uses the vectorized decoder when numpy is available.
+        """
+        if numpy is None:
+            return decode_buffer_python(buf, end_addr, self.ad_step_sizes)
+        sample = decode_buffer(buf, end_addr, self.ad_step_sizes)
+        return dict((ch, values.tolist()) for ch, values in sample.items())
 
-        TODO: This function spends a lot of time waiting. Make it asynchronous.
+    def decode_sample_arrays(self, buf, end_addr):
+        """Decodes a memory buffer into numpy arrays for each channel."""
+        return decode_buffer(buf, end_addr, self.ad_step_sizes)
+
+    def make_frame(self, buf, end_addr, settings, timestamp):
+        self.sequence += 1
+        metrics.count('frames.acquired')
+        return Frame(self.sequence, timestamp, settings, end_addr, buf)
+
+    def get_frame(self):
+        """Begins and collects a sample. Decoding is left to the Frame.
+
+        Blocks until the scope triggers and its memory is read;
+        ScopeSerialProtocol does the same from reactor callbacks.
         """
+        settings = self.flush_commands()
+        start = time.time()
         self.begin_sample()
         end_addr = self.wait_for_sample()
+        timestamp = time.time()
+        metrics.record('scope.trigger-wait', timestamp - start)
         buf = self.read_memory()
-        return self.decode_sample(buf, end_addr)
+        metrics.record('scope.transfer', time.time() - timestamp)
+        return self.make_frame(buf, end_addr, settings, timestamp)
+
+    def get_frame_into(self, buf):
+        """Like get_frame, but transfers the memory into buf."""
+        settings = self.flush_commands()
+        start = time.time()
+        self.begin_sample()
+        end_addr = self.wait_for_sample()
+        timestamp = time.time()
+        metrics.record('scope.trigger-wait', timestamp - start)
+        self.read_memory_into(buf)
+        metrics.record('scope.transfer', time.time() - timestamp)
+        return self.make_frame(buf, end_addr, settings, timestamp)
+
+    def get_sample(self):
+        """Begins, collects and decodes a sample."""
+        return self.get_frame().samples
+
+    # Settings take effect on the scope at the next flush_commands. They are
+    # updated under the command lock so that flush_commands always returns
+    # settings matching the commands it sent.
 
     def set_preamp(self, channel, high):
-        if high:
-            self.ad_step_size = 0.0521
-            self.command("S P %s" % channel.upper())
-        else:
-            self.ad_step_size = 0.00592
-            self.command("S P %s" % channel.lower())
+        key = ('S P', channel.upper())
+        with self.command_lock:
+            if high:
+                self.ad_step_sizes[channel.upper()] = 0.0521
+                self.queue_command(key, "S P %s" % channel.upper())
+            else:
+                self.ad_step_sizes[channel.upper()] = 0.00592
+                self.queue_command(key, "S P %s" % channel.lower())
 
     def set_sample_rate_divisor(self, divisor):
         if divisor & ~0xf:
             raise RuntimeError('Invalid sample rate divisor %d' % divisor)
         else:
-            self.sample_rate_divisor = divisor
-            self.command("S R %d" % self.control_register)
+            with self.command_lock:
+                self.sample_rate_divisor = divisor
+                self.queue_command('S R', "S R %d" % self.control_register)
 
     def set_trigger_type(self, edge, channel):
-        self.trigger_edge = edge
-        self.trigger_channel = channel
-        self.command("S R %d" % self.control_register)
+        with self.command_lock:
+            self.trigger_edge = edge
+            self.trigger_channel = channel
+            self.queue_command('S R', "S R %d" % self.control_register)
 
     def set_trigger_level(self, voltage):
-        self.trigger_level = voltage
-        value = int(511 - self.gain * self.trigger_level / 0.52421484375)
-        (high_byte, low_byte) = split_bytes(value)
-        self.command("S T %d %d" % (high_byte, low_byte))
+        with self.command_lock:
+            self.trigger_level = voltage
+            value = int(511 - self.gain * self.trigger_level / 0.52421484375)
+            (high_byte, low_byte) = split_bytes(value)
+            self.queue_command('S T', "S T %d %d" % (high_byte, low_byte))
+
+
+class AcquisitionControl(object):
+    """Decides when a scope should capture.
+
+    The run mode is one of RUN_MODES:
+
+        run         capture continuously
+        stop        do not capture
+        single      capture one frame, then stop
+
+    With on_demand set, captures are also only taken while someone wants
+    them, as reported with set_demand, so an instrument nobody is watching
+    leaves the serial link and the CPU idle. Listeners are called with no
+    arguments, on the thread that made the change, whenever the state
+    changes.
+    """
+    RUN = 'run'
+    STOP = 'stop'
+    SINGLE = 'single'
+    RUN_MODES = (RUN, STOP, SINGLE)
+
+    def __init__(self, on_demand=True):
+        self.condition = threading.Condition()
+        self.on_demand = on_demand
+        self.mode = AcquisitionControl.RUN
+        self.demand = False
+        self.listeners = []
+
+    @property
+    def state(self):
+        return {'mode': self.mode, 'idle': not self.active}
+
+    @property
+    def active(self):
+        return (self.mode != AcquisitionControl.STOP and
+                (self.demand or not self.on_demand))
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def update(self, mode=None, demand=None):
+        with self.condition:
+            if mode is not None:
+                if mode not in AcquisitionControl.RUN_MODES:
+                    raise ValueError('Unknown run mode %s' % mode)
+                self.mode = mode
+            if demand is not None:
+                self.demand = demand
+            self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def set_mode(self, mode):
+        self.update(mode=mode)
+
+    def set_demand(self, demand):
+        if demand != self.demand:
+            self.update(demand=demand)
+
+    def begin_capture(self):
+        """Returns whether a capture may start now, and counts it towards a
+        single shot.
+        """
+        with self.condition:
+            if not self.active:
+                return False
+            single = self.mode == AcquisitionControl.SINGLE
+            if single:
+                self.mode = AcquisitionControl.STOP
+        if single:
+            for listener in self.listeners:
+                listener()
+        return True
+
+    def wait(self):
+        """Blocks until captures may be taken or wake is called."""
+        with self.condition:
+            if not self.active:
+                self.condition.wait()
+
+    def wake(self):
+        with self.condition:
+            self.condition.notify_all()
+
+
+class FramePool(object):
+    """Reusable memory for captures.
+
+    Each slot holds a raw memory buffer and the arrays its codes are decoded
+    into. A frame read into a slot is lent out with lend, and the slot comes
+    back to the pool once nothing references the frame any more, so frames
+    can sit in client queues for as long as they need to without being
+    released explicitly. Anything that keeps a frame's codes must keep the
+    frame too.
+
+    acquire makes a new slot if every slot is lent out, and at most count
+    free slots are kept, so acquisition allocates nothing per frame once
+    consumers keep up. slots_made counts the slots made past the first count.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self.lock = threading.Lock()
+        self.free = [self.make_slot() for _ in range(count)]
+        self.lent = {}
+        # References to lent frames that died, whose slots have yet to be
+        # put back.
+        self.reclaimed = collections.deque()
+        self.slots_made = 0
+
+    def make_slot(self):
+        return (bytearray(BUFFER_SIZE), empty_codes())
+
+    def acquire(self):
+        """Returns a free (buffer, codes) slot."""
+        with self.lock:
+            self.collect()
+            if self.free:
+                return self.free.pop()
+            self.slots_made += 1
+        metrics.count('pool.slots-made')
+        return self.make_slot()
+
+    def release(self, slot):
+        """Returns a slot that was not lent out."""
+        with self.lock:
+            if len(self.free) < self.count:
+                self.free.append(slot)
+
+    def lend(self, frame, slot):
+        """Lends the slot out with a frame read into its buffer."""
+        frame.codes_out = slot[1]
+        with self.lock:
+            self.lent[weakref.ref(frame, self.reclaim)] = slot
+
+    def reclaim(self, frame_ref):
+        # Called on whichever thread drops the last reference to the frame,
+        # which may hold the lock already, so the slot is only put back by
+        # the next acquire.
+        self.reclaimed.append(frame_ref)
+
+    def collect(self):
+        """Puts back the slots of the frames that died. Call with the lock
+        held.
+        """
+        while self.reclaimed:
+            slot = self.lent.pop(self.reclaimed.popleft())
+            if len(self.free) < self.count:
+                self.free.append(slot)
+
+
+class FramePublishThread(threading.Thread):
+    """Publishes frames handed over by a ScopeReadThread.
+
+    At most depth frames wait to be published, so acquisition is throttled
+    to the rate at which they are.
+    """
+
+    def __init__(self, scope_data, depth):
+        super(FramePublishThread, self).__init__(name='frame-publish')
+
+        self.scope_data = scope_data
+        self.frames = Queue.Queue(depth)
+
+    def run(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            self.scope_data.append(frame)
+
+    def stop(self):
+        self.frames.put(None)
 
 
 class ScopeReadThread(threading.Thread):
-    def __init__(self, scope, scope_data):
-        super(ScopeReadThread, self).__init__()
+    """Acquires frames from the scope and appends them to scope_data.
+
+    Frames are read into the memory of a FramePool, and decoded into it.
+    In pipelined mode frame N is decoded and published on a FramePublishThread
+    while frame N+1 is armed and transferred into the next pooled buffer, so
+    the serial link is not left idle while frames are being processed.
+
+    With an AcquisitionControl, the thread sleeps without capturing while the
+    control is not active.
+    """
+
+    POOL_SIZE = 8
+
+    def __init__(self, scope, scope_data, pipelined=False, buffer_count=3,
+                 control=None):
+        super(ScopeReadThread, self).__init__(name='scope-read')
 
         self.scope = scope
         self.scope_data = scope_data
+        self.pipelined = pipelined
+        self.buffer_count = buffer_count
+        self.control = control
+        self.pool = FramePool(max(buffer_count, ScopeReadThread.POOL_SIZE))
         self.stopped = True
 
+    def may_capture(self):
+        """Waits until the next capture may start. Returns False if the
+        thread was stopped in the meantime.
+        """
+        if self.control is None:
+            return not self.stopped
+        while not self.stopped:
+            if self.control.begin_capture():
+                return True
+            self.control.wait()
+        return False
+
     def run(self):
         self.stopped = False
-        while not self.stopped:
-            self.scope_data.append(self.scope.get_sample())
+        try:
+            if self.pipelined:
+                self.run_pipelined()
+            else:
+                while self.may_capture():
+                    self.scope_data.append(self.read_frame())
+        except EOFError:
+            # A source with a finite number of frames, like a ReplayScope,
+            # has run out.
+            self.stopped = True
+
+    def read_frame(self):
+        slot = self.pool.acquire()
+        frame = self.scope.get_frame_into(slot[0])
+        self.pool.lend(frame, slot)
+        return frame
+
+    def run_pipelined(self):
+        # One frame is being read while the others wait or are published.
+        publish_thread = FramePublishThread(
+                self.scope_data, max(self.buffer_count - 1, 1))
+        publish_thread.name = '%s-publish' % self.name
+        publish_thread.start()
+        try:
+            while self.may_capture():
+                publish_thread.frames.put(self.read_frame())
+        finally:
+            publish_thread.stop()
+            publish_thread.join()
 
     def stop(self):
         self.stopped = True
+        if self.control is not None:
+            self.control.wake()
+
+
+class ScopeSerialProtocol(protocol.Protocol):
+    """Drives acquisition from reactor data callbacks instead of a thread.
+
+    Each capture steps through the same exchange as Scope.get_frame, but the
+    replies are parsed incrementally as they arrive:
+
+        S G -> 'A' HI LO -> S B -> 'D' + 4096 bytes -> publish -> S G ...
+
+    The Scope is created once the serial transport is connected and writes its
+    commands straight to that transport. With an AcquisitionControl, the
+    protocol stays idle while the control is not active and arms as soon as
+    it becomes active again.
+    """
+    IDLE = 0
+    WAIT_ACK = 1
+    WAIT_DATA = 2
+    READ_MEMORY = 3
+
+    def __init__(self, scope_data, reactor, control=None):
+        self.scope_data = scope_data
+        self.reactor = reactor
+        self.control = control
+        if control is not None:
+            control.add_listener(self.control_changed)
+        self.scope = None
+        self.state = ScopeSerialProtocol.IDLE
+        self.running = False
+        self.pending = bytearray()
+        self.settings = None
+        self.end_addr = None
+        self.armed_at = None
+        self.timestamp = None
+
+    def connectionMade(self):
+        self.scope = Scope(None, com=self.transport)
+
+    def start(self):
+        self.running = True
+        if self.state == ScopeSerialProtocol.IDLE:
+            self.arm()
+
+    def stop(self):
+        """Stops after the capture in flight, if any, has been read."""
+        self.running = False
+
+    def control_changed(self):
+        # Control changes may come from any thread.
+        self.reactor.callFromThread(self.resume)
+
+    def resume(self):
+        if self.running and self.state == ScopeSerialProtocol.IDLE:
+            self.arm()
+
+    def arm(self):
+        if self.control is not None and not self.control.begin_capture():
+            return
+        self.settings = self.scope.flush_commands()
+        self.state = ScopeSerialProtocol.WAIT_ACK
+        self.armed_at = time.time()
+        self.scope.begin_sample()
+
+    def dataReceived(self, data):
+        self.pending.extend(data)
+        while self.step():
+            pass
+
+    def skip_unexpected_byte(self):
+        self.scope.handle_message(chr(self.pending[0]))
+        del self.pending[0]
+
+    def step(self):
+        """Consumes pending data for the current state.
+
+        Returns True if progress was made and the next state should run.
+        """
+        if self.state == ScopeSerialProtocol.WAIT_ACK:
+            if len(self.pending) < 3:
+                return False
+            if self.pending[0] != ord('A'):
+                self.skip_unexpected_byte()
+                return True
+            self.end_addr = 256 * self.pending[1] + self.pending[2]
+            self.timestamp = time.time()
+            metrics.record(
+                    'scope.trigger-wait', self.timestamp - self.armed_at)
+            del self.pending[:3]
+            self.state = ScopeSerialProtocol.WAIT_DATA
+            self.scope.command("S B")
+            return True
+        elif self.state == ScopeSerialProtocol.WAIT_DATA:
+            if not self.pending:
+                return False
+            if self.pending[0] != ord('D'):
+                self.skip_unexpected_byte()
+                return True
+            del self.pending[0]
+            self.state = ScopeSerialProtocol.READ_MEMORY
+            return True
+        elif self.state == ScopeSerialProtocol.READ_MEMORY:
+            if len(self.pending) < BUFFER_SIZE:
+                return False
+            buf = str(self.pending[:BUFFER_SIZE])
+            del self.pending[:BUFFER_SIZE]
+            metrics.record('scope.transfer', time.time() - self.timestamp)
+            self.publish(buf)
+            return True
+        elif self.pending:
+            self.skip_unexpected_byte()
+            return True
+        return False
+
+    def publish(self, buf):
+        self.state = ScopeSerialProtocol.IDLE
+        frame = self.scope.make_frame(
+                buf, self.end_addr, self.settings, self.timestamp)
+        self.scope_data.append(frame)
+        if self.running:
+            self.arm()
+
+
+def open_scope_serial(port, scope_data, reactor, control=None):
+    """Opens a scope on the reactor. Returns its ScopeSerialProtocol."""
+    scope_protocol = ScopeSerialProtocol(scope_data, reactor, control)
+    SerialPort(scope_protocol, port, reactor, baudrate=Scope.BAUD_RATE,
+               rtscts=True)
+    return scope_protocol
@@ -0,0 +1,213 @@
+"""Server-side spectrum of each capture.
+
+The spectrum of each channel is the magnitude of the real FFT of the windowed
+voltages, in dBV (dB relative to 1 volt peak). Magnitudes are corrected for
+the coherent gain of the window, so a sine of amplitude 1 V reads 0 dBV at its
+frequency whatever window is used:
+
+    hann        good general purpose frequency resolution
+    flattop     accurate amplitudes, wide peaks
+    blackman    low leakage, for signals next to much larger ones
+
+Bin k is at k * sample_rate / samples Hz. Window coefficients and the
+frequency axis are computed once per window, sample rate divisor and size.
+
+With averaging, the power in each bin is averaged exponentially over about
+that many captures, which steadies the noise floor without hiding changes in
+the signal for long. Averages start over when the window, the averaging,
+the channels computed or the scope settings change.
+"""
+import cmath
+import math
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from scope import Scope
+
+HANN = 'hann'
+FLATTOP = 'flattop'
+BLACKMAN = 'blackman'
+# Cosine-sum coefficients of each window.
+WINDOWS = {
+    HANN: (0.5, 0.5),
+    FLATTOP: (0.21557895, 0.41663158, 0.277263158, 0.083578947, 0.006947368),
+    BLACKMAN: (0.42, 0.5, 0.08),
+}
+
+# Magnitudes below this many volts are reported as this many volts, rather
+# than as minus infinity dBV.
+FLOOR = 1e-6
+
+_axes = {}
+
+
+def window_coefficients(window, size):
+    terms = WINDOWS[window]
+    if numpy is not None:
+        phase = 2 * numpy.pi * numpy.arange(size) / size
+        coefficients = numpy.zeros(size)
+        for k, term in enumerate(terms):
+            coefficients += (-1) ** k * term * numpy.cos(k * phase)
+        return coefficients
+    return [sum((-1) ** k * term * math.cos(2 * math.pi * k * n / size)
+                for k, term in enumerate(terms))
+            for n in range(size)]
+
+
+def axis(window, divisor, sample_rate, size):
+    """Returns the cached (window coefficients, amplitude scale, bin
+    frequencies) for a window, sample rate divisor and size.
+    """
+    key = (window, divisor, size)
+    cached = _axes.get(key)
+    if cached is None:
+        coefficients = window_coefficients(window, size)
+        # Every bin but DC holds half of the amplitude of a real signal.
+        scale = 2.0 / sum(coefficients)
+        bins = size // 2 + 1
+        if numpy is not None:
+            frequencies = numpy.arange(bins) * (sample_rate / size)
+        else:
+            frequencies = [k * sample_rate / size for k in range(bins)]
+        cached = (coefficients, scale, frequencies)
+        _axes[key] = cached
+    return cached
+
+
+def fft(values):
+    """Radix-2 FFT of a list of complex values whose length is a power of two.
+
+    Only used when numpy is not available.
+    """
+    size = len(values)
+    if size & (size - 1):
+        raise ValueError('FFT size must be a power of two')
+    bits = size.bit_length() - 1
+    out = [0j] * size
+    for i, value in enumerate(values):
+        out[int(bin(i)[2:].zfill(bits)[::-1], 2) if bits else 0] = value
+    width = 2
+    while width <= size:
+        step = cmath.exp(-2j * math.pi / width)
+        for start in range(0, size, width):
+            twiddle = 1 + 0j
+            for i in range(start, start + width // 2):
+                even = out[i]
+                odd = out[i + width // 2] * twiddle
+                out[i] = even + odd
+                out[i + width // 2] = even - odd
+                twiddle *= step
+        width *= 2
+    return out
+
+
+def power_spectrum(volts, coefficients, scale):
+    """Returns the squared amplitude, in volts, of each frequency bin."""
+    if numpy is not None:
+        magnitudes = numpy.abs(numpy.fft.rfft(volts * coefficients)) * scale
+        magnitudes[0] /= 2
+        return magnitudes * magnitudes
+    spectrum = fft([v * c for v, c in zip(volts, coefficients)])
+    powers = [(abs(x) * scale) ** 2 for x in spectrum[:len(volts) // 2 + 1]]
+    powers[0] /= 4
+    return powers
+
+
+def decibels(powers):
+    """Converts squared amplitudes to dBV, rounded to 0.01 dB."""
+    if numpy is not None:
+        floored = numpy.maximum(powers, FLOOR * FLOOR)
+        return numpy.round(10 * numpy.log10(floored), 2).tolist()
+    return [round(10 * math.log10(max(p, FLOOR * FLOOR)), 2) for p in powers]
+
+
+def peak(powers, frequencies):
+    """Returns the strongest bin other than DC as {"frequency", "db"}."""
+    if numpy is not None:
+        index = int(numpy.argmax(powers[1:])) + 1
+    else:
+        index = max(range(1, len(powers)), key=powers.__getitem__)
+    db = 10 * math.log10(max(float(powers[index]), FLOOR * FLOOR))
+    return {'frequency': float(frequencies[index]), 'db': round(db, 2)}
+
+
+class Spectrum(object):
+    """Computes the spectrum of captures, with optional averaging.
+
+    process is called for captures in order by the thread that encodes
+    frames. The window and averaging may be changed from any thread.
+    """
+
+    def __init__(self, window=HANN, average=1):
+        self.lock = threading.Lock()
+        self.window = window
+        self.average = average
+        self.averaged = None
+        self.settings = None
+
+    @property
+    def state(self):
+        return {'window': self.window, 'average': self.average}
+
+    def configure(self, window=None, average=None):
+        if window is None:
+            window = self.window
+        if average is None:
+            average = self.average
+        if window not in WINDOWS:
+            raise ValueError('Unknown window %s' % window)
+        if not isinstance(average, int) or average < 1:
+            raise ValueError('Invalid spectrum averaging %s' % average)
+        with self.lock:
+            self.window = window
+            self.average = average
+            self.averaged = None
+
+    def process(self, frame, channels=(Scope.CHANNEL_A, Scope.CHANNEL_B)):
+        """Returns the spectrum message contents of the given channels of a
+        frame.
+        """
+        if frame.source is not None:
+            frame = frame.source
+        settings = (frame.settings, tuple(channels))
+        with self.lock:
+            if settings != self.settings:
+                self.settings = settings
+                self.averaged = None
+            if numpy is not None:
+                sample = frame.sample_arrays
+            else:
+                sample = frame.samples
+            size = len(sample[channels[0]])
+            coefficients, scale, frequencies = axis(
+                    self.window, frame.settings.sample_rate_divisor,
+                    frame.settings.sample_rate, size)
+
+            powers = [power_spectrum(sample[channel], coefficients, scale)
+                      for channel in channels]
+            if self.averaged is not None and self.average > 1:
+                weight = 1.0 / self.average
+                for channel, averaged in enumerate(self.averaged):
+                    if numpy is not None:
+                        averaged += (powers[channel] - averaged) * weight
+                    else:
+                        for i, p in enumerate(powers[channel]):
+                            averaged[i] += (p - averaged[i]) * weight
+            else:
+                self.averaged = powers
+
+            data = {
+                'sequence': frame.sequence,
+                'window': self.window,
+                'average': self.average,
+                'bin-width': frame.settings.sample_rate / size,
+                'peak': {},
+            }
+            for channel, powers in zip(channels, self.averaged):
+                data[channel] = decibels(powers)
+                data['peak'][channel] = peak(powers, frequencies)
+            return data
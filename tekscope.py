@@ -38,98 +38,894 @@ Developer documentation:
     separate process can post to the web service whenever control information
     needs to be updated.
 """
+import argparse
+import collections
 import json
 import signal
-import sys
-from twisted.internet import reactor, protocol
+import socket
+import threading
+import time
+from twisted.internet import interfaces, reactor, protocol, task
+from zope.interface import implementer
 
+import decimate
+import encoding
+import metrics
+import modes
+import profiler
+import spectrum
+from acquisition import AcquisitionWorker, FrameRing, RingReaderThread
 from controls import ControlPanel, ControlPanelThread, Encoder, Switch, Led
-from scope import Scope, ScopeReadThread
+from controls import open_control_panel_serial
+from history import FrameHistory, HistoryReply
+from recording import FrameRecorder, Recording, ReplayScope
+from scope import SAMPLE_COUNT, AcquisitionControl, Scope, ScopeReadThread
+from scope import open_scope_serial
 
 
-class ScopeProtocol(protocol.Protocol):
-    def __init__(self, client_list, scope, control_panel):
-        self.client_list = client_list
+def is_integer(value):
+    """Returns whether a decoded JSON value is an integer. true and false
+    decode to bools, which are ints too, but are not accepted as numbers.
+    """
+    return isinstance(value, (int, long)) and not isinstance(value, bool)
+
+
+def is_number(value):
+    return is_integer(value) or isinstance(value, float)
+
+
+class Instrument(object):
+    """A scope and the ScopeDataSender that fans its frames out.
+
+    Instruments are numbered from 0 in the order their ports were given.
+    """
+
+    def __init__(self, instrument_id, scope, data_sender):
+        self.instrument_id = instrument_id
         self.scope = scope
+        self.data_sender = data_sender
+
+    @property
+    def stats(self):
+        stats = self.data_sender.stats
+        stats['commands'] = self.scope.command_stats
+        stats['run'] = self.data_sender.control.state
+        return stats
+
+
+@implementer(interfaces.IPushProducer)
+class ScopeProtocol(protocol.Protocol):
+    """A scope client.
+
+    Clients send JSON commands, one message per line. A message may also be
+    a JSON array of commands, which are handled in order. Messages that are
+    not valid JSON, or are longer than MAX_MESSAGE_SIZE bytes, are answered
+    with {"error": MESSAGE} and skipped, as are commands that fail.
+
+    Frames are queued per client and written only while the transport is not
+    applying backpressure. When a client falls behind, its oldest queued
+    frames are dropped so that it always receives the most recent captures.
+    Replies to history queries are written a page at a time in the same way,
+    but are never dropped.
+
+    Clients receive frames from instrument 0 until they subscribe to others.
+    Settings messages apply to instrument 0 unless the message names another
+    with "instrument": ID.
+
+    Instruments only capture while at least one client subscribed to them
+    wants frames, and while their run mode ({"run": MODE}) allows it.
+
+    With a SamplingProfiler, clients may also profile the server (see
+    profiler.py).
+
+    A client with a maximum frame rate is sent at most that many frames per
+    second from each instrument. Frames that arrive early are held, and a
+    newer frame replaces the one held, so a throttled client is always sent
+    the latest capture rather than a backlog.
+    """
+    MAX_QUEUED_FRAMES = 4
+    MIN_STATS_INTERVAL = 0.5
+    MAX_MESSAGE_SIZE = 64 * 1024
+
+    WAVEFORMS = 'waveforms'
+    UI_PARAMS = 'ui'
+    MEASUREMENTS = 'measurements'
+    PERSISTENCE = 'persistence'
+    SPECTRUM = 'spectrum'
+    MESSAGE_TYPES = (WAVEFORMS, UI_PARAMS, MEASUREMENTS, PERSISTENCE, SPECTRUM)
+    # Message types sent along with frames, and their wire formats.
+    FRAME_TYPES = (WAVEFORMS, MEASUREMENTS, PERSISTENCE, SPECTRUM)
+    MESSAGE_FORMATS = (
+        (MEASUREMENTS, encoding.FORMAT_MEASUREMENTS),
+        (PERSISTENCE, encoding.FORMAT_PERSISTENCE),
+        (SPECTRUM, encoding.FORMAT_SPECTRUM),
+    )
+
+    def __init__(self, instruments, control_panel, profiler=None):
+        self.instruments = instruments
         self.control_panel = control_panel
-        self.pending_data = ''
+        self.profiler = profiler
+        # Chunks of the message received so far, and their total length.
+        self.pending_data = []
+        self.pending_size = 0
+        # Set while the rest of a message that was too long is skipped.
+        self.discarding = False
+        self.wire_format = encoding.FORMAT_JSON
+        self.decimation = None
+        self.message_types = frozenset(
+                [ScopeProtocol.WAVEFORMS, ScopeProtocol.UI_PARAMS])
+        self.instrument_ids = frozenset([0])
+        self.channels = encoding.CHANNELS
+        self.max_rate = None
+        # Sequence number of the last frame sent from each instrument, and
+        # the deltas sent from it since its last keyframe.
+        self.last_sequence_sent = {}
+        self.deltas_sent = {}
+        # Capture time from which each instrument's next frame may be sent,
+        # and the latest frame held back until then.
+        self.next_due = {}
+        self.throttled = {}
+        self.throttle_call = None
+        self.frames_throttled = 0
+        self.frame_queue = collections.deque(
+                maxlen=ScopeProtocol.MAX_QUEUED_FRAMES)
+        self.history_replies = collections.deque()
+        self.paused = False
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.bytes_sent = 0
+        self.stats_push = None
 
     def connectionMade(self):
         print "connection from: %s" % self.transport.getPeer()
-        self.client_list.add(self)
+        self.transport.registerProducer(self, True)
+        for instrument in self.instruments:
+            instrument.data_sender.add_client(self)
 
     def connectionLost(self, reason):
-        self.client_list.remove(self)
+        self.stop_stats_push()
+        self.clear_throttled()
+        for instrument in self.instruments:
+            instrument.data_sender.remove_client(self)
+        print 'connection closed: %s (%d frames sent, %d dropped)' % (
+                self.transport.getPeer(), self.frames_sent,
+                self.frames_dropped)
+
+    def queue_frame(self, payloads):
+        if self.message_types.isdisjoint(ScopeProtocol.FRAME_TYPES):
+            return
+        if self.max_rate is not None:
+            instrument_id = payloads.frame.instrument
+            due = self.next_due.get(instrument_id, 0.0)
+            if payloads.frame.timestamp < due:
+                self.throttle(payloads, due)
+                return
+            # A frame still held is older, and must not be sent after it.
+            if self.throttled.pop(instrument_id, None) is not None:
+                self.frames_throttled += 1
+            self.next_due[instrument_id] = (
+                    payloads.frame.timestamp + 1.0 / self.max_rate)
+        self.enqueue_frame(payloads)
+
+    def throttle(self, payloads, due):
+        """Holds a frame until it is due, dropping the one held before."""
+        if payloads.frame.instrument in self.throttled:
+            self.frames_throttled += 1
+        self.throttled[payloads.frame.instrument] = payloads
+        self.release_when_due(due)
+
+    def release_when_due(self, due):
+        if self.throttle_call is None:
+            self.throttle_call = reactor.callLater(
+                    max(due - time.time(), 0), self.release_throttled)
+
+    def release_throttled(self):
+        """Sends the held frames that are due and waits for the rest."""
+        self.throttle_call = None
+        now = time.time()
+        for instrument_id, payloads in self.throttled.items():
+            due = self.next_due[instrument_id]
+            if now < due:
+                self.release_when_due(due)
+                continue
+            del self.throttled[instrument_id]
+            self.next_due[instrument_id] = due + 1.0 / self.max_rate
+            self.enqueue_frame(payloads)
+
+    def clear_throttled(self):
+        self.throttled.clear()
+        self.next_due.clear()
+        if self.throttle_call is not None:
+            self.throttle_call.cancel()
+            self.throttle_call = None
+
+    def enqueue_frame(self, payloads):
+        if len(self.frame_queue) == self.frame_queue.maxlen:
+            self.frames_dropped += 1
+            metrics.count('frames.dropped')
+        self.frame_queue.append(payloads)
+        self.send_queued_frames()
+
+    def keys_for(self, payloads):
+        """Returns the payload keys to send, choosing keyframes for delta
+        clients that did not receive the frame the delta is against or are
+        due a periodic one.
+        """
+        keys = []
+        if ScopeProtocol.WAVEFORMS in self.message_types:
+            instrument_id = payloads.frame.instrument
+            last_sequence_sent = self.last_sequence_sent.get(instrument_id)
+            if self.wire_format == encoding.FORMAT_DELTA and (
+                    payloads.reference_sequence != last_sequence_sent or
+                    self.deltas_sent.get(instrument_id, 0) >=
+                    encoding.KEYFRAME_INTERVAL - 1):
+                keys.append((encoding.FORMAT_DELTA_KEYFRAME, self.decimation,
+                             self.channels))
+            else:
+                keys.append(self.payload_key)
+        keys.extend(self.message_keys)
+        return keys
+
+    def send_queued_frames(self):
+        while not self.paused:
+            if not self.frame_queue:
+                if not self.history_replies:
+                    break
+                self.send_history_page()
+                continue
+            payloads = self.frame_queue.popleft()
+            keys = self.keys_for(payloads)
+            payload = ''.join(payloads.get(key) for key in keys)
+            if ScopeProtocol.WAVEFORMS in self.message_types:
+                frame = payloads.frame
+                self.last_sequence_sent[frame.instrument] = frame.sequence
+                if (keys[0][0] == encoding.FORMAT_DELTA_KEYFRAME or
+                        payloads.reference_sequence is None):
+                    self.deltas_sent[frame.instrument] = 0
+                else:
+                    self.deltas_sent[frame.instrument] = (
+                            self.deltas_sent.get(frame.instrument, 0) + 1)
+            self.frames_sent += 1
+            self.bytes_sent += len(payload)
+            metrics.count('bytes.sent', len(payload))
+            start = time.time()
+            # May call pauseProducing before returning.
+            self.transport.write(payload)
+            metrics.record('client.write', time.time() - start)
+
+    def send_history_page(self):
+        reply = self.history_replies[0]
+        header, payloads = reply.next_page()
+        if reply.done:
+            self.history_replies.popleft()
+        payload = '%s\n%s' % (json.dumps(header), ''.join(payloads))
+        self.bytes_sent += len(payload)
+        metrics.count('bytes.sent', len(payload))
+        self.transport.write(payload)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.send_queued_frames()
+
+    def stopProducing(self):
+        self.frame_queue.clear()
+        self.history_replies.clear()
+
+    @property
+    def payload_key(self):
+        return (self.wire_format, self.decimation, self.channels)
+
+    @property
+    def payload_keys(self):
+        """Every payload key this client may be sent."""
+        keys = []
+        if ScopeProtocol.WAVEFORMS in self.message_types:
+            keys.append(self.payload_key)
+        keys.extend(self.message_keys)
+        return keys
+
+    @property
+    def message_keys(self):
+        return [(wire_format, None, self.channels)
+                for message_type, wire_format in ScopeProtocol.MESSAGE_FORMATS
+                if message_type in self.message_types]
+
+    @property
+    def stats(self):
+        return {
+            'peer': str(self.transport.getPeer()),
+            'format': self.wire_format,
+            'subscribe': sorted(self.message_types),
+            'instruments': sorted(self.instrument_ids),
+            'channels': list(self.channels),
+            'max-rate': self.max_rate,
+            'frames-sent': self.frames_sent,
+            'frames-dropped': self.frames_dropped,
+            'frames-throttled': self.frames_throttled,
+            'frames-queued': len(self.frame_queue),
+            'bytes-sent': self.bytes_sent,
+        }
+
+    def send_message(self, data):
+        self.transport.write('%s\n' % json.dumps(data))
+
+    def send_error(self, message):
+        metrics.count('client.errors')
+        self.send_message({'error': message})
+
+    def send_setting(self, data_sender, name, data):
+        """Sends a shared setting to every client that wants UI parameters,
+        and to this one in any case.
+        """
+        data_sender.send_ui_param(name, data)
+        if ScopeProtocol.UI_PARAMS not in self.message_types:
+            self.send_message({name: data})
+
+    def server_stats(self):
+        report = metrics.report()
+        report['clients'] = self.instruments[0].data_sender.client_stats()
+        report['encoders'] = encoding.stats.report()
+        report['instruments'] = [
+                instrument.stats for instrument in self.instruments]
+        report['frames-per-second'] = sum(
+                stats['frames-per-second']
+                for stats in report['instruments'])
+        return report
+
+    def send_stats(self):
+        self.send_message({'stats': self.server_stats()})
+
+    def stop_stats_push(self):
+        if self.stats_push is not None:
+            self.stats_push.stop()
+            self.stats_push = None
+
+    def set_stats_interval(self, value):
+        """Handles {"stats": true} and {"stats": {"interval": N}}.
+
+        Replies with a report straight away. A non-zero interval also pushes
+        one every N seconds until the interval is set to 0.
+        """
+        if isinstance(value, dict):
+            interval = value.get('interval') or 0
+            if not is_number(interval) or interval < 0:
+                self.send_error('unsupported stats interval: %s' %
+                                json.dumps(interval))
+                return
+            self.stop_stats_push()
+            if interval:
+                self.stats_push = task.LoopingCall(self.send_stats)
+                self.stats_push.start(
+                        max(interval, ScopeProtocol.MIN_STATS_INTERVAL),
+                        now=False)
+        self.send_stats()
+
+    def update_payload_key(self):
+        # Queued frames were encoded for the previous key.
+        self.frame_queue.clear()
+        self.clear_throttled()
+        self.last_sequence_sent = {}
+        for instrument in self.instruments:
+            instrument.data_sender.update_payload_keys()
+
+    def set_wire_format(self, wire_format):
+        if wire_format not in encoding.FORMATS:
+            self.send_error('unsupported wire format: %s' % wire_format)
+            return
+        self.wire_format = wire_format
+        self.update_payload_key()
+        self.send_message({'format': self.wire_format})
+
+    def set_subscription(self, value):
+        """Handles {"subscribe": {"types": [TYPE, ...], "instruments": [ID,
+        ...], "channels": [CHANNEL, ...], "max-rate": N}}.
+
+        TYPE is one of MESSAGE_TYPES. Clients start out subscribed to
+        waveforms and UI parameters; a client that only wants measurements
+        subscribes to just those. CHANNEL is "A" or "B", and N is the most
+        frames per second to send, or null for every frame. Any key may be
+        left out.
+        """
+        types = value.get('types', self.message_types)
+        instrument_ids = value.get('instruments', self.instrument_ids)
+        channels = value.get('channels', self.channels)
+        max_rate = value.get('max-rate', self.max_rate)
+        unknown = set(types) - set(ScopeProtocol.MESSAGE_TYPES)
+        unknown_ids = [instrument_id for instrument_id in instrument_ids
+                       if not is_integer(instrument_id) or
+                       not 0 <= instrument_id < len(self.instruments)]
+        if unknown:
+            self.send_error(
+                    'unsupported message types: %s' % ', '.join(unknown))
+            return
+        if unknown_ids:
+            self.send_error('unknown instruments: %s' % ', '.join(
+                    json.dumps(instrument_id)
+                    for instrument_id in unknown_ids))
+            return
+        if not channels or set(channels) - set(encoding.CHANNELS):
+            self.send_error(
+                    'unsupported channels: %s' % json.dumps(channels))
+            return
+        if max_rate is not None and (not is_number(max_rate) or
+                                     max_rate <= 0):
+            self.send_error(
+                    'unsupported maximum rate: %s' % json.dumps(max_rate))
+            return
+        self.message_types = frozenset(types)
+        self.instrument_ids = frozenset(instrument_ids)
+        self.channels = tuple(channel for channel in encoding.CHANNELS
+                              if channel in channels)
+        self.max_rate = max_rate
+        self.update_payload_key()
+        self.send_message({'subscribe': {
+            'types': sorted(self.message_types),
+            'instruments': sorted(self.instrument_ids),
+            'channels': list(self.channels),
+            'max-rate': self.max_rate,
+        }})
+
+    def set_trigger_level(self, instrument, value):
+        if not is_number(value):
+            self.send_error(
+                    'unsupported trigger level: %s' % json.dumps(value))
+            return
+        instrument.scope.set_trigger_level(value)
+
+    def set_sample_rate(self, instrument, value):
+        if not (is_integer(value) and 0 <= value <= 0xf):
+            self.send_error(
+                    'unsupported sample rate divisor: %s' % json.dumps(value))
+            return
+        instrument.scope.set_sample_rate_divisor(value)
+
+    def set_acquisition_mode(self, instrument, value):
+        """Handles {"acquire": {"mode": MODE, "count": N}}.
+
+        MODE is one of modes.MODES and either key may be left out. The mode
+        is shared by every client, so the result is sent to all of them.
+        """
+        data_sender = instrument.data_sender
+        try:
+            data_sender.modes.set_mode(value.get('mode'), value.get('count'))
+        except ValueError as e:
+            self.send_error('unsupported acquisition mode: %s' % e)
+            return
+        self.send_setting(data_sender, 'acquire', data_sender.modes_state)
+
+    def set_spectrum_settings(self, instrument, value):
+        """Handles {"spectrum-settings": {"window": WINDOW, "average": N}}.
+
+        WINDOW is one of spectrum.WINDOWS and either key may be left out.
+        Like the acquisition mode, the settings are shared by every client.
+        """
+        data_sender = instrument.data_sender
+        try:
+            data_sender.spectrum.configure(
+                    value.get('window'), value.get('average'))
+        except ValueError as e:
+            self.send_error('unsupported spectrum settings: %s' % e)
+            return
+        self.send_setting(
+                data_sender, 'spectrum-settings', data_sender.spectrum_state)
+
+    def set_run_mode(self, instrument, value):
+        """Handles {"run": MODE}, where MODE is one of
+        AcquisitionControl.RUN_MODES.
+
+        Like the acquisition mode, the run mode is shared by every client.
+        Clients that want UI parameters are told whenever it changes.
+        """
+        data_sender = instrument.data_sender
+        try:
+            data_sender.control.set_mode(value)
+        except ValueError as e:
+            self.send_error('unsupported run mode: %s' % e)
+            return
+        if ScopeProtocol.UI_PARAMS not in self.message_types:
+            self.send_message({'run': data_sender.run_state})
+
+    def query_history(self, instrument, value):
+        """Handles {"history": {...}} (see history.py)."""
+        history = instrument.data_sender.history
+        start = value.get('start', 0)
+        end = value.get('end', SAMPLE_COUNT)
+        if history is None:
+            self.send_error('the history is disabled, start the server with a '
+                            'non-zero --history-mb to enable it')
+            return
+        if not (is_integer(start) and is_integer(end) and
+                0 <= start < end <= SAMPLE_COUNT):
+            self.send_error(
+                    'unsupported history window: %s %s' % (
+                            json.dumps(start), json.dumps(end)))
+            return
+        for name in ('from', 'to', 'since', 'until'):
+            bound = value.get(name)
+            if bound is not None and not is_number(bound):
+                self.send_error('unsupported history bound: %s %s' % (
+                        name, json.dumps(bound)))
+                return
+        try:
+            decimation = decimate.parse_decimation(
+                    value.get('decimate'), end - start)
+            positions, more = history.select(
+                    first=value.get('from'), last=value.get('to'),
+                    since=value.get('since'), until=value.get('until'))
+        except ValueError as e:
+            self.send_error(str(e))
+            return
+
+        wire_format = self.wire_format
+        if wire_format == encoding.FORMAT_DELTA:
+            wire_format = encoding.FORMAT_BINARY
+        channels = self.channels
+
+        def encode(frame):
+            if decimation is not None:
+                frame = decimate.decimate_frame(frame, *decimation)
+            return encoding.encode_frame(frame, wire_format, channels=channels)
+
+        self.history_replies.append(HistoryReply(
+                history, instrument.instrument_id, positions, more, start,
+                end, encode))
+        self.send_queued_frames()
+
+    def start_profile(self, value):
+        """Handles {"profile": {...}} (see profiler.py)."""
+        if self.profiler is None:
+            self.send_error('profiling is disabled, start the server with '
+                            '--allow-profiling to enable it')
+            return
+        seconds = value.get('seconds', profiler.DEFAULT_SECONDS)
+        interval = value.get('interval', profiler.DEFAULT_INTERVAL)
+        output_format = value.get('format', profiler.COLLAPSED)
+        try:
+            self.profiler.start(
+                    seconds, interval, output_format,
+                    done=lambda result: reactor.callFromThread(
+                            self.send_message, {'profile': result}))
+        except (ValueError, RuntimeError) as e:
+            self.send_error(str(e))
+            return
+        self.send_message({'profile': {
+            'started': True,
+            'seconds': seconds,
+            'interval': interval,
+            'format': output_format,
+        }})
+
+    def set_decimation(self, value):
+        """Handles {"decimate": {"mode": MODE, "points": N}} or null."""
+        try:
+            self.decimation = decimate.parse_decimation(value)
+        except ValueError as e:
+            self.send_error(str(e))
+            return
+        self.update_payload_key()
+
+        if self.decimation is None:
+            self.send_message({'decimate': None})
+        else:
+            mode, points = self.decimation
+            self.send_message({'decimate': {'mode': mode, 'points': points}})
 
     def dataReceived(self, data):
-        print 'received: %s' % data
-        self.pending_data += data
-        self.process_data()
-
-    def get_packet(self):
-        # TODO: this isn't working quite right...
-        if self.pending_data[:1] != '{':
-            raise RuntimeError('bad data in buffer: %s' % self.pending_data)
-        stack = ['{']
-        for i, char in enumerate(self.pending_data[1:]):
-            if char == '{':
-                stack.append(char)
-            elif char == '}' and len(stack) > 0:
-                stack.pop()
-            elif char == '}' and len(stack) == 0:
-                return None
+        # Each byte is copied a bounded number of times: a message is only
+        # joined from its chunks once its newline has arrived.
+        lines = data.split('\n')
+        for line in lines[:-1]:
+            if self.discarding:
+                self.discarding = False
+                continue
+            self.pending_data.append(line)
+            message = ''.join(self.pending_data)
+            self.pending_data = []
+            self.pending_size = 0
+            self.message_received(message)
+        tail = lines[-1]
+        if tail and not self.discarding:
+            self.pending_data.append(tail)
+            self.pending_size += len(tail)
+            if self.pending_size > ScopeProtocol.MAX_MESSAGE_SIZE:
+                self.pending_data = []
+                self.pending_size = 0
+                self.discarding = True
+                self.send_message_too_long()
 
-            if len(stack) == 0:
-                packet = self.pending_data[:i + 1]
-                self.pending_data = self.pending_data[i + 1:]
-                return packet
-        return None
+    def send_message_too_long(self):
+        self.send_error('messages are limited to %d bytes' %
+                        ScopeProtocol.MAX_MESSAGE_SIZE)
+
+    def message_received(self, message):
+        message = message.strip()
+        if not message:
+            return
+        if len(message) > ScopeProtocol.MAX_MESSAGE_SIZE:
+            self.send_message_too_long()
+            return
+        try:
+            data = json.loads(message)
+        except ValueError as e:
+            self.send_error('invalid JSON: %s' % e)
+            return
+        for command in data if isinstance(data, list) else [data]:
+            self.run_command(command)
 
-    def process_data(self):
-        #packet = self.get_packet()
-        packet = self.pending_data
-        self.pending_data = ''
-        if not packet:
+    def run_command(self, command):
+        """Handles a command, reporting failures to the client."""
+        if not isinstance(command, dict):
+            self.send_error('commands must be JSON objects')
             return
+        try:
+            self.handle_message(command)
+        except Exception as e:
+            print 'error handling %s: %s' % (json.dumps(command), e)
+            self.send_error('%s failed: %s' % (
+                    ', '.join(sorted(command)), e))
 
-        data = json.loads(packet)
+    def handle_message(self, data):
+        """Applies the settings and answers the requests of a command."""
+        instrument_id = data.pop('instrument', 0)
+        if not (is_integer(instrument_id) and
+                0 <= instrument_id < len(self.instruments)):
+            self.send_error(
+                    'unknown instrument: %s' % json.dumps(instrument_id))
+            return
+        instrument = self.instruments[instrument_id]
         for key, value in data.items():
             if key == 'led':
                 self.control_panel.update_led(value['id'], value['value'])
             elif key == 'trigger-level':
-                self.scope.set_trigger_level(value)
+                self.set_trigger_level(instrument, value)
             elif key == 'sample-rate':
-                self.scope.set_sample_rate_divisor(value)
+                self.set_sample_rate(instrument, value)
+            elif key == 'format':
+                self.set_wire_format(value)
+            elif key == 'decimate':
+                self.set_decimation(value)
+            elif key == 'subscribe':
+                self.set_subscription(value)
+            elif key == 'acquire':
+                self.set_acquisition_mode(instrument, value)
+            elif key == 'spectrum-settings':
+                self.set_spectrum_settings(instrument, value)
+            elif key == 'run':
+                self.set_run_mode(instrument, value)
+            elif key == 'history':
+                self.query_history(instrument, value)
+            elif key == 'keyframe':
+                self.last_sequence_sent = {}
+            elif key == 'encoder-stats':
+                self.send_message({'encoder-stats': encoding.stats.report()})
+            elif key == 'command-stats':
+                self.send_message(
+                        {'command-stats': instrument.scope.command_stats})
+            elif key == 'stats':
+                self.set_stats_interval(value)
+            elif key == 'profile':
+                self.start_profile(value)
             else:
-                print 'unhandled message: %s' % data
+                self.send_error('unhandled command: %s' % key)
 
 
 class ScopeFactory(protocol.Factory):
-    def __init__(self, client_list, scope, control_panel):
-        self.client_list = client_list
-        self.scope = scope
+    def __init__(self, instruments, control_panel, profiler=None):
+        self.instruments = instruments
         self.control_panel = control_panel
+        self.profiler = profiler
 
     def buildProtocol(self, addr):
-        return ScopeProtocol(self.client_list, self.scope, self.control_panel)
+        return ScopeProtocol(
+                self.instruments, self.control_panel, self.profiler)
 
 
 class ScopeDataSender(object):
-    def __init__(self, client_list):
+    """Fans frames and UI updates of one instrument out to its subscribers.
+
+    append and send_ui_param may be called from any thread. Frames are encoded
+    once per payload key (wire format and decimation) in use on the calling
+    thread, and everything that touches a transport is handed to the reactor
+    thread. The senders of all instruments share one client list, and each
+    instrument is encoded on the thread that acquires it.
+
+    Only the payload keys subscribed clients use are encoded, and clients
+    with the same subscription share them. While every subscriber has a
+    maximum frame rate, frames that none of them is due are not encoded at
+    all.
+
+    control tells the acquisition whether anyone wants frames. With
+    on_demand unset, as when every capture is recorded, the instrument
+    captures whether or not anyone does.
+
+    With a history_budget, the latest captures are kept in a FrameHistory of
+    about that many bytes. Every capture is then decoded, including ones no
+    subscriber is due, so that the history has no gaps; without one, skipped
+    captures are never decoded.
+    """
+    RATE_FRAMES = 32
+
+    def __init__(self, client_list, instrument_id=0, on_demand=True,
+                 history_budget=0):
         self.client_list = client_list
+        self.instrument_id = instrument_id
+        # Replaced, never mutated, so other threads can read it safely.
+        self.payload_keys = frozenset()
+        self.max_rate = None
+        self.next_encode = 0.0
+        self.last_payloads = None
+        self.previous_payloads = None
+        self.modes = modes.AcquisitionModes()
+        self.spectrum = spectrum.Spectrum()
+        self.control = AcquisitionControl(on_demand=on_demand)
+        self.control.add_listener(self.send_run_state)
+        self.history = None
+        if history_budget:
+            self.history = FrameHistory(history_budget)
+        self.frames_encoded = 0
+        self.encode_seconds = 0.0
+        self.dispatch_times = collections.deque(
+                maxlen=ScopeDataSender.RATE_FRAMES)
+
+    def is_subscribed(self, client):
+        return self.instrument_id in client.instrument_ids
+
+    def add_client(self, client):
+        self.client_list.add(client)
+        self.update_payload_keys()
+        if self.last_payloads is not None and self.is_subscribed(client):
+            client.queue_frame(self.last_payloads)
+
+    def remove_client(self, client):
+        self.client_list.discard(client)
+        self.update_payload_keys()
 
-    def append(self, data):
+    def update_payload_keys(self):
+        subscribers = [client for client in self.client_list
+                       if self.is_subscribed(client) and client.payload_keys]
+        rates = [client.max_rate for client in subscribers]
+        if not rates or None in rates:
+            self.max_rate = None
+        else:
+            self.max_rate = max(rates)
+        self.payload_keys = frozenset(
+                key for client in subscribers for key in client.payload_keys)
+        self.control.set_demand(bool(subscribers))
+
+    @property
+    def modes_state(self):
+        state = self.modes.state
+        state['instrument'] = self.instrument_id
+        return state
+
+    @property
+    def spectrum_state(self):
+        state = self.spectrum.state
+        state['instrument'] = self.instrument_id
+        return state
+
+    @property
+    def run_state(self):
+        state = self.control.state
+        state['instrument'] = self.instrument_id
+        return state
+
+    def send_run_state(self):
+        # The state is read on the reactor thread, so that clients end up with
+        # the latest one however changes from different threads interleave.
+        reactor.callFromThread(
+                lambda: self.broadcast({'run': self.run_state}))
+
+    @property
+    def stats(self):
+        times = self.dispatch_times
+        rate = 0.0
+        if len(times) > 1 and times[-1] > times[0]:
+            rate = (len(times) - 1) / (times[-1] - times[0])
+        return {
+            'id': self.instrument_id,
+            'frames': self.frames_encoded,
+            'frames-per-second': rate,
+            'mean-encode-time':
+                self.encode_seconds / max(self.frames_encoded, 1),
+            'acquire': self.modes.state,
+            'spectrum-settings': self.spectrum.state,
+            'history': self.history.stats if self.history else None,
+        }
+
+    def append(self, frame):
+        payloads = self.encode(frame)
+        if payloads is not None:
+            self.publish(payloads)
+
+    def encode(self, frame):
+        """Encodes a frame for every payload key currently in use.
+
+        Must be called for frames in order: delta encodings are computed
+        against the frame encoded before. Returns None for frames skipped
+        because no subscriber is due one.
+        """
+        start = time.time()
+        keys = self.payload_keys
+        max_rate = self.max_rate
+        frame.instrument = self.instrument_id
+        # The history and the acquisition modes see every capture, even
+        # skipped ones. Appending to the history decodes the capture: that
+        # is the price of a history without gaps, paid only while enabled.
+        if self.history is not None:
+            self.history.append(frame)
+        frame = self.modes.process(frame)
+        if max_rate is not None:
+            if frame.timestamp < self.next_encode:
+                metrics.count('frames.skipped')
+                return None
+            self.next_encode = frame.timestamp + 1.0 / max_rate
+        # Spectra are averaged across frames, so they are only computed here,
+        # in order, and only for the channels someone is subscribed to.
+        spectrum_channels = [
+                channel for channel in encoding.CHANNELS
+                if any(key[0] == encoding.FORMAT_SPECTRUM and channel in key[2]
+                       for key in keys)]
+        if spectrum_channels:
+            frame.spectrum = self.spectrum.process(frame, spectrum_channels)
+        payloads = encoding.FramePayloads(frame, self.previous_payloads)
+        for key in keys:
+            payloads.get(key)
+        payloads.drop_reference()
+        self.previous_payloads = payloads
+        elapsed = time.time() - start
+        metrics.record('sender.encode', elapsed)
+        self.frames_encoded += 1
+        self.encode_seconds += elapsed
+        return payloads
+
+    def publish(self, payloads):
+        reactor.callFromThread(self.dispatch, payloads, time.time())
+
+    def dispatch(self, payloads, published_at):
+        now = time.time()
+        metrics.record('sender.dispatch-wait', now - published_at)
+        metrics.record('frame.age', now - payloads.frame.timestamp)
+        metrics.count('frames.published')
+        self.dispatch_times.append(now)
+        self.last_payloads = payloads
         for client in self.client_list:
-            client.transport.write('%s\n' % json.dumps(data))
+            if self.is_subscribed(client):
+                client.queue_frame(payloads)
 
     def send_ui_param(self, name, data):
-        client_data = {name: data}
+        reactor.callFromThread(self.broadcast, {name: data})
+
+    def send_instrument_param(self, name, data):
+        """Like send_ui_param, for a setting of this instrument. The
+        message says which instrument it is about, as in
+        {"sample-rate": N, "instrument": ID}.
+        """
+        reactor.callFromThread(
+                self.broadcast, {name: data, 'instrument': self.instrument_id})
+
+    def broadcast(self, data):
+        message = '%s\n' % json.dumps(data)
         for client in self.client_list:
-            client.transport.write('%s\n' % json.dumps(client_data))
+            if ScopeProtocol.UI_PARAMS in client.message_types:
+                client.transport.write(message)
+
+    def client_stats(self):
+        return [client.stats for client in self.client_list]
 
 
-def make_control_panel(port, scope, data_sender):
-    control_panel = ControlPanel(port=port)
+def make_control_panel(port, instruments, com=None):
+    """Builds the control panel, which drives one instrument at a time.
+
+    Switch H selects the next instrument, switch I runs or stops it and
+    switch J takes a single shot.
+    """
+    control_panel = ControlPanel(port=port, com=com)
+    data_sender = instruments[0].data_sender
+    selected = [instruments[0]]
 
     def update_encoder_ui_param(control):
         data = {
@@ -147,8 +943,10 @@ def make_control_panel(port, scope, data_sender):
 
     def update_sample_rate(encoder):
         encoder.value = max(0, min(encoder.value, 15))
+        scope = selected[0].scope
         scope.set_sample_rate_divisor(encoder.value)
-        data_sender.send_ui_param('sample-rate', scope.sample_rate_divisor)
+        selected[0].data_sender.send_instrument_param(
+                'sample-rate', scope.sample_rate_divisor)
         update_encoder_ui_param(encoder)
 
     def update_trigger_level(encoder):
@@ -156,8 +954,10 @@ def make_control_panel(port, scope, data_sender):
         trigger_limit = 200
         trigger_step = 1
         encoder.value = max(-trigger_limit, min(encoder.value, trigger_limit))
+        scope = selected[0].scope
         scope.set_trigger_level(encoder.value * trigger_step)
-        data_sender.send_ui_param('trigger-level', scope.trigger_level)
+        selected[0].data_sender.send_instrument_param(
+                'trigger-level', scope.trigger_level)
         update_encoder_ui_param(encoder)
 
     def toggle_led(switch):
@@ -165,6 +965,42 @@ def make_control_panel(port, scope, data_sender):
         if switch.value:
             control_panel.toggle_led(switch.control_id)
 
+    def next_acquisition_mode(switch):
+        update_switch_ui_param(switch)
+        if switch.value:
+            sender = selected[0].data_sender
+            sender.modes.next_mode()
+            sender.send_ui_param('acquire', sender.modes_state)
+
+    def next_acquisition_count(switch):
+        update_switch_ui_param(switch)
+        if switch.value:
+            sender = selected[0].data_sender
+            sender.modes.next_count()
+            sender.send_ui_param('acquire', sender.modes_state)
+
+    def toggle_run(switch):
+        update_switch_ui_param(switch)
+        if switch.value:
+            control = selected[0].data_sender.control
+            if control.mode == AcquisitionControl.RUN:
+                control.set_mode(AcquisitionControl.STOP)
+            else:
+                control.set_mode(AcquisitionControl.RUN)
+
+    def single_shot(switch):
+        update_switch_ui_param(switch)
+        if switch.value:
+            selected[0].data_sender.control.set_mode(
+                    AcquisitionControl.SINGLE)
+
+    def next_instrument(switch):
+        update_switch_ui_param(switch)
+        if switch.value:
+            index = (selected[0].instrument_id + 1) % len(instruments)
+            selected[0] = instruments[index]
+            data_sender.send_ui_param('instrument', index)
+
     control_panel.add_encoder(1, update_encoder_ui_param)
     control_panel.add_encoder(2, update_encoder_ui_param)
     control_panel.add_encoder(3, update_encoder_ui_param)
@@ -178,11 +1014,11 @@ def make_control_panel(port, scope, data_sender):
     control_panel.add_switch('C', toggle_led)
     control_panel.add_switch('D', toggle_led)
     control_panel.add_switch('E', toggle_led)
-    control_panel.add_switch('F', update_switch_ui_param)
-    control_panel.add_switch('G', update_switch_ui_param)
-    control_panel.add_switch('H', update_switch_ui_param)
-    control_panel.add_switch('I', update_switch_ui_param)
-    control_panel.add_switch('J', update_switch_ui_param)
+    control_panel.add_switch('F', next_acquisition_mode)
+    control_panel.add_switch('G', next_acquisition_count)
+    control_panel.add_switch('H', next_instrument)
+    control_panel.add_switch('I', toggle_run)
+    control_panel.add_switch('J', single_shot)
     control_panel.add_switch('P', toggle_led)
 
     control_panel.add_led('A')
@@ -195,61 +1031,287 @@ def make_control_panel(port, scope, data_sender):
     return control_panel
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+            description='Backend service for the TekBots USB oscilloscope.')
+    parser.add_argument('scope_port', metavar='SCOPE_PORT')
+    parser.add_argument('controls_port', metavar='CONTROLS_PORT')
+    parser.add_argument(
+            'server_port', metavar='SERVER_PORT', type=int, nargs='?',
+            default=15151)
+    parser.add_argument(
+            '--scope', metavar='PORT', action='append', default=[],
+            help='serve another scope, may be repeated')
+    parser.add_argument(
+            '--history-mb', metavar='MB', type=float, default=16.0,
+            help='memory for the capture history of each scope, 0 for none '
+                 '(which saves decoding captures that are not sent)')
+    parser.add_argument(
+            '--pipelined', action='store_true',
+            help='decode and publish frames while the next one is acquired')
+    parser.add_argument(
+            '--reactor-serial', action='store_true',
+            help='drive the scope and controls from the reactor, not threads')
+    parser.add_argument(
+            '--worker-process', action='store_true',
+            help='acquire frames in a separate, supervised process')
+    parser.add_argument(
+            '--record', metavar='FILE',
+            help='record every capture to FILE')
+    parser.add_argument(
+            '--replay', action='store_true',
+            help='the scope ports are recordings to play back instead')
+    parser.add_argument(
+            '--replay-speed', metavar='SPEED', type=float, default=1.0,
+            help='times faster than real time to replay, 0 for flat out')
+    parser.add_argument(
+            '--loop', action='store_true',
+            help='start the replay over when it reaches the end')
+    parser.add_argument(
+            '--allow-profiling', action='store_true',
+            help='let clients profile the running server')
+    parser.add_argument(
+            '--fanout-workers', metavar='N', type=int, default=0,
+            help='serve clients from N worker processes sharing the port')
+    args = parser.parse_args()
+    if args.fanout_workers and (args.reactor_serial or args.worker_process):
+        parser.error('--fanout-workers acquires on threads of this process')
+    if args.fanout_workers and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('--fanout-workers needs SO_REUSEPORT')
+    if args.worker_process and (args.record or args.replay):
+        parser.error('--record and --replay need the scope in this process')
+    if args.reactor_serial and args.replay:
+        parser.error('--replay is not supported with --reactor-serial')
+    args.scope_ports = [args.scope_port] + args.scope
+    return args
+
+
 def main():
-    server_port = 15151
-    client_list = set()
+    args = parse_args()
+    # Names the thread in profiles.
+    threading.current_thread().name = 'reactor'
+    if args.fanout_workers:
+        # fanout builds on the classes of this module, so it is only imported
+        # when needed.
+        import fanout
+        fanout.run_with_fanout_workers(args)
+    elif args.reactor_serial:
+        run_on_reactor(args)
+    elif args.worker_process:
+        run_with_worker_process(args)
+    else:
+        run_threaded(args)
+
+
+def listen(server_port, instruments, control_panel, profiler=None):
+    def status_message(msg):
+        print msg
+
+    scope_factory = ScopeFactory(instruments, control_panel, profiler)
+    reactor.listenTCP(server_port, scope_factory)
+    reactor.callWhenRunning(
+            status_message, 'Server started on port %d with %d instrument(s)' %
+            (server_port, len(instruments)))
+
+
+def record_path(args, instrument_id):
+    """Returns the recording of an instrument, if captures are recorded.
+
+    Instrument 0 records to the --record path and the others to PATH.ID.
+    """
+    if not args.record:
+        return None
+    if instrument_id == 0:
+        return args.record
+    return '%s.%d' % (args.record, instrument_id)
 
-    argc = len(sys.argv)
-    if argc < 3 or argc > 4:
-        usage()
-        sys.exit(-1)
 
-    scope_port = sys.argv[1]
-    controls_port = sys.argv[2]
+def history_budget(args):
+    return int(args.history_mb * 1024 * 1024)
 
-    if argc == 4:
-        server_port = int(sys.argv[3])
 
-    scope = Scope(scope_port)
-    scope.set_preamp(Scope.CHANNEL_A, high=True)
-    scope.set_preamp(Scope.CHANNEL_B, high=True)
-    #scope.set_sample_rate_divisor(0x7)
-    #scope.set_trigger_level(1.0)  # default trigger at 1v
+def make_profiler(args):
+    if args.allow_profiling:
+        return profiler.SamplingProfiler()
+    return None
 
-    data_sender = ScopeDataSender(client_list)
 
-    control_panel = make_control_panel(controls_port, scope, data_sender)
+def open_scopes(args, make_data_sender):
+    """Opens every scope for acquisition on a thread of its own.
+
+    make_data_sender(instrument_id, on_demand) builds the data sender of each
+    instrument. Returns the instruments, their ScopeReadThreads and the
+    recorders to close on exit.
+    """
+    instruments = []
+    frame_sinks = []
+    scope_read_threads = []
+    for instrument_id, port in enumerate(args.scope_ports):
+        if args.replay:
+            scope = ReplayScope(Recording(port),
+                                speed=args.replay_speed, loop=args.loop)
+        else:
+            scope = Scope(port)
+        scope.set_preamp(Scope.CHANNEL_A, high=True)
+        scope.set_preamp(Scope.CHANNEL_B, high=True)
+        #scope.set_sample_rate_divisor(0x7)
+        #scope.set_trigger_level(1.0)  # default trigger at 1v
+
+        path = record_path(args, instrument_id)
+        data_sender = make_data_sender(instrument_id, not path)
+        instruments.append(Instrument(instrument_id, scope, data_sender))
+
+        frame_sink = data_sender
+        if path:
+            frame_sink = FrameRecorder(path, data_sender)
+            frame_sinks.append(frame_sink)
+        scope_read_thread = ScopeReadThread(
+                scope, frame_sink, pipelined=args.pipelined,
+                control=data_sender.control)
+        scope_read_thread.name = 'scope-read-%d' % instrument_id
+        scope_read_threads.append(scope_read_thread)
+    return instruments, scope_read_threads, frame_sinks
+
+
+def run_threaded(args):
+    """Acquires from every scope on its own thread."""
+    client_list = set()
 
-    scope_read_thread = ScopeReadThread(scope, data_sender)
+    def make_data_sender(instrument_id, on_demand):
+        return ScopeDataSender(client_list, instrument_id,
+                               on_demand=on_demand,
+                               history_budget=history_budget(args))
+
+    instruments, scope_read_threads, frame_sinks = open_scopes(
+            args, make_data_sender)
+    control_panel = make_control_panel(args.controls_port, instruments)
     control_panel_thread = ControlPanelThread(control_panel)
 
     def stop_server_and_exit(signum, frame):
         print '\rStopping server'
-        scope_read_thread.stop()
+        for scope_read_thread in scope_read_threads:
+            scope_read_thread.stop()
         control_panel_thread.stop()
         print 'Joining control panel thread...'
         control_panel_thread.join()
-        print 'Joining scope read thread... ',
+        print 'Joining scope read threads... ',
         print 'If this takes too long, kill with ^\\'
-        scope_read_thread.join()
+        for scope_read_thread in scope_read_threads:
+            scope_read_thread.join()
+        for frame_sink in frame_sinks:
+            frame_sink.close()
         reactor.stop()
 
-    def status_message(msg):
-        print msg
+    signal.signal(signal.SIGINT, stop_server_and_exit)
+    for scope_read_thread in scope_read_threads:
+        scope_read_thread.start()
+    control_panel_thread.start()
+
+    listen(args.server_port, instruments, control_panel,
+           make_profiler(args))
+    reactor.run()
+
+
+def run_with_worker_process(args):
+    """Runs the acquisition of every scope in a worker process of its own.
+
+    Workers are restarted if they die.
+    """
+    client_list = set()
+    instruments = []
+    workers = []
+    ring_reader_threads = []
+    for instrument_id, port in enumerate(args.scope_ports):
+        data_sender = ScopeDataSender(
+                client_list, instrument_id,
+                history_budget=history_budget(args))
+        ring = FrameRing()
+        worker = AcquisitionWorker(port, ring, pipelined=args.pipelined,
+                                   control=data_sender.control)
+        worker.start()
+        workers.append(worker)
+        instruments.append(
+                Instrument(instrument_id, worker.scope, data_sender))
+        ring_reader_thread = RingReaderThread(
+                ring, data_sender, data_sender.control)
+        ring_reader_thread.name = 'ring-reader-%d' % instrument_id
+        ring_reader_threads.append(ring_reader_thread)
+
+    control_panel = make_control_panel(args.controls_port, instruments)
+    control_panel_thread = ControlPanelThread(control_panel)
+
+    def stop_server_and_exit(signum, frame):
+        print '\rStopping server'
+        for ring_reader_thread in ring_reader_threads:
+            ring_reader_thread.stop()
+        control_panel_thread.stop()
+        for worker in workers:
+            worker.stop()
+        print 'Joining control panel thread...'
+        control_panel_thread.join()
+        for ring_reader_thread in ring_reader_threads:
+            ring_reader_thread.join()
+        reactor.stop()
+
+    def check_workers():
+        for worker in workers:
+            worker.check()
 
     signal.signal(signal.SIGINT, stop_server_and_exit)
-    scope_read_thread.start()
+    for ring_reader_thread in ring_reader_threads:
+        ring_reader_thread.start()
     control_panel_thread.start()
+    task.LoopingCall(check_workers).start(0.5)
 
-    scope_factory = ScopeFactory(client_list, scope, control_panel)
-    reactor.listenTCP(server_port, scope_factory)
-    reactor.callWhenRunning(
-            status_message, 'Server started on port %d' % server_port)
+    listen(args.server_port, instruments, control_panel,
+           make_profiler(args))
     reactor.run()
 
 
-def usage():
-    print 'usage: python tekscope.py SCOPE_PORT CONTROLS_PORT [SERVER_PORT]'
+def run_on_reactor(args):
+    """Runs the scopes and the control panel as protocols on the reactor.
+
+    No threads are involved, so stopping the server is immediate.
+    """
+    client_list = set()
+    instruments = []
+    frame_sinks = []
+    scope_protocols = []
+    for instrument_id, port in enumerate(args.scope_ports):
+        path = record_path(args, instrument_id)
+        data_sender = ScopeDataSender(
+                client_list, instrument_id, on_demand=not path,
+                history_budget=history_budget(args))
+        frame_sink = data_sender
+        if path:
+            frame_sink = FrameRecorder(path, data_sender)
+            frame_sinks.append(frame_sink)
+        scope_protocol = open_scope_serial(
+                port, frame_sink, reactor, data_sender.control)
+        scope_protocols.append(scope_protocol)
+        instruments.append(Instrument(
+                instrument_id, scope_protocol.scope, data_sender))
+
+    control_protocol = open_control_panel_serial(args.controls_port, reactor)
+    control_panel = make_control_panel(
+            args.controls_port, instruments, com=control_protocol.transport)
+    control_protocol.control_panel = control_panel
+
+    def stop_server_and_exit(signum, frame):
+        print '\rStopping server'
+        for scope_protocol in scope_protocols:
+            scope_protocol.stop()
+        for frame_sink in frame_sinks:
+            frame_sink.close()
+        reactor.stop()
+
+    signal.signal(signal.SIGINT, stop_server_and_exit)
+    for scope_protocol in scope_protocols:
+        reactor.callWhenRunning(scope_protocol.start)
+
+    listen(args.server_port, instruments, control_panel,
+           make_profiler(args))
+    reactor.run()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import encoding
+import mockserial
+import modes
+from scope import Frame, Scope
+
+
+def make_frames(count):
+    mock_scope = Scope(None, com=mockserial.Serial(realtime=False, seed=0))
+    frames = []
+    for sequence in range(count):
+        capture = mock_scope.get_frame()
+        frames.append(Frame(sequence, capture.timestamp, None,
+                            capture.end_addr, capture.buf))
+    return frames
+
+
+@pytest.mark.parametrize('count', (0, -1, max(modes.COUNTS) + 1, True, 2.0))
+def test_invalid_counts_are_rejected(count):
+    acquisition_modes = modes.AcquisitionModes()
+    with pytest.raises(ValueError):
+        acquisition_modes.set_mode(modes.AVERAGE, count)
+    assert acquisition_modes.state == {
+        'mode': modes.NORMAL, 'count': modes.DEFAULT_COUNT}
+
+
+def test_counts_cycle_through_counts():
+    acquisition_modes = modes.AcquisitionModes()
+    acquisition_modes.set_mode(count=max(modes.COUNTS))
+    acquisition_modes.next_count()
+    assert acquisition_modes.count == modes.COUNTS[0]
+
+
+def test_persistence_images_are_made_on_demand():
+    persistence = modes.Persistence(4)
+    made = []
+    make_images = persistence.make_images
+
+    def counting_make_images():
+        made.append(None)
+        return make_images()
+    persistence.make_images = counting_make_images
+
+    first, second = [persistence.process(frame) for frame in make_frames(2)]
+    assert not made
+    # Images of a capture that has been superseded are not made at all.
+    assert encoding.encode_persistence(first) == ''
+    assert not made
+    payload = encoding.encode_persistence(second)
+    encoding.encode_persistence(second)
+    assert len(made) == 1
+    data = json.loads(payload)['persistence']
+    assert data['sequence'] == second.sequence
+    for channel in encoding.CHANNELS:
+        assert data[channel]
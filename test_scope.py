@@ -0,0 +1,175 @@
+import collections
+import random
+
+import pytest
+
+import mockserial
+import scope
+from scope import Frame, FramePool, Scope, ScopeReadThread
+from scope import BUFFER_SIZE, CODE_MASK, SAMPLE_COUNT
+
+# End addresses around each point where the rotation wraps, as well as ones
+# past the end of the memory, which the decoders take modulo its size.
+WRAP_END_ADDRS = (0, 1, 2, SAMPLE_COUNT - 2, SAMPLE_COUNT - 1, SAMPLE_COUNT,
+                  SAMPLE_COUNT + 1, 2 * SAMPLE_COUNT - 1, BUFFER_SIZE - 1,
+                  BUFFER_SIZE)
+STEP_SIZES = (0.0521, 0.00592)
+
+
+def baseline_decode(buf, end_addr, step_size):
+    """The original per-sample Scope.decode_sample, which used one step size
+    for both channels.
+    """
+    sample = {Scope.CHANNEL_A: [], Scope.CHANNEL_B: []}
+    for i in range(1024):
+        index = ((i + end_addr) * 4) + 4
+        a_high = ord(buf[index % 4096])
+        a_low = ord(buf[(index + 1) % 4096])
+        b_high = ord(buf[(index + 2) % 4096])
+        b_low = ord(buf[(index + 3) % 4096])
+
+        a = 256 * a_high + a_low
+        b = 256 * b_high + b_low
+        a_voltage = (511 - a) * step_size
+        b_voltage = (511 - b) * step_size
+        sample[Scope.CHANNEL_A].append(round(a_voltage, 2))
+        sample[Scope.CHANNEL_B].append(round(b_voltage, 2))
+    return sample
+
+
+def make_buffer(seed, high_bits=False):
+    """Returns a memory buffer of random 10-bit codes. With high_bits, the
+    unused top bits of each word are set at random too.
+    """
+    rand = random.Random(seed)
+    data = bytearray()
+    for _ in range(2 * SAMPLE_COUNT):
+        word = rand.randint(0, CODE_MASK)
+        if high_bits:
+            word |= rand.randint(0, 0x3f) << 10
+        data.extend(scope.split_bytes(word))
+    return str(data)
+
+
+def as_lists(sample):
+    return dict((channel, list(values)) for channel, values in sample.items())
+
+
+def end_addrs():
+    return sorted(set(range(SAMPLE_COUNT)) | set(WRAP_END_ADDRS))
+
+
+@pytest.mark.parametrize('step_size', STEP_SIZES)
+def test_python_decoder_matches_baseline(step_size):
+    buf = make_buffer(step_size)
+    step_sizes = {Scope.CHANNEL_A: step_size, Scope.CHANNEL_B: step_size}
+    for end_addr in end_addrs():
+        assert (scope.decode_buffer_python(buf, end_addr, step_sizes) ==
+                baseline_decode(buf, end_addr, step_size)), end_addr
+
+
+@pytest.mark.skipif(scope.numpy is None, reason='numpy is not installed')
+@pytest.mark.parametrize('step_size', STEP_SIZES)
+def test_vectorized_decoder_matches_baseline(step_size):
+    buf = make_buffer(step_size)
+    step_sizes = {Scope.CHANNEL_A: step_size, Scope.CHANNEL_B: step_size}
+    for end_addr in end_addrs():
+        assert (as_lists(scope.decode_buffer(buf, end_addr, step_sizes)) ==
+                baseline_decode(buf, end_addr, step_size)), end_addr
+
+
+@pytest.mark.skipif(scope.numpy is None, reason='numpy is not installed')
+@pytest.mark.parametrize('high_bits', (False, True))
+def test_decoders_match_with_separate_step_sizes(high_bits):
+    buf = make_buffer(1, high_bits)
+    step_sizes = dict(zip((Scope.CHANNEL_A, Scope.CHANNEL_B), STEP_SIZES))
+    for end_addr in end_addrs():
+        assert (as_lists(scope.decode_buffer(buf, end_addr, step_sizes)) ==
+                scope.decode_buffer_python(buf, end_addr, step_sizes)), (
+                        end_addr)
+
+
+@pytest.mark.skipif(scope.numpy is None, reason='numpy is not installed')
+def test_decode_codes_into_buffers():
+    buf = make_buffer(2)
+    out = scope.empty_codes()
+    for end_addr in WRAP_END_ADDRS:
+        codes = scope.decode_codes(buf, end_addr, out)
+        assert codes is out
+        assert [c.tolist() for c in codes] == list(
+                scope.decode_codes_python(buf, end_addr))
+
+
+def test_decoders_reject_short_buffers():
+    with pytest.raises(RuntimeError):
+        scope.decode_codes_python('\0' * (BUFFER_SIZE - 1), 0)
+    if scope.numpy is not None:
+        with pytest.raises(RuntimeError):
+            scope.decode_codes('\0' * (BUFFER_SIZE - 1), 0)
+
+
+class FrameSink(object):
+    """Stands in for the data sender, keeping the latest few frames the way
+    client queues do, and stopping the read thread after a number of them.
+    """
+
+    def __init__(self, keep=4, stop_after=None):
+        self.frames = collections.deque(maxlen=keep)
+        self.stop_after = stop_after
+        self.count = 0
+        self.read_thread = None
+        self.slots_made = []
+        self.code_arrays = {}
+
+    def append(self, frame):
+        frame.codes
+        self.frames.append(frame)
+        self.count += 1
+        # Keep the arrays, not the frames, so their ids stay unique.
+        self.code_arrays[id(frame.codes[0])] = frame.codes[0]
+        self.slots_made.append(self.read_thread.pool.slots_made)
+        if self.count == self.stop_after:
+            self.read_thread.stop()
+
+
+def make_read_thread(sink, pipelined=False):
+    mock_scope = Scope(None, com=mockserial.Serial(realtime=False, seed=0))
+    read_thread = ScopeReadThread(mock_scope, sink, pipelined=pipelined)
+    sink.read_thread = read_thread
+    return read_thread
+
+
+def test_pool_reuses_slots_in_steady_state():
+    sink = FrameSink()
+    read_thread = make_read_thread(sink)
+    for _ in range(20):
+        sink.append(read_thread.read_frame())
+    slots_made = read_thread.pool.slots_made
+    sink.code_arrays.clear()
+    for _ in range(100):
+        sink.append(read_thread.read_frame())
+    assert read_thread.pool.slots_made == slots_made
+    assert len(sink.code_arrays) <= read_thread.pool.count
+
+
+def test_pipelined_pool_reuses_slots_in_steady_state():
+    sink = FrameSink(stop_after=120)
+    read_thread = make_read_thread(sink, pipelined=True)
+    read_thread.start()
+    read_thread.join(30)
+    assert not read_thread.is_alive()
+    assert sink.count >= 120
+    # Once the pipeline is full, no more slots are made.
+    assert sink.slots_made[20] == sink.slots_made[-1]
+
+
+def test_pool_reclaims_while_locked():
+    pool = FramePool(2)
+    slot = pool.acquire()
+    frame = Frame(1, 0.0, None, 0, slot[0])
+    pool.lend(frame, slot)
+    # The frame may die on a thread that is inside the pool already.
+    with pool.lock:
+        del frame
+    assert pool.acquire() is slot
+    assert pool.slots_made == 0
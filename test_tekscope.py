@@ -0,0 +1,181 @@
+import collections
+import json
+import time
+
+import pytest
+from twisted.internet.testing import StringTransport
+
+import encoding
+import mockserial
+from scope import Frame, Scope
+from tekscope import Instrument, ScopeDataSender, ScopeProtocol
+
+
+class RecordingProtocol(ScopeProtocol):
+    """Records the frames sent and the payload keys they were sent with."""
+
+    def __init__(self, *args, **kwargs):
+        ScopeProtocol.__init__(self, *args, **kwargs)
+        self.sent = []
+
+    def keys_for(self, payloads):
+        keys = ScopeProtocol.keys_for(self, payloads)
+        self.sent.append((payloads.frame.sequence, keys[0][0]))
+        return keys
+
+
+class FrameSource(object):
+    """Makes frames from one mock capture, at the given capture times."""
+
+    def __init__(self):
+        mock_scope = Scope(None, com=mockserial.Serial(realtime=False, seed=0))
+        self.capture = mock_scope.get_frame()
+        self.sequence = 0
+
+    def next(self, timestamp):
+        self.sequence += 1
+        capture = self.capture
+        return Frame(self.sequence, timestamp, capture.settings,
+                     capture.end_addr, capture.buf)
+
+
+def connect(subscription=None, history_budget=0):
+    data_sender = ScopeDataSender(set(), history_budget=history_budget)
+    mock_scope = Scope(None, com=mockserial.Serial(realtime=False, seed=0))
+    instruments = [Instrument(0, mock_scope, data_sender)]
+    client = RecordingProtocol(instruments, None)
+    client.makeConnection(StringTransport())
+    client.set_wire_format(encoding.FORMAT_DELTA)
+    if subscription:
+        client.set_subscription(subscription)
+    return client, data_sender
+
+
+def send_frames(client, data_sender, count, frame_time):
+    source = FrameSource()
+    try:
+        for i in range(count):
+            payloads = data_sender.encode(source.next(i * frame_time))
+            if payloads is not None:
+                client.queue_frame(payloads)
+    finally:
+        client.clear_throttled()
+
+
+def test_delta_clients_get_periodic_keyframes():
+    client, data_sender = connect()
+    send_frames(client, data_sender, 2 * encoding.KEYFRAME_INTERVAL + 1,
+                0.01)
+    keyframes = [i for i, (_, wire_format) in enumerate(client.sent)
+                 if wire_format == encoding.FORMAT_DELTA_KEYFRAME]
+    assert keyframes == [encoding.KEYFRAME_INTERVAL,
+                         2 * encoding.KEYFRAME_INTERVAL]
+
+
+def test_throttled_delta_clients_get_periodic_keyframes():
+    # Only every third frame is sent, so keyframes due by frame sequence
+    # number would come every KEYFRAME_INTERVAL * 3 frames sent, at best.
+    client, data_sender = connect({'max-rate': 30})
+    send_frames(client, data_sender, 6 * encoding.KEYFRAME_INTERVAL, 0.0125)
+    sent_formats = [wire_format for _, wire_format in client.sent]
+    assert len(sent_formats) >= 2 * encoding.KEYFRAME_INTERVAL
+    deltas = 0
+    for wire_format in sent_formats[1:]:
+        if wire_format == encoding.FORMAT_DELTA_KEYFRAME:
+            assert deltas == encoding.KEYFRAME_INTERVAL - 1
+            deltas = 0
+        else:
+            deltas += 1
+    assert deltas < encoding.KEYFRAME_INTERVAL
+
+
+def queue_frames(client, start, offsets):
+    """Queues frames captured at the given offsets from start, releasing
+    held frames in place of None offsets.
+    """
+    source = FrameSource()
+    for offset in offsets:
+        if offset is None:
+            client.release_throttled()
+            continue
+        frame = source.next(start + offset)
+        client.queue_frame(encoding.FramePayloads(frame, None))
+
+
+def test_throttled_frames_are_sent_in_order():
+    client, _ = connect({'max-rate': 10})
+    # Captures from the past, so held frames are due once released.
+    try:
+        queue_frames(client, time.time() - 60, (0.0, 0.05, 0.12, None))
+    finally:
+        client.clear_throttled()
+    assert [sequence for sequence, _ in client.sent] == [1, 3]
+    assert client.frames_throttled == 1
+
+
+def test_throttled_frames_are_counted_once():
+    client, _ = connect({'max-rate': 10})
+    # Captures from the future, so held frames are never due when released.
+    try:
+        queue_frames(client, time.time() + 60,
+                     (0.0, 0.05, None, 0.07, None, 0.12))
+    finally:
+        client.clear_throttled()
+    assert [sequence for sequence, _ in client.sent] == [1, 4]
+    # Frames 2 and 3 were dropped.
+    assert client.frames_throttled == 2
+
+
+@pytest.mark.parametrize('history_budget', (0, 1024 * 1024))
+def test_skipped_frames_are_only_decoded_for_the_history(history_budget):
+    data_sender = ScopeDataSender(set(), history_budget=history_budget)
+    data_sender.max_rate = 1.0
+    source = FrameSource()
+    first, second = source.next(0.0), source.next(0.5)
+    assert data_sender.encode(first) is not None
+    assert data_sender.encode(second) is None
+    assert (second._codes is not None) == bool(history_budget)
+
+
+def replies(client):
+    lines = client.transport.value().splitlines()
+    client.transport.clear()
+    return [json.loads(line) for line in lines]
+
+
+@pytest.mark.parametrize('command', (
+    {'trigger-level': True},
+    {'trigger-level': '1'},
+    {'sample-rate': True},
+    {'sample-rate': 1.0},
+    {'sample-rate': 16},
+    {'decimate': {'points': True}},
+    {'history': {'from': 'a'}},
+    {'history': {'to': False}},
+    {'history': {'since': [1]}},
+    {'history': {'until': {}}},
+))
+def test_invalid_command_values_are_reported(command):
+    client, _ = connect(history_budget=1024 * 1024)
+    scope = client.instruments[0].scope
+    settings = (scope.trigger_level, scope.sample_rate_divisor,
+                client.decimation)
+    replies(client)
+    client.message_received(json.dumps(command))
+    assert [sorted(reply) for reply in replies(client)] == [['error']]
+    assert client.history_replies == collections.deque()
+    assert settings == (scope.trigger_level, scope.sample_rate_divisor,
+                        client.decimation)
+
+
+def test_valid_command_values_are_applied():
+    client, _ = connect(history_budget=1024 * 1024)
+    scope = client.instruments[0].scope
+    replies(client)
+    client.message_received(json.dumps([
+        {'trigger-level': 1.5},
+        {'sample-rate': 3},
+        {'history': {'from': 1, 'to': 2.0, 'since': 0, 'until': 1e12}},
+    ]))
+    assert (scope.trigger_level, scope.sample_rate_divisor) == (1.5, 3)
+    assert [reply for reply in replies(client) if 'error' in reply] == []